@@ -19,6 +19,37 @@ import numpy as np
 import torch
 
 
+def image_to_tensor(img, out=None, pin_memory=False):
+    """
+    Function to normalize an image to [0, 1] and swap its color axis (numpy image: H x W x C, torch image: C x H x W,
+    leading batch axes are kept) directly into a contiguous float32 tensor
+    :param np.ndarray img: image (uint8, or any dtype clamped to [0, 1] after scaling)
+    :param None/torch.Tensor out: contiguous float32 tensor to write to (e.g. a reused pinned buffer), default: new
+    :param bool pin_memory: allocate the new tensor in pinned memory (only if CUDA is available, not in DataLoader
+                            worker processes)
+    :return: torch.Tensor
+    """
+    if out is None:
+        shape = img.shape[:-3] + (img.shape[-1],) + img.shape[-3:-1]
+        out = torch.empty(shape, dtype=torch.float32, pin_memory=pin_memory and torch.cuda.is_available())
+
+    # Swapping the axes of uint8 images before the division (a copy of a quarter of the size) keeps the division
+    # contiguous, which is faster than dividing the strided view
+    img_chw = np.moveaxis(img, -1, -3)
+    if img.dtype == np.uint8:
+        img_chw = np.ascontiguousarray(img_chw)
+
+    # Computed in float32 (as img.astype(np.float32) / 255.0)
+    out_array = out.numpy()
+    np.divide(img_chw, np.float32(255.0), out=out_array, dtype=np.float32, casting='unsafe')
+
+    # Clamping is a no-op for uint8 images
+    if img.dtype != np.uint8:
+        np.clip(out_array, 0.0, 1.0, out=out_array)
+
+    return out
+
+
 ##
 # Transformations for evaluation
 ##
@@ -27,18 +58,11 @@ class ToTensorTest(object):
     Convert np.ndarrays in sample to Tensors.
     """
 
-    def __call__(self, img):
-        img = img.astype(np.float32)
-
-        # Normalize and clamp between 0 and 1
-        img = np.clip(img / 255.0, a_min=0.0, a_max=1.0)
-
-        # swap color axis because
-        # numpy image: H x W x C
-        # torch image: C X H X W
-        img = img.transpose((2, 0, 1))
+    def __init__(self, pin_memory=False):
+        self.pin_memory = pin_memory
 
-        return img
+    def __call__(self, img):
+        return image_to_tensor(img, pin_memory=self.pin_memory)
 
 
 ##
@@ -49,20 +73,66 @@ class ToTensor(object):
     Convert ndarrays in sample to Tensors.
     """
 
+    def __init__(self, pin_memory=False):
+        self.pin_memory = pin_memory
+
     def __call__(self, sample):
         img, label, weight = sample['img'], sample['label'], sample['weight']
 
-        img = img.astype(np.float32)
+        return {'img': image_to_tensor(img, pin_memory=self.pin_memory),
+                'label': torch.from_numpy(np.ascontiguousarray(label)),
+                'weight': torch.from_numpy(np.ascontiguousarray(weight))}
+
+
+def get_pad_widths(pad_size):
+    """
+    Function to get the padding of height and width as ((top, bottom), (left, right))
+    :param int/tuple pad_size: padding as accepted by np.pad for two axes (int, (before, after) or
+                               ((top, bottom), (left, right)))
+    :return:
+    """
+    return tuple(tuple(int(width) for width in axis) for axis in np.broadcast_to(pad_size, (2, 2)))
+
+
+def crop_edge_padded(data, top, left, output_size, pad_size, out=None):
+    """
+    Function to crop a window of the edge padded data without padding it: the window is given in padded coordinates,
+    only its part inside the data is copied and the border outside is filled by replicating the edge, as
+    np.pad(data, pad_size, 'edge')[top:top + output_size[0], left:left + output_size[1]] would give
+    :param np.ndarray data: data to crop (H x W x ...)
+    :param int top: first row of the window in padded coordinates
+    :param int left: first column of the window in padded coordinates
+    :param tuple output_size: height and width of the window
+    :param tuple pad_size: padding ((top, bottom), (left, right)), only the padding before is needed
+    :param None/np.ndarray out: array to write the window to (default: new array)
+    :return:
+    """
+    if out is None:
+        out = np.empty(tuple(output_size) + data.shape[2:], dtype=data.dtype)
+
+    h, w = data.shape[:2]
+    row, col = top - pad_size[0][0], left - pad_size[1][0]
+
+    # Rows and columns of the window inside the data
+    r0, c0 = min(max(-row, 0), output_size[0]), min(max(-col, 0), output_size[1])
+    r1, c1 = max(min(h - row, output_size[0]), r0), max(min(w - col, output_size[1]), c0)
 
-        # Normalize image and clamp between 0 and 1
-        img = np.clip(img / 255.0, a_min=0.0, a_max=1.0)
+    if r0 == r1 or c0 == c1:
+        # Window completely in the padding along an axis
+        rows = np.clip(np.arange(row, row + output_size[0]), 0, h - 1)
+        cols = np.clip(np.arange(col, col + output_size[1]), 0, w - 1)
+        out[...] = data[np.ix_(rows, cols)]
+        return out
 
-        # swap color axis because
-        # numpy image: H x W x C
-        # torch image: C X H X W
-        img = img.transpose((2, 0, 1))
+    out[r0:r1, c0:c1] = data[row + r0:row + r1, col + c0:col + c1]
 
-        return {'img': torch.from_numpy(img), 'label': label, 'weight': weight}
+    # Replicate the edge columns, then the edge rows (which fills the corners)
+    out[r0:r1, :c0] = out[r0:r1, c0:c0 + 1]
+    out[r0:r1, c1:] = out[r0:r1, c1 - 1:c1]
+    out[:r0] = out[r0:r0 + 1]
+    out[r1:] = out[r1 - 1:r1]
+
+    return out
 
 
 class AugmentationPadImage(object):
@@ -74,14 +144,12 @@ class AugmentationPadImage(object):
 
         assert isinstance(pad_size, (int, tuple))
 
-        if isinstance(pad_size, int):
-
-            # Do not pad along the channel dimension
-            self.pad_size_image = ((pad_size, pad_size), (pad_size, pad_size), (0, 0))
-            self.pad_size_mask = ((pad_size, pad_size), (pad_size, pad_size))
+        # (before, after) of height and width, an int or a tuple as accepted by np.pad
+        self.pad_size = get_pad_widths(pad_size)
 
-        else:
-            self.pad_size = pad_size
+        # Do not pad along the channel dimension
+        self.pad_size_image = self.pad_size + ((0, 0),)
+        self.pad_size_mask = self.pad_size
 
         self.pad_type = pad_type
 
@@ -134,3 +202,147 @@ class AugmentationRandomCrop(object):
         weight = weight[top:bottom, left:right]
 
         return {'img': img, 'label': label, 'weight': weight}
+
+
+class AugmentationPadCrop(object):
+    """
+    Pad (edge replication) and crop img, label and weight in one step without creating the padded arrays. The crop
+    position is drawn like AugmentationRandomCrop draws it on the padded arrays, so the result is identical to
+    AugmentationPadImage followed by AugmentationRandomCrop.
+    """
+
+    def __init__(self, pad_size=((16, 16), (16, 16)), output_size=256, crop_type='Random'):
+
+        assert isinstance(output_size, (int, tuple))
+
+        self.pad_size = get_pad_widths(pad_size)
+        self.output_size = (output_size, output_size) if isinstance(output_size, int) else output_size
+        self.crop_type = crop_type
+
+    def get_window(self, h, w):
+        """
+        Function to get the crop position in padded coordinates
+        :param int h: height of the unpadded data
+        :param int w: width of the unpadded data
+        :return: top, left
+        """
+        h += sum(self.pad_size[0])
+        w += sum(self.pad_size[1])
+
+        if self.crop_type == 'Center':
+            return (h - self.output_size[0]) // 2, (w - self.output_size[1]) // 2
+
+        top = np.random.randint(0, h - self.output_size[0])
+        left = np.random.randint(0, w - self.output_size[1])
+        return top, left
+
+    def __call__(self, sample):
+        img, label, weight = sample['img'], sample['label'], sample['weight']
+
+        top, left = self.get_window(*img.shape[:2])
+
+        return {'img': crop_edge_padded(img, top, left, self.output_size, self.pad_size),
+                'label': crop_edge_padded(label, top, left, self.output_size, self.pad_size),
+                'weight': crop_edge_padded(weight, top, left, self.output_size, self.pad_size)}
+
+
+##
+# Batched transformations for training (applied to whole batches in the collate function of the DataLoader)
+##
+class BatchToTensor(ToTensor):
+    """
+    Convert a batch of ndarrays (N x H x W x C images) to Tensors: the images are normalized to [0, 1] into one
+    contiguous N x C x H x W float32 tensor, labels and weights are converted as well.
+    """
+
+
+class BatchAugmentationPadImage(AugmentationPadImage):
+    """
+    Pad a batch of images (N x H x W x C), labels and weights (N x H x W) like AugmentationPadImage, with one np.pad
+    call per array
+    """
+
+    def __call__(self, batch):
+        img, label, weight = batch['img'], batch['label'], batch['weight']
+
+        img = np.pad(img, ((0, 0),) + self.pad_size_image, self.pad_type)
+        label = np.pad(label, ((0, 0),) + self.pad_size_mask, self.pad_type)
+        weight = np.pad(weight, ((0, 0),) + self.pad_size_mask, self.pad_type)
+
+        return {'img': img, 'label': label, 'weight': weight}
+
+
+class BatchAugmentationRandomCrop(AugmentationRandomCrop):
+    """
+    Crop every image of a batch (N x H x W x C), its label and weight (N x H x W) at its own random position (drawn
+    in the order AugmentationRandomCrop draws them sample by sample) into one preallocated array per key
+    """
+
+    def __call__(self, batch):
+        img, label, weight = batch['img'], batch['label'], batch['weight']
+
+        n, h, w, _ = img.shape
+
+        if self.crop_type == 'Center':
+            top = (h - self.output_size[0]) // 2
+            left = (w - self.output_size[1]) // 2
+
+            return {'img': img[:, top:top + self.output_size[0], left:left + self.output_size[1], :],
+                    'label': label[:, top:top + self.output_size[0], left:left + self.output_size[1]],
+                    'weight': weight[:, top:top + self.output_size[0], left:left + self.output_size[1]]}
+
+        cropped = {key: np.empty((n,) + self.output_size + batch[key].shape[3:], dtype=batch[key].dtype)
+                   for key in ['img', 'label', 'weight']}
+
+        # Copying the windows sample by sample is much faster than a fancy-indexing gather over the batch
+        for idx in range(n):
+            top = np.random.randint(0, h - self.output_size[0])
+            left = np.random.randint(0, w - self.output_size[1])
+
+            for key in ['img', 'label', 'weight']:
+                cropped[key][idx] = batch[key][idx, top:top + self.output_size[0], left:left + self.output_size[1]]
+
+        return cropped
+
+
+class BatchAugmentationPadCrop(AugmentationPadCrop):
+    """
+    Pad and crop every image of a batch (N x H x W x C), its label and weight (N x H x W) like AugmentationPadCrop,
+    into one preallocated array per key
+    """
+
+    def __call__(self, batch):
+        n, h, w, _ = batch['img'].shape
+
+        cropped = {key: np.empty((n,) + self.output_size + batch[key].shape[3:], dtype=batch[key].dtype)
+                   for key in ['img', 'label', 'weight']}
+
+        for idx in range(n):
+            top, left = self.get_window(h, w)
+
+            for key in ['img', 'label', 'weight']:
+                crop_edge_padded(batch[key][idx], top, left, self.output_size, self.pad_size, out=cropped[key][idx])
+
+        return cropped
+
+
+class BatchCollate(object):
+    """
+    Collate function for the DataLoader: stacks the samples of AsegDatasetWithAugmentation (created without
+    per-sample transforms) into one array per key and applies the batched transforms to the whole batch, e.g.
+    DataLoader(dataset, batch_size, collate_fn=BatchCollate(transforms.Compose([BatchAugmentationPadImage(),
+    BatchAugmentationRandomCrop(256), BatchToTensor()])))
+    """
+
+    def __init__(self, transforms=None):
+        self.transforms = transforms
+
+    def __call__(self, samples):
+        batch = {'img': np.stack([sample['image'] for sample in samples]),
+                 'label': np.stack([sample['label'] for sample in samples]),
+                 'weight': np.stack([sample['weight'] for sample in samples])}
+
+        if self.transforms is not None:
+            batch = self.transforms(batch)
+
+        return {'image': batch['img'], 'label': batch['label'], 'weight': batch['weight']}
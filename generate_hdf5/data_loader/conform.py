@@ -64,28 +64,132 @@ def options_parse():
 
 
 def map_image(img, out_affine, out_shape, ras2ras=np.array([[1.0, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]]),
-              order=1):
+              order=1, data=None, num_threads=1):
     """
     Function to map image to new voxel space (RAS orientation)
+    Float images are interpolated into float32 (integer images into their dtype, rounded by scipy). For order <= 1
+    (no spline prefiltering of the whole input needed) and num_threads > 1, the output is split into slabs along the
+    first axis, which are interpolated by num_threads threads. The source coordinates of each slab are computed as
+    affine_transform computes them for the whole volume, so the result does not depend on num_threads.
 
     :param nibabel.MGHImage img: the src 3D image with data and affine set
     :param np.ndarray out_affine: trg image affine
     :param np.ndarray out_shape: the trg shape information
     :param np.ndarray ras2ras: ras2ras an additional maping that should be applied (default=id to just reslice)
     :param int order: order of interpolation (0=nearest,1=linear(default),2=quadratic,3=cubic)
+    :param None/np.ndarray data: image data of img if already decoded (default None = read from img)
+    :param int num_threads: number of threads interpolating slabs of the output (default 1)
     :return: mapped Image data array
     """
-    from scipy.ndimage import affine_transform
+    from scipy.ndimage import affine_transform, map_coordinates
     from numpy.linalg import inv
+    from concurrent.futures import ThreadPoolExecutor
+
+    if data is None:
+        data = np.asanyarray(img.dataobj)
 
     # compute vox2vox from src to trg
     vox2vox = inv(out_affine) @ ras2ras @ img.affine
 
     # here we apply the inverse vox2vox (to pull back the src info to the target image)
-    new_data = affine_transform(img.get_data(), inv(vox2vox), output_shape=out_shape, order=order)
+    trg2src = inv(vox2vox)
+    matrix, offset = trg2src[:3, :3], trg2src[:3, 3]
+    out_shape = tuple(int(s) for s in out_shape[:3])
+    new_data = np.empty(out_shape, dtype=data.dtype.newbyteorder('=') if np.issubdtype(data.dtype, np.integer)
+                        else np.float32)
+
+    if order > 1 or num_threads <= 1:
+        affine_transform(data, matrix, offset, output=new_data, order=order)
+        return new_data
+
+    # Source coordinates summed in the order of affine_transform (offset first, then the output axes), a shifted
+    # offset per slab would round differently and move voxels on the border of the input in or out
+    grid = np.ogrid[tuple(slice(0, s) for s in out_shape)]
+
+    def map_slab(start, block_size=8):
+        for idx in range(start, min(start + slab_size, out_shape[0]), block_size):
+            rows = grid[0][idx:idx + block_size]
+            coordinates = np.empty((3, rows.shape[0]) + out_shape[1:])
+            for axis in range(3):
+                coordinates[axis] = offset[axis] + rows * matrix[axis, 0]
+                coordinates[axis] += grid[1] * matrix[axis, 1]
+                coordinates[axis] += grid[2] * matrix[axis, 2]
+
+            map_coordinates(data, coordinates, output=new_data[idx:idx + rows.shape[0]], order=order)
+
+    slab_size = -(-out_shape[0] // num_threads)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(map_slab, range(0, out_shape[0], slab_size)))
+
     return new_data
 
 
+def iter_blocks(data, block_size=16):
+    """
+    Generator over blocks of block_size slices along the first axis of data (views)
+
+    :param np.ndarray data: array to iterate over
+    :param int block_size: number of slices per block
+    :return: blocks of data
+    """
+    for idx in range(0, data.shape[0], block_size):
+        yield data[idx:idx + block_size]
+
+
+def get_intensity_stats(data, histosize=1000, histogram=True):
+    """
+    Function to get min, max, number of non-zero voxels (abs >= 1e-15) and the histogram (histosize bins between min
+    and max) of the image intensities, identical to np.min, np.max, ... and np.histogram(data, histosize).
+    Integer images with up to 16 bit are counted once with np.bincount (the histogram is computed from the counts of
+    the values), other images are passed through block by block: min, max and non-zero voxels in one pass, the
+    histogram (which needs the range) in a second one, without full-size temporaries.
+
+    :param np.ndarray data: Image data (intensity values)
+    :param int histosize: number of histogram bins
+    :param bool histogram: compute the histogram (default True), None is returned otherwise
+    :return: src_min, src_max (scalars of the data dtype), number of non-zero voxels, histogram
+    """
+    if np.issubdtype(data.dtype, np.integer) and data.dtype.itemsize <= 2 and data.size > 0:
+        # Count the bit patterns (signed values are counted as their unsigned view)
+        native = data.dtype.newbyteorder('=')
+        unsigned = np.dtype('u{}'.format(data.dtype.itemsize))
+        counts = np.zeros(2 ** (8 * data.dtype.itemsize), dtype=np.intp)
+        for block in iter_blocks(data):
+            counts += np.bincount(np.ascontiguousarray(block, dtype=native).view(unsigned).ravel(),
+                                  minlength=len(counts))
+
+        present = np.flatnonzero(counts)
+        values = present.astype(unsigned).view(native)
+        counts = counts[present]
+
+        src_min, src_max = np.min(values), np.max(values)
+        nz = int(counts[values != 0].sum())
+        hist = np.histogram(values, histosize, range=(src_min, src_max), weights=counts)[0].astype(np.intp) \
+            if histogram else None
+
+        return src_min, src_max, nz, hist
+
+    src_min, src_max, nz = None, None, 0
+    for block in iter_blocks(data):
+        block_min, block_max = np.min(block), np.max(block)
+        # np.minimum / np.maximum propagate NaN as np.min / np.max do
+        src_min = block_min if src_min is None else np.minimum(src_min, block_min)
+        src_max = block_max if src_max is None else np.maximum(src_max, block_max)
+        nz += int(np.count_nonzero(np.abs(block) >= 1e-15))
+
+    if src_min is None:
+        # Empty image (np.min raises as before)
+        src_min = src_max = np.min(data)
+
+    hist = None
+    if histogram:
+        hist = np.zeros(histosize, dtype=np.intp)
+        for block in iter_blocks(data):
+            hist += np.histogram(block, histosize, range=(src_min, src_max))[0]
+
+    return src_min, src_max, nz, hist
+
+
 def getscale(data, dst_min, dst_max, f_low=0.0, f_high=0.999):
     """
     Function to get offset and scale of image intensities to robustly rescale to range dst_min..dst_max.
@@ -98,9 +202,9 @@ def getscale(data, dst_min, dst_max, f_low=0.0, f_high=0.999):
     :param f_high: robust cropping at higher end (0.999 crop one thousandths of high intensity voxels)
     :return: returns (adjusted) src_min and scale factor
     """
-    # get min and max from source
-    src_min = np.min(data)
-    src_max = np.max(data)
+    # get min and max, non-zeros and histogram from source
+    histosize = 1000
+    src_min, src_max, nz, hist = get_intensity_stats(data, histosize, histogram=not (f_low == 0.0 and f_high == 1.0))
 
     if src_min < 0.0:
         sys.exit('ERROR: Min value in input is below 0.0!')
@@ -110,14 +214,11 @@ def getscale(data, dst_min, dst_max, f_low=0.0, f_high=0.999):
     if f_low == 0.0 and f_high == 1.0:
         return src_min, 1.0
 
-    # compute non-zeros and total vox num
-    nz = (np.abs(data) >= 1e-15).sum()
+    # compute total vox num
     voxnum = data.shape[0] * data.shape[1] * data.shape[2]
 
     # compute histogram
-    histosize = 1000
     bin_size = (src_max - src_min) / histosize
-    hist, bin_edges = np.histogram(data, histosize)
 
     # compute cummulative sum
     cs = np.concatenate(([0], np.cumsum(hist)))
@@ -160,24 +261,39 @@ def getscale(data, dst_min, dst_max, f_low=0.0, f_high=0.999):
     return src_min, scale
 
 
-def scalecrop(data, dst_min, dst_max, src_min, scale):
+def scalecrop(data, dst_min, dst_max, src_min, scale, out=None):
     """
     Function to crop the intensity ranges to specific min and max values
+    The values are computed block by block (in the same precision as before), so there are no full-size temporaries.
+    With out, the result is written to out (e.g. in place into a float32 image, or rounded into an uint8 image).
 
     :param np.ndarray data: Image data (intensity values)
     :param float dst_min: future minimal intensity value
     :param float dst_max: future maximal intensity value
     :param float src_min: minimal value to consider from source (crops below)
     :param float scale: scale value by which source will be shifted
+    :param None/np.ndarray out: array to write the result to (same shape as data, may be data itself), integer arrays
+                                get the rounded (np.rint) values (default None = new array)
     :return: scaled Image data array
     """
-    data_new = dst_min + scale * (data - src_min)
+    out_min, out_max = None, None
 
-    # clip
-    data_new = np.clip(data_new, dst_min, dst_max)
-    print("Output:   min: " + format(data_new.min()) + "  max: " + format(data_new.max()))
+    for idx in range(0, data.shape[0], 16):
+        block = dst_min + scale * (data[idx:idx + 16] - src_min)
 
-    return data_new
+        # clip
+        np.clip(block, dst_min, dst_max, out=block)
+        out_min = block.min() if out_min is None else min(out_min, block.min())
+        out_max = block.max() if out_max is None else max(out_max, block.max())
+
+        if out is None:
+            out = np.empty(data.shape, dtype=block.dtype)
+
+        out[idx:idx + 16] = np.rint(block) if np.issubdtype(out.dtype, np.integer) else block
+
+    print("Output:   min: " + format(out_min) + "  max: " + format(out_max))
+
+    return out
 
 
 def rescale(data, dst_min, dst_max, f_low=0.0, f_high=0.999):
@@ -196,7 +312,7 @@ def rescale(data, dst_min, dst_max, f_low=0.0, f_high=0.999):
     return data_new
 
 
-def conform(img, order=1):
+def conform(img, order=1, label=False, num_threads=1):
     """
     Python version of mri_convert -c, which turns image intensity values into UCHAR, reslices images to standard position, fills up
     slices to standard 256x256x256 format and enforces 1 mm isotropic voxel sizes.
@@ -204,8 +320,13 @@ def conform(img, order=1):
     Difference to mri_convert -c is that we first interpolate (float image), and then rescale to uchar. mri_convert is
     doing it the other way. However, we compute the scale factor from the input to be more similar again
 
+    Label volumes (segmentations) are resliced with nearest neighbour interpolation and keep their label values
+    (stored as int32, no rescaling).
+
     :param nibabel.MGHImage img: loaded source image
-    :param int order: interpolation order (0=nearest,1=linear(default),2=quadratic,3=cubic)
+    :param int order: interpolation order (0=nearest,1=linear(default),2=quadratic,3=cubic), 0 for label volumes
+    :param bool label: img is a label volume (default False)
+    :param int num_threads: number of threads used for the interpolation (default 1)
     :return:nibabel.MGHImage new_img: conformed image
     """
     from nibabel.freesurfer.mghformat import MGHHeader
@@ -223,18 +344,38 @@ def conform(img, order=1):
     # from_header does not compute Pxyz_c (and probably others) when importing from nii
     # Pxyz is the center of the image in world coords
 
+    # decode the source once (used for the scale and the mapping)
+    data = np.asanyarray(img.dataobj)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3])
+
+    if label:
+        mapped_data = map_image(img, h1.get_affine(), h1.get_data_shape(), order=0, data=data,
+                                num_threads=num_threads)
+        if not np.issubdtype(mapped_data.dtype, np.integer):
+            mapped_data = np.rint(mapped_data)
+
+        new_img = nib.MGHImage(np.asarray(mapped_data, dtype=np.int32), h1.get_affine(), h1)
+        new_img.set_data_dtype(np.int32)
+
+        return new_img
+
     # get scale for conversion on original input before mapping to be more similar to mri_convert
-    src_min, scale = getscale(img.get_data(), 0, 255)
+    src_min, scale = getscale(data, 0, 255)
 
-    mapped_data = map_image(img, h1.get_affine(), h1.get_data_shape(), order=order)
+    mapped_data = map_image(img, h1.get_affine(), h1.get_data_shape(), order=order, data=data,
+                            num_threads=num_threads)
     # print("max: "+format(np.max(mapped_data)))
 
+    new_data = None
     if not img.get_data_dtype() == np.dtype(np.uint8):
 
         if np.max(mapped_data) > 255:
-            mapped_data = scalecrop(mapped_data, 0, 255, src_min, scale)
+            # scale, clip and round straight into the uchar image
+            new_data = scalecrop(mapped_data, 0, 255, src_min, scale, out=np.empty(mapped_data.shape, np.uint8))
 
-    new_data = np.uint8(np.rint(mapped_data))
+    if new_data is None:
+        new_data = np.uint8(np.rint(mapped_data))
     new_img = nib.MGHImage(new_data, h1.get_affine(), h1)
 
     # make sure we store uchar
@@ -0,0 +1,574 @@
+# IMPORTS
+import os
+import numpy as np
+import h5py
+
+try:
+    # Registers the blosc and zstd filters, so files written with them can be read
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+# Storage dtypes for the weight dataset
+WEIGHT_DTYPES = ['float64', 'float32', 'float16', 'uint8']
+
+# Compression filters for the datasets (blosc and zstd need the optional hdf5plugin package)
+COMPRESSIONS = ['gzip', 'lzf', 'none', 'blosc', 'zstd']
+
+
+##
+# Compression and chunk layout
+##
+def check_compression_options(options):
+    """
+    Function to check that the hdf5 filters accept the options (e.g. the compression level), by creating a small
+    dataset in an in-memory file. h5py checks them only when a dataset is created.
+    :param dict options: keyword arguments for create_dataset as returned by get_compression_options
+    :return: options
+    """
+    try:
+        with h5py.File("check_compression_options.hdf5", "w", driver='core', backing_store=False) as hf:
+            hf.create_dataset('check', data=np.zeros((2, 2), dtype=np.uint8), chunks=(1, 2), **options)
+
+    except (ValueError, TypeError, OSError) as e:
+        raise ValueError("Invalid compression options {}: {}".format(options, e))
+
+    return options
+
+
+def get_compression_options(compression='gzip', compression_level=None, shuffle=False):
+    """
+    Function to get the filter keyword arguments for h5py create_dataset
+    :param str compression: compression filter (one of COMPRESSIONS, default gzip)
+    :param None/int compression_level: level of the compression filter (None = filter default, ignored for lzf)
+    :param bool shuffle: apply the hdf5 shuffle filter before compression (blosc shuffles internally)
+    :return: dictionary of keyword arguments for create_dataset (checked with check_compression_options)
+    """
+    if compression == 'none':
+        return {'shuffle': shuffle}
+
+    if compression == 'gzip':
+        return check_compression_options({'compression': 'gzip', 'compression_opts': compression_level,
+                                          'shuffle': shuffle})
+
+    if compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': shuffle}
+
+    if compression not in ['blosc', 'zstd']:
+        raise ValueError('Unknown compression {}, use one of {}'.format(compression, COMPRESSIONS))
+
+    if hdf5plugin is None:
+        raise ImportError('Compression {} needs the hdf5plugin package (pip install hdf5plugin)'.format(compression))
+
+    if compression == 'blosc':
+        blosc_shuffle = hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE
+        clevel = 5 if compression_level is None else compression_level
+        return check_compression_options(dict(hdf5plugin.Blosc(cname='zstd', clevel=clevel, shuffle=blosc_shuffle)))
+
+    options = dict(hdf5plugin.Zstd(clevel=3 if compression_level is None else compression_level))
+    options['shuffle'] = shuffle
+    return check_compression_options(options)
+
+
+##
+# Compact weight storage
+##
+def get_weight_lut(scale, offset):
+    """
+    Function to get the weights of the 256 uint8 codes of log quantized weights (code 0 is weight 0, code k > 0 is
+    exp(offset + (k - 1) * scale))
+    :param float scale: quantization step of the log weights
+    :param float offset: log of the weight of code 1
+    :return: weights of the codes (256,) float32
+    """
+    lut = np.exp(offset + (np.arange(256) - 1) * scale).astype(np.float32)
+    lut[0] = 0.0
+    return lut
+
+
+def get_weight_quantization(weight_min, weight_max):
+    """
+    Function to get the attributes of log quantized uint8 weights: codes 1 to 255 are spaced logarithmically from
+    weight_min to weight_max (every weight is kept with a relative error of at most exp(scale / 2) - 1, ~2.3% for the
+    defaults of HDF5SliceWriter), code 0 is weight 0. Median frequency weights of large classes (background) are far
+    below the linear step of weight_max / 255, so a linear quantization would turn them to 0.
+    :param float weight_min: smallest weight kept (smaller positive weights are stored as weight_min)
+    :param float weight_max: largest weight (larger weights are stored as weight_max)
+    :return: dictionary of the encoding, scale and offset attributes
+    """
+    if not 0 < weight_min < weight_max:
+        raise ValueError("Need 0 < weight_min < weight_max, got {} and {}".format(weight_min, weight_max))
+
+    return {'encoding': 'log', 'scale': (np.log(weight_max) - np.log(weight_min)) / 254.0,
+            'offset': float(np.log(weight_min))}
+
+
+def encode_weights(weights, dtype, scale=1.0, offset=0.0, encoding='linear'):
+    """
+    Function to convert weights to their storage dtype. uint8 weights are quantized as
+    round((weights - offset) / scale) (encoding linear, written before log quantization was added) or as
+    round((log(weights) - offset) / scale) + 1 with 0 for weights <= 0 (encoding log, see get_weight_quantization),
+    the float dtypes are cast.
+    :param np.ndarray weights: weights to store
+    :param str dtype: storage dtype (one of WEIGHT_DTYPES)
+    :param float scale: quantization step for uint8
+    :param float offset: quantization offset for uint8
+    :param str encoding: quantization of uint8 weights (linear or log)
+    :return:
+    """
+    if dtype == 'uint8' and encoding == 'log':
+        positive = weights > 0
+        quantized = np.rint((np.log(np.where(positive, weights, 1.0)) - offset) / scale) + 1
+        return np.where(positive, np.clip(quantized, 1, 255), 0).astype(np.uint8)
+
+    if dtype == 'uint8':
+        quantized = np.rint((weights - offset) / scale)
+        return np.clip(quantized, 0, 255).astype(np.uint8)
+
+    return weights.astype(dtype, copy=False)
+
+
+def decode_weights(weights, scale=None, offset=0.0, encoding='linear'):
+    """
+    Function to convert stored weights back to float (inverse of encode_weights)
+    :param np.ndarray weights: stored weights
+    :param None/float scale: quantization step (scale attribute of the weight dataset), None if not quantized
+    :param float offset: quantization offset (offset attribute of the weight dataset)
+    :param str encoding: quantization (encoding attribute of the weight dataset)
+    :return:
+    """
+    if scale is not None and encoding == 'log':
+        return get_weight_lut(scale, offset)[weights]
+
+    if scale is not None:
+        return weights.astype(np.float32) * np.float32(scale) + np.float32(offset)
+
+    if weights.dtype == np.float16:
+        return weights.astype(np.float32)
+
+    return weights
+
+
+def get_weight_scale(dataset):
+    """
+    Function to get the quantization of a stored weight dataset
+    :param h5py.Dataset dataset: weight dataset
+    :return: scale (None if not quantized), offset and encoding
+    """
+    if 'scale' not in dataset.attrs:
+        return None, 0.0, 'linear'
+
+    encoding = dataset.attrs.get('encoding', 'linear')
+    encoding = encoding.decode() if isinstance(encoding, bytes) else str(encoding)
+    return float(dataset.attrs['scale']), float(dataset.attrs['offset']), encoding
+
+
+##
+# Per-slice index
+##
+def get_slice_index_dtype(num_classes, cropped=False):
+    """
+    Function to get the record of the per-slice index: subject_id (position in the subject dataset), slice_idx
+    (index of the slice in the volume of the plane), foreground (number of non-background label voxels) and
+    class_mask (classes present in the slice, packed into bits with np.packbits).
+    Records of cropped slices additionally hold bucket (position in the buckets attribute of the file), bucket_slice
+    (position in the datasets of the bucket), crop_top and crop_left (position of the crop in the full frame) and
+    weight_fill (weight outside of the crop).
+    :param int num_classes: number of classes of the label space
+    :param bool cropped: record of cropped slices
+    :return: numpy structured dtype
+    """
+    fields = [('subject_id', np.uint32), ('slice_idx', np.uint16), ('foreground', np.uint32),
+              ('class_mask', np.uint8, ((num_classes + 7) // 8,))]
+
+    if cropped:
+        fields += [('bucket', np.uint8), ('bucket_slice', np.uint32), ('crop_top', np.uint16),
+                   ('crop_left', np.uint16), ('weight_fill', np.float64)]
+
+    return np.dtype(fields)
+
+
+def get_class_presence(slice_index, num_classes):
+    """
+    Function to unpack the class masks of a slice index
+    :param np.ndarray slice_index: records of the slice index (N,)
+    :param int num_classes: number of classes (num_classes attribute of the slice index dataset)
+    :return: boolean array (N, num_classes), True where the class is present in the slice
+    """
+    return np.unpackbits(slice_index['class_mask'], axis=1, count=num_classes).astype(bool)
+
+
+##
+# Streaming hdf5 writer (for training set generation)
+##
+class HDF5SliceWriter(object):
+    """
+    Class to stream the thick slices, labels and weights of one subject after another into resizable hdf5-datasets,
+    so that only the subject currently processed has to be held in memory.
+    """
+    def __init__(self, filename, mode="w", compression_options=None, chunk_slices=1, weight_dtype='float64',
+                 weight_max=10.0, attrs=None, buffer_slices=None, num_classes=None, subject_offset=0, weight_min=1e-4):
+        """
+        :param str filename: path and name of hdf5-file to write
+        :param str mode: file mode passed to h5py.File (default "w" = overwrite, "a" = append to an existing file)
+        :param None/dict compression_options: filter options of the slice datasets as returned by
+                                              get_compression_options (default gzip)
+        :param int chunk_slices: number of slices per chunk, chunks are (chunk_slices, H, W[, C]) (default 1, matches
+                                 the per-slice reads in training)
+        :param str weight_dtype: storage dtype of the weights (one of WEIGHT_DTYPES, default float64)
+        :param float weight_max: largest weight (max_weight + max_edge_weight of create_weight_mask), upper end of the
+                                 log quantization of uint8 weights
+        :param None/dict attrs: attributes of the file (e.g. plane and slice_thickness). When appending to an existing
+                                file, they (and the weight dtype) have to match the stored attributes.
+        :param None/int buffer_slices: maximal number of slices converted (transposed and encoded) and written at once,
+                                       bounds the memory of the writer (default None = whole subject at once)
+        :param None/int num_classes: number of classes of the label space, stored as attribute of the slice index
+        :param int subject_offset: number of subjects written to other files before (subject_id of the slice index
+                                   counts the subjects of all shards)
+        :param float weight_min: smallest positive weight kept by the log quantization of uint8 weights (median
+                                 frequency weights of the background are ~1e-3)
+        """
+        self.filename = filename
+        self.compression_options = compression_options if compression_options is not None \
+            else get_compression_options()
+        self.chunk_slices = chunk_slices
+        self.weight_dtype = weight_dtype
+        self.buffer_slices = buffer_slices
+        self.num_classes = num_classes
+        self.subject_offset = subject_offset
+        self.weight_attrs = get_weight_quantization(weight_min, weight_max) if weight_dtype == 'uint8' else {}
+        self.hf = h5py.File(filename, mode)
+
+        try:
+            file_attrs = dict(attrs or {}, weight_dtype=weight_dtype)
+
+            buckets = list(self.hf.attrs.get('buckets', []))
+            if 'orig_dataset' in self.hf or buckets:
+                self._check_attrs(file_attrs)
+                # Keep the quantization of the existing weights
+                self.weight_attrs = dict(self.hf[buckets[0] + '/weight_dataset' if buckets else 'weight_dataset'].attrs)
+            else:
+                self.hf.attrs.update(file_attrs)
+
+        except Exception:
+            self.hf.close()
+            raise
+
+        self.num_slices = self._count_slices()
+        self.num_subjects = len(self.get_subjects())
+        # Files written without slice index or class counts (before they were added) are appended to without them
+        self.with_records = {name: self.num_slices == 0 or name in self.hf for name in ['slice_index', 'class_counts']}
+
+    def _check_attrs(self, attrs):
+        """
+        Function to check that the attributes of an existing file match
+        :param dict attrs: expected attributes
+        :return:
+        """
+        for name, value in attrs.items():
+            stored = self.hf.attrs.get(name)
+
+            if stored is None or stored != value:
+                raise ValueError("Can not append to {}: {} is {} in the file, but {} now".format(
+                    self.filename, name, stored, value))
+
+    def _count_slices(self):
+        """
+        Function to count the slices already in the file (of all buckets for cropped slices)
+        :return:
+        """
+        groups = [self.hf] + [self.hf[bucket] for bucket in self.hf.attrs.get('buckets', [])]
+        return sum(group['orig_dataset'].shape[0] for group in groups if 'orig_dataset' in group)
+
+    def get_subjects(self):
+        """
+        Function to get the names of the subjects already in the file
+        :return: list of subject names
+        """
+        if 'subject' not in self.hf:
+            return []
+
+        return [s.decode() if isinstance(s, bytes) else s for s in self.hf['subject'][()]]
+
+    def _append(self, name, data, dtype, attrs=None, convert=None):
+        """
+        Function to append data along the first axis of a dataset (created with an unlimited first axis on first use)
+        :param str name: name of the dataset
+        :param np.ndarray data: data to append (N, ...)
+        :param dtype: dtype of the dataset
+        :param None/dict attrs: attributes set when the dataset is created
+        :param convert: function converting a block of data before it is written (default None = write as is)
+        :return:
+        """
+        if name not in self.hf:
+            if name in ['subject', 'slice_index', 'class_counts']:
+                # Names and records (small per subject/slice) are kept gzip compressed with automatic chunking
+                options = {'chunks': True, 'compression': 'gzip'}
+            else:
+                options = dict(self.compression_options, chunks=(self.chunk_slices,) + data.shape[1:])
+
+            dset = self.hf.create_dataset(name, shape=(0,) + data.shape[1:], maxshape=(None,) + data.shape[1:],
+                                          dtype=dtype, **options)
+            dset.attrs.update(attrs or {})
+
+        dset = self.hf[name]
+        start = dset.shape[0]
+        dset.resize(start + data.shape[0], axis=0)
+
+        # Write block by block, so at most buffer_slices slices are held converted
+        block = self.buffer_slices or max(data.shape[0], 1)
+        for idx in range(0, data.shape[0], block):
+            data_block = data[idx:idx + block]
+            dset[start + idx:start + idx + data_block.shape[0]] = data_block if convert is None else convert(data_block)
+
+    def append(self, orig, aseg, weights, subject, slice_index=None, class_counts=None, frame_shape=None):
+        """
+        Function to append the processed slices of one subject. Slices cropped to a bounding box (frame_shape given)
+        are appended to the datasets of the group of their size (bucket_<H>x<W>), the slice index records where.
+        :param np.ndarray orig: thick slices as returned by filter_blank_slices_thick (H, W, N, C)
+        :param np.ndarray aseg: label slices (H, W, N)
+        :param np.ndarray weights: weight slices (H, W, N)
+        :param str subject: name of the subject
+        :param None/np.ndarray slice_index: records of the slices (N,) as returned by get_slice_index (subject_id is
+                                            set here), appended to the slice_index dataset
+        :param None/np.ndarray class_counts: voxel counts of every class in the slices (N, num_classes) as returned by
+                                             get_slice_class_counts, appended to the class_counts dataset
+        :param None/tuple frame_shape: shape (H, W) of the full frames the slices are cropped from (None = not
+                                       cropped), the slice index with crop offsets is required then
+        :return:
+        """
+        # Transpose to N, H, W, C (views, the weights are encoded block by block while writing)
+        orig = np.transpose(orig, (2, 0, 1, 3))
+        aseg = np.transpose(aseg, (2, 0, 1))
+        weights = np.transpose(weights, (2, 0, 1))
+
+        bucket = None
+        if frame_shape is not None:
+            bucket = "bucket_{}x{}".format(*orig.shape[1:3])
+
+            if 'orig_dataset' in self.hf:
+                raise ValueError("Can not append cropped slices to {} with full frames".format(self.filename))
+
+            if 'frame_shape' in self.hf.attrs and tuple(self.hf.attrs['frame_shape']) != tuple(frame_shape):
+                raise ValueError("Can not append slices cropped from frames of shape {} to {} with frames of shape "
+                                 "{}".format(tuple(frame_shape), self.filename, tuple(self.hf.attrs['frame_shape'])))
+
+            if slice_index is None or 'crop_top' not in slice_index.dtype.names:
+                raise ValueError("Cropped slices need a slice index with crop offsets")
+
+        elif 'frame_shape' in self.hf.attrs:
+            raise ValueError("Can not append full frames to {} with cropped slices".format(self.filename))
+
+        prefix = '' if bucket is None else bucket + '/'
+
+        # Check all shapes before writing anything, so a mismatching subject does not leave partial data behind
+        for name, data in [('orig_dataset', orig), ('aseg_dataset', aseg), ('weight_dataset', weights)]:
+            if prefix + name in self.hf and self.hf[prefix + name].shape[1:] != data.shape[1:]:
+                raise ValueError("Can not append {} of shape {} to {} of shape {}".format(
+                    name, data.shape[1:], self.filename, self.hf[prefix + name].shape[1:]))
+
+        for name, records in [('slice_index', slice_index), ('class_counts', class_counts)]:
+            if records is not None and len(records) != orig.shape[0]:
+                raise ValueError("{} of {} records for {} slices".format(name, len(records), orig.shape[0]))
+
+            if records is None and name in self.hf:
+                raise ValueError("Can not append to {} without {}, the file has one".format(self.filename, name))
+
+        if bucket is not None:
+            buckets = list(self.hf.attrs.get('buckets', []))
+            if bucket not in buckets:
+                buckets.append(bucket)
+                self.hf.attrs['buckets'] = buckets
+                self.hf.attrs['frame_shape'] = tuple(frame_shape)
+
+            bucket_start = self.hf[prefix + 'orig_dataset'].shape[0] if prefix + 'orig_dataset' in self.hf else 0
+            slice_index = slice_index.copy()
+            slice_index['bucket'] = buckets.index(bucket)
+            slice_index['bucket_slice'] = bucket_start + np.arange(orig.shape[0])
+            # The weight outside of the crop is stored as it is read back from the weight dataset
+            slice_index['weight_fill'] = decode_weights(
+                encode_weights(slice_index['weight_fill'], self.weight_dtype, **self.weight_attrs),
+                **dict({'scale': None}, **self.weight_attrs))
+
+        self._append(prefix + 'orig_dataset', orig, np.uint8)
+        self._append(prefix + 'aseg_dataset', aseg, np.uint8)
+        self._append(prefix + 'weight_dataset', weights, self.weight_dtype, self.weight_attrs,
+                     lambda block: encode_weights(block, self.weight_dtype, **self.weight_attrs))
+
+        dt = h5py.special_dtype(vlen=str)
+        self._append('subject', np.asarray([subject.encode("ascii", "ignore")], dtype=object), dt)
+
+        records_attrs = {} if self.num_classes is None else {'num_classes': self.num_classes}
+        if slice_index is not None and self.with_records['slice_index']:
+            slice_index = slice_index.copy()
+            slice_index['subject_id'] = self.subject_offset + self.num_subjects
+            self._append('slice_index', slice_index, slice_index.dtype, records_attrs)
+
+        if class_counts is not None and self.with_records['class_counts']:
+            self._append('class_counts', class_counts, np.uint32, records_attrs)
+
+        self.num_slices += orig.shape[0]
+        self.num_subjects += 1
+
+    def close(self):
+        self.hf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+##
+# Sharded output with a virtual-dataset master file
+##
+class HDF5ShardedWriter(object):
+    """
+    Class to stream the slices into shard files of bounded slice count (written with HDF5SliceWriter) and a master
+    file exposing the datasets of all shards as virtual datasets, so the master file is read like a single file.
+    Subjects are not split across shards: a shard is closed before the subject that would exceed shard_size, and a
+    subject with more than shard_size slices gets a shard of its own.
+    The master file references the shards by file name relative to its own directory, so the master file and the shard
+    files have to be moved together. It is written on close.
+    """
+    def __init__(self, filename, shard_size, compression_options=None, chunk_slices=1, weight_dtype='float64',
+                 weight_max=10.0, attrs=None, buffer_slices=None, num_classes=None, weight_min=1e-4):
+        """
+        :param str filename: path and name of the master hdf5-file, shards are written next to it as
+                             <name>_shard000.hdf5, <name>_shard001.hdf5, ...
+        :param int shard_size: maximal number of slices per shard
+        :param None/dict compression_options: see HDF5SliceWriter
+        :param int chunk_slices: see HDF5SliceWriter
+        :param str weight_dtype: see HDF5SliceWriter
+        :param float weight_max: see HDF5SliceWriter
+        :param None/dict attrs: attributes of the master file and of every shard
+        :param None/int buffer_slices: see HDF5SliceWriter
+        :param None/int num_classes: see HDF5SliceWriter
+        :param float weight_min: see HDF5SliceWriter
+        """
+        if shard_size < 1:
+            raise ValueError("shard_size has to be at least 1, got {}".format(shard_size))
+
+        self.filename = filename
+        self.shard_size = shard_size
+        self.attrs = dict(attrs or {}, weight_dtype=weight_dtype)
+        self.writer_options = {'compression_options': compression_options, 'chunk_slices': chunk_slices,
+                               'weight_dtype': weight_dtype, 'weight_max': weight_max, 'weight_min': weight_min,
+                               'attrs': attrs, 'buffer_slices': buffer_slices, 'num_classes': num_classes}
+        self.writer = None
+        self.shards = []
+        self.shapes = None
+        self.subjects = []
+        self.num_slices = 0
+        self.num_subjects = 0
+
+    def get_shard_name(self, idx):
+        root, ext = os.path.splitext(self.filename)
+        return "{}_shard{:03d}{}".format(root, idx, ext or ".hdf5")
+
+    def get_subjects(self):
+        """
+        Function to get the names of the subjects already written
+        :return: list of subject names
+        """
+        return list(self.subjects)
+
+    def append(self, orig, aseg, weights, subject, slice_index=None, class_counts=None, frame_shape=None):
+        """
+        Function to append the processed slices of one subject (see HDF5SliceWriter.append)
+        :param np.ndarray orig: thick slices (H, W, N, C)
+        :param np.ndarray aseg: label slices (H, W, N)
+        :param np.ndarray weights: weight slices (H, W, N)
+        :param str subject: name of the subject
+        :param None/np.ndarray slice_index: records of the slices (N,) as returned by get_slice_index
+        :param None/np.ndarray class_counts: voxel counts of the slices (N, num_classes)
+        :param None/tuple frame_shape: has to be None, slices cropped to their bounding box can not be sharded
+        :return:
+        """
+        if frame_shape is not None:
+            raise ValueError("Can not append cropped slices to the sharded file {}".format(self.filename))
+
+        # All shards have to share the slice shapes to be concatenated in the master file
+        shapes = [orig.shape[:2] + orig.shape[3:], aseg.shape[:2], weights.shape[:2]]
+        if self.shapes is not None and shapes != self.shapes:
+            raise ValueError("Can not append slices of shapes {} to {} with slices of shapes {}".format(
+                shapes, self.filename, self.shapes))
+
+        num_slices = orig.shape[2]
+        if self.writer is not None and self.writer.num_slices > 0 and \
+                self.writer.num_slices + num_slices > self.shard_size:
+            self._close_shard()
+
+        if self.writer is None:
+            self.writer = HDF5SliceWriter(self.get_shard_name(len(self.shards)), "w",
+                                          subject_offset=self.num_subjects, **self.writer_options)
+
+        self.writer.append(orig, aseg, weights, subject, slice_index, class_counts)
+
+        self.shapes = shapes
+        self.subjects.append(subject)
+        self.num_slices += num_slices
+        self.num_subjects += 1
+
+    def _close_shard(self):
+        """
+        Function to close the current shard (an empty shard, e.g. after a failed first append, is removed)
+        :return:
+        """
+        filename, num_slices = self.writer.filename, self.writer.num_slices
+        self.writer.close()
+        self.writer = None
+
+        if num_slices > 0:
+            self.shards.append((filename, num_slices))
+        else:
+            os.remove(filename)
+
+    def write_master(self):
+        """
+        Function to write the master file with the virtual datasets orig_dataset, aseg_dataset, weight_dataset,
+        subject, slice_index and class_counts (concatenation of the datasets of all shards)
+        :return:
+        """
+        with h5py.File(self.filename, "w") as hf:
+            hf.attrs.update(self.attrs)
+            hf.attrs['shards'] = [os.path.basename(filename) for filename, _ in self.shards]
+
+            if not self.shards:
+                return
+
+            with h5py.File(self.shards[0][0], "r") as shard:
+                datasets = [(name, shard[name].shape[1:], shard[name].dtype, dict(shard[name].attrs))
+                            for name in ['orig_dataset', 'aseg_dataset', 'weight_dataset', 'subject', 'slice_index',
+                                         'class_counts'] if name in shard]
+
+            for name, shape, dtype, attrs in datasets:
+                num_slices = self.num_subjects if name == 'subject' else self.num_slices
+                layout = h5py.VirtualLayout(shape=(num_slices,) + shape, dtype=dtype)
+
+                start = 0
+                for filename, _ in self.shards:
+                    with h5py.File(filename, "r") as shard:
+                        length = shard[name].shape[0]
+
+                    # Relative to the directory of the master file
+                    layout[start:start + length] = h5py.VirtualSource(os.path.basename(filename), name,
+                                                                      shape=(length,) + shape)
+                    start += length
+
+                dset = hf.create_virtual_dataset(name, layout)
+                dset.attrs.update(attrs)
+
+    def close(self):
+        if self.writer is not None:
+            self._close_shard()
+
+        self.write_master()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
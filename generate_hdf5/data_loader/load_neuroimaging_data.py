@@ -15,19 +15,71 @@
 
 
 # IMPORTS
+import os
 import nibabel as nib
 import numpy as np
 import h5py
 
+from numpy.lib.stride_tricks import sliding_window_view
 from skimage.measure import label
 from torch.utils.data.dataset import Dataset
 from .conform import is_conform, conform
+from .hdf5_io import decode_weights, get_weight_scale, get_slice_index_dtype
 
 ##
 # Helper Functions
 ##
 
 
+def read_compressed_voxels(proxy, block_size=2 ** 22):
+    """
+    Function to decompress the voxels of a compressed image (e.g. .mgz) block by block straight into the array,
+    nibabel (gzip) holds an extra copy of the whole decompressed data while reading
+    :param nibabel.arrayproxy.ArrayProxy proxy: dataobj of the image
+    :param int block_size: number of bytes decompressed at once
+    :return: unscaled voxels in the dtype stored in the file
+    """
+    data = np.empty(proxy.shape, dtype=proxy.dtype, order=proxy.order)
+    buffer = memoryview(data.reshape(-1, order='A')).cast('B')
+
+    with nib.openers.ImageOpener(proxy.file_like, 'rb') as opener:
+        opener.seek(proxy.offset)
+        position = 0
+        while position < len(buffer):
+            num_read = opener.fobj.readinto(buffer[position:position + block_size])
+            if not num_read:
+                raise OSError("Expected {} bytes, got {} bytes from {}".format(len(buffer), position, proxy.file_like))
+            position += num_read
+
+    return data
+
+
+def load_volume(img_filename, dtype):
+    """
+    Function to load the voxels of an image directly in the needed dtype: the data is read through the dataobj
+    (native dtype, scaled only if the header has a scaling) and cast once, so neither a float64 copy nor nibabel's
+    get_fdata cache are created. Uncompressed images (.mgh, .nii) are memory mapped and not copied if they are stored
+    in dtype already, compressed ones are decompressed block by block.
+    :param str img_filename: path and name of volume to read
+    :param dtype: dtype of the returned voxels (e.g. np.uint8 for images, np.int32 for segmentations)
+    :return: np.ndarray
+    """
+    img = nib.load(img_filename, mmap=True)
+    proxy = img.dataobj
+
+    if nib.is_proxy(proxy) and isinstance(proxy.file_like, str) and \
+            proxy.file_like.endswith(('.gz', '.mgz')) and proxy.slope == 1 and proxy.inter == 0:
+        data = read_compressed_voxels(proxy)
+    else:
+        data = np.asanyarray(proxy)
+
+    # MGH stores big-endian voxels, swap them in place instead of casting to a native copy
+    if data.dtype.newbyteorder('=') == np.dtype(dtype) and not data.dtype.isnative and data.flags.writeable:
+        data = data.byteswap(inplace=True).view(data.dtype.newbyteorder('='))
+
+    return np.asarray(data, dtype=dtype)
+
+
 # Conform an MRI brain image to UCHAR, RAS orientation, and 1mm isotropic voxels
 def load_and_conform_image(img_filename, interpol=1):
     """
@@ -46,7 +98,7 @@ def load_and_conform_image(img_filename, interpol=1):
     # Collect header and affine information
     header_info = orig.header
     affine_info = orig.affine
-    orig = np.asarray(orig.get_data(), dtype=np.uint8)
+    orig = np.asarray(np.asanyarray(orig.dataobj), dtype=np.uint8)
 
     return header_info, affine_info, orig
 
@@ -86,28 +138,27 @@ def get_thick_slices(img_data, slice_thickness=3):
     Function to extract thick slices from the image 
     (feed slice_thickness preceeding and suceeding slices to network, 
     label only middle one)
+    The thick slices are a read-only sliding window view on the edge-padded volume, nothing is copied until
+    the slices are indexed (e.g. by filter_blank_slices_thick).
     :param np.ndarray img_data: 3D MRI image read in with nibabel 
     :param int slice_thickness: number of slices to stack on top and below slice of interest (default=3) 
-    :return: 
+    :return: thick slices (H, W, D, 2 * slice_thickness + 1)
     """
-    h, w, d = img_data.shape
-    img_data_pad = np.expand_dims(np.pad(img_data, ((0, 0), (0, 0), (slice_thickness, slice_thickness)), mode='edge'),
-                                  axis=3)
-    img_data_thick = np.ndarray((h, w, d, 0), dtype=np.uint8)
-    
-    for slice_idx in range(2 * slice_thickness + 1):
-        img_data_thick = np.append(img_data_thick, img_data_pad[:, :, slice_idx:d + slice_idx, :], axis=3)
+    # Same dtype as the stack appended to an uint8 array before
+    img_data = np.asarray(img_data, dtype=np.result_type(np.uint8, img_data.dtype))
+    img_data_pad = np.pad(img_data, ((0, 0), (0, 0), (slice_thickness, slice_thickness)), mode='edge')
 
-    return img_data_thick
+    return sliding_window_view(img_data_pad, 2 * slice_thickness + 1, axis=2)
 
 
-def filter_blank_slices_thick(img_vol, label_vol, weight_vol, threshold=50):
+def filter_blank_slices_thick(img_vol, label_vol, weight_vol, threshold=50, return_index=False):
     """
     Function to filter blank slices from the volume using the label volume
     :param np.ndarray img_vol: orig image volume
     :param np.ndarray label_vol: label images (ground truth)
     :param np.ndarray weight_vol: weight corresponding to labels
     :param int threshold: threshold for number of pixels needed to keep slice (below = dropped)
+    :param bool return_index: also return the indices of the kept slices in the volume
     :return:
     """
     # Get indices of all slices with more than threshold labels/pixels
@@ -118,33 +169,135 @@ def filter_blank_slices_thick(img_vol, label_vol, weight_vol, threshold=50):
     label_vol = label_vol[:, :, select_slices]
     weight_vol = weight_vol[:, :, select_slices]
 
+    if return_index:
+        return img_vol, label_vol, weight_vol, np.flatnonzero(select_slices)
+
     return img_vol, label_vol, weight_vol
 
 
+def get_slice_class_counts(label_vol, num_classes):
+    """
+    Function to count the voxels of every class in every slice
+    :param np.ndarray label_vol: label slices (H, W, N)
+    :param int num_classes: number of classes of the label space
+    :return: voxel counts (N, num_classes)
+    """
+    class_counts = np.zeros((label_vol.shape[2], num_classes), dtype=np.uint32)
+
+    for idx in range(label_vol.shape[2]):
+        counts = np.bincount(label_vol[:, :, idx].ravel(), minlength=num_classes)
+
+        if len(counts) > num_classes:
+            raise ValueError("Label {} in slice {} exceeds the {} classes".format(len(counts) - 1, idx, num_classes))
+
+        class_counts[idx] = counts
+
+    return class_counts
+
+
+def get_slice_index(label_vol, slice_idx, num_classes, class_counts=None, crop=None):
+    """
+    Function to get the records of the per-slice index (see get_slice_index_dtype) of the label slices of one subject
+    :param np.ndarray label_vol: label slices (H, W, N), full frames
+    :param np.ndarray slice_idx: indices of the slices in the volume (N,), as returned by filter_blank_slices_thick
+    :param int num_classes: number of classes of the label space
+    :param None/np.ndarray class_counts: voxel counts of the slices as returned by get_slice_class_counts (computed
+                                         if None)
+    :param None/tuple crop: crop_top, crop_left and weight_fill of slices cropped with get_crop_window (None = not
+                            cropped)
+    :return: structured array (N,), subject_id (and bucket and bucket_slice) are left 0 (set when writing)
+    """
+    if class_counts is None:
+        class_counts = get_slice_class_counts(label_vol, num_classes)
+
+    slice_index = np.zeros(label_vol.shape[2], dtype=get_slice_index_dtype(num_classes, cropped=crop is not None))
+    slice_index['slice_idx'] = slice_idx
+    slice_index['foreground'] = class_counts[:, 1:].sum(axis=1)
+    slice_index['class_mask'] = np.packbits(class_counts > 0, axis=1)
+
+    if crop is not None:
+        slice_index['crop_top'], slice_index['crop_left'], slice_index['weight_fill'] = crop
+
+    return slice_index
+
+
 # weight map generator
-def create_weight_mask(mapped_aseg, max_weight=5, max_edge_weight=5):
+def get_label_counts(mapped_aseg, block_size=16):
+    """
+    Function to count the voxels of each label (np.bincount over blocks of the first axis, so the intp copy bincount
+    makes of small integer inputs stays small)
+    :param np.ndarray mapped_aseg: label volume (non-negative integers)
+    :param int block_size: number of slices along the first axis counted at once
+    :return: counts of the labels 0 to max label
+    """
+    num_labels = int(mapped_aseg.max()) + 1 if mapped_aseg.size > 0 else 0
+    counts = np.zeros(num_labels, dtype=np.intp)
+
+    for idx in range(0, mapped_aseg.shape[0], block_size):
+        counts += np.bincount(mapped_aseg[idx:idx + block_size].ravel(), minlength=num_labels)
+
+    return counts
+
+
+def get_label_edges(mapped_aseg):
+    """
+    Function to find the voxels on label edges, i.e. where np.gradient of the label volume is non-zero along any axis:
+    inside the volume the neighbours before and after differ, at the borders the voxel and its only neighbour differ.
+    Compares the integer labels directly, no float gradients are computed.
+    :param np.ndarray mapped_aseg: label volume
+    :return: boolean edge mask
+    """
+    edges = np.zeros(mapped_aseg.shape, dtype=bool)
+    differs = np.empty(mapped_aseg.shape, dtype=bool)
+
+    for axis, length in enumerate(mapped_aseg.shape):
+        if length < 2:
+            raise ValueError("Shape of array too small to calculate a numerical gradient, "
+                             "at least (edge_order + 1) elements are required.")
+
+        def select(start, stop):
+            return tuple(slice(start, stop) if ax == axis else slice(None) for ax in range(mapped_aseg.ndim))
+
+        # (target, next, previous) for the interior and the two borders
+        for target, after, before in [(select(1, -1), select(2, None), select(None, -2)),
+                                      (select(0, 1), select(1, 2), select(0, 1)),
+                                      (select(-1, None), select(-1, None), select(-2, -1))]:
+            np.not_equal(mapped_aseg[after], mapped_aseg[before], out=differs[target])
+            np.logical_or(edges[target], differs[target], out=edges[target])
+
+    return edges
+
+
+def create_weight_mask(mapped_aseg, max_weight=5, max_edge_weight=5, dtype=np.float32):
     """
     Function to create weighted mask - with median frequency balancing and edge-weighting
-    :param mapped_aseg:
-    :param max_weight:
-    :param max_edge_weight:
+    As before, the class weights are looked up by label value in the array of the labels present, so all labels
+    0 to max label have to be present.
+    :param np.ndarray mapped_aseg: label volume (non-negative integers)
+    :param max_weight: maximal class weight
+    :param max_edge_weight: weight added on label edges
+    :param dtype: dtype of the weight mask (default float32, float64 as the original implementation)
     :return:
     """
-    unique, counts = np.unique(mapped_aseg, return_counts=True)
+    counts = get_label_counts(mapped_aseg)
+    counts = counts[counts > 0]
 
     # Median Frequency Balancing
     class_wise_weights = np.median(counts) / counts
     class_wise_weights[class_wise_weights > max_weight] = max_weight
-    (h, w, d) = mapped_aseg.shape
 
-    weights_mask = np.reshape(class_wise_weights[mapped_aseg.ravel()], (h, w, d))
+    if mapped_aseg.size > 0 and mapped_aseg.max() >= len(class_wise_weights):
+        raise IndexError("index {} is out of bounds for the {} labels present".format(mapped_aseg.max(),
+                                                                                     len(class_wise_weights)))
 
-    # Gradient Weighting
-    (gx, gy, gz) = np.gradient(mapped_aseg)
-    grad_weight = max_edge_weight * np.asarray(np.power(np.power(gx, 2) + np.power(gy, 2) + np.power(gz, 2), 0.5) > 0,
-                                               dtype='float')
+    # Look up the class weights block by block (np.take makes an intp copy of the indices)
+    class_wise_weights = class_wise_weights.astype(dtype)
+    weights_mask = np.empty(mapped_aseg.shape, dtype=dtype)
+    for idx in range(0, mapped_aseg.shape[0], 16):
+        np.take(class_wise_weights, mapped_aseg[idx:idx + 16], out=weights_mask[idx:idx + 16], mode='clip')
 
-    weights_mask += grad_weight
+    # Edge Weighting
+    np.add(weights_mask, max_edge_weight, out=weights_mask, where=get_label_edges(mapped_aseg))
 
     return weights_mask
 
@@ -174,25 +327,48 @@ def map_label2aparc_aseg(mapped_aseg):
     return aseg
 
 
-def map_aparc_aseg2label(aseg, aseg_nocc=None):
+# Labels of the coronal/axial and the sagittal label space (index in array = class in label space)
+LABELS = np.array([0, 2, 4, 5, 7, 8, 10, 11, 12, 13, 14,
+                   15, 16, 17, 18, 24, 26, 28, 31, 41, 43, 44,
+                   46, 47, 49, 50, 51, 52, 53, 54, 58, 60, 63,
+                   77, 1002, 1003, 1005, 1006, 1007, 1008, 1009, 1010, 1011,
+                   1012, 1013, 1014, 1015, 1016, 1017, 1018, 1019, 1020, 1021, 1022,
+                   1023, 1024, 1025, 1026, 1027, 1028, 1029, 1030, 1031, 1034, 1035,
+                   2002, 2005, 2010, 2012, 2013, 2014, 2016, 2017, 2021, 2022, 2023,
+                   2024, 2025, 2028])
+
+LABELS_SAG = np.array([0, 14, 15, 16, 24, 41, 43, 44, 46, 47, 49,
+                       50, 51, 52, 53, 54, 58, 60, 63, 77, 1002,
+                       1003, 1005, 1006, 1007, 1008, 1009, 1010, 1011, 1012, 1013, 1014,
+                       1015, 1016, 1017, 1018, 1019, 1020, 1021, 1022, 1023, 1024, 1025,
+                       1026, 1027, 1028, 1029, 1030, 1031, 1034, 1035])
+
+# Right hemisphere cortical labels which keep their own class in the coronal/axial label space
+PRESERVED_CORTICAL_LABELS = [2014, 2028, 2012, 2016, 2002, 2023, 2017, 2024, 2010, 2013, 2025, 2022, 2021, 2005]
+
+# Largest aparc+aseg label kept by the mapping (larger labels are set to background)
+MAX_ASEG_LABEL = 11000
+
+
+def build_aparc_aseg_luts(corpus_callosum=False):
     """
-    Function to perform look-up table mapping of aparc.DKTatlas+aseg.mgz data to label space
-    :param np.ndarray aseg: ground truth aparc+aseg
-    :param None/np.ndarray aseg_nocc: ground truth aseg without corpus callosum segmentation
-    :return:
+    Function to build composite look-up tables from raw aparc.DKTatlas+aseg values to the coronal/axial and the
+    sagittal label space. Index MAX_ASEG_LABEL + 1 collects all values above MAX_ASEG_LABEL (mapped like background).
+    Values without a class in the label space are marked with -1.
+    :param bool corpus_callosum: build the tables for the values replacing the corpus callosum (taken from aseg_nocc),
+                                 which skip the vessel/hypointensity remapping and the preservation of cortical labels
+    :return: lut for coronal/axial label space, lut for sagittal label space
     """
-    aseg[aseg > 11000] = 0
-    aseg_temp = aseg.copy()
-    aseg[aseg == 80] = 77  # Hypointensities Class
-    aseg[aseg == 85] = 0  # Optic Chiasma to BKG
-    aseg[aseg == 62] = 41  # Right Vessel to Right GM
-    aseg[aseg == 30] = 2  # Left Vessel to Left GM
-    aseg[aseg == 72] = 24  # 5th Ventricle to CSF
+    raw = np.arange(MAX_ASEG_LABEL + 2)
+    raw[-1] = 0
+    aseg = raw.copy()
 
-    # If corpus callosum is not removed yet, do it now
-    if aseg_nocc is not None:
-        cc_mask = (aseg >= 251) & (aseg <= 255)
-        aseg[cc_mask] = aseg_nocc[cc_mask]
+    if not corpus_callosum:
+        aseg[aseg == 80] = 77  # Hypointensities Class
+        aseg[aseg == 85] = 0  # Optic Chiasma to BKG
+        aseg[aseg == 62] = 41  # Right Vessel to Right GM
+        aseg[aseg == 30] = 2  # Left Vessel to Left GM
+        aseg[aseg == 72] = 24  # 5th Ventricle to CSF
 
     aseg[aseg == 3] = 0  # Map Remaining Cortical labels to background
     aseg[aseg == 42] = 0
@@ -201,77 +377,76 @@ def map_aparc_aseg2label(aseg, aseg_nocc=None):
     aseg[cortical_label_mask] = aseg[cortical_label_mask] - 1000
 
     # Preserve Cortical Labels
-    aseg[aseg_temp == 2014] = 2014
-    aseg[aseg_temp == 2028] = 2028
-    aseg[aseg_temp == 2012] = 2012
-    aseg[aseg_temp == 2016] = 2016
-    aseg[aseg_temp == 2002] = 2002
-    aseg[aseg_temp == 2023] = 2023
-    aseg[aseg_temp == 2017] = 2017
-    aseg[aseg_temp == 2024] = 2024
-    aseg[aseg_temp == 2010] = 2010
-    aseg[aseg_temp == 2013] = 2013
-    aseg[aseg_temp == 2025] = 2025
-    aseg[aseg_temp == 2022] = 2022
-    aseg[aseg_temp == 2021] = 2021
-    aseg[aseg_temp == 2005] = 2005
+    if not corpus_callosum:
+        preserve_mask = np.isin(raw, PRESERVED_CORTICAL_LABELS)
+        aseg[preserve_mask] = raw[preserve_mask]
 
-    labels = np.array([0, 2, 4, 5, 7, 8, 10, 11, 12, 13, 14,
-                       15, 16, 17, 18, 24, 26, 28, 31, 41, 43, 44,
-                       46, 47, 49, 50, 51, 52, 53, 54, 58, 60, 63,
-                       77, 1002, 1003, 1005, 1006, 1007, 1008, 1009, 1010, 1011,
-                       1012, 1013, 1014, 1015, 1016, 1017, 1018, 1019, 1020, 1021, 1022,
-                       1023, 1024, 1025, 1026, 1027, 1028, 1029, 1030, 1031, 1034, 1035,
-                       2002, 2005, 2010, 2012, 2013, 2014, 2016, 2017, 2021, 2022, 2023,
-                       2024, 2025, 2028])
+    # Coronal, Axial
+    lut_aseg = np.zeros(max(LABELS) + 1, dtype='int')
+    lut_aseg[LABELS] = np.arange(len(LABELS))
+    lut = np.where(aseg < len(lut_aseg), lut_aseg[np.minimum(aseg, len(lut_aseg) - 1)], -1)
 
-    h, w, d = aseg.shape
-    lut_aseg = np.zeros(max(labels) + 1, dtype='int')
-    for idx, value in enumerate(labels):
-        lut_aseg[value] = idx
+    # Sagittal (left labels are mapped to the corresponding right labels)
+    for left, right in [(2, 41), (3, 42), (4, 43), (5, 44), (7, 46), (8, 47), (10, 49), (11, 50), (12, 51),
+                        (13, 52), (17, 53), (18, 54), (26, 58), (28, 60), (31, 63)]:
+        aseg[aseg == left] = right
 
-    # Remap Label Classes - Perform LUT Mapping - Coronal, Axial
+    cortical_label_mask = (aseg >= 2000) & (aseg <= 2999)
+    aseg[cortical_label_mask] = aseg[cortical_label_mask] - 1000
 
-    mapped_aseg = lut_aseg.ravel()[aseg.ravel()]
+    lut_aseg = np.zeros(max(LABELS_SAG) + 1, dtype='int')
+    lut_aseg[LABELS_SAG] = np.arange(len(LABELS_SAG))
+    lut_sag = np.where(aseg < len(lut_aseg), lut_aseg[np.minimum(aseg, len(lut_aseg) - 1)], -1)
 
-    mapped_aseg = mapped_aseg.reshape((h, w, d))
+    return lut, lut_sag
 
-    # Map Sagittal Labels
-    aseg[aseg == 2] = 41
-    aseg[aseg == 3] = 42
-    aseg[aseg == 4] = 43
-    aseg[aseg == 5] = 44
-    aseg[aseg == 7] = 46
-    aseg[aseg == 8] = 47
-    aseg[aseg == 10] = 49
-    aseg[aseg == 11] = 50
-    aseg[aseg == 12] = 51
-    aseg[aseg == 13] = 52
-    aseg[aseg == 17] = 53
-    aseg[aseg == 18] = 54
-    aseg[aseg == 26] = 58
-    aseg[aseg == 28] = 60
-    aseg[aseg == 31] = 63
 
-    cortical_label_mask = (aseg >= 2000) & (aseg <= 2999)
-    aseg[cortical_label_mask] = aseg[cortical_label_mask] - 1000
+# Built once at import, shared by all calls of map_aparc_aseg2label
+LUT_ASEG, LUT_ASEG_SAG = build_aparc_aseg_luts()
+LUT_ASEG_CC, LUT_ASEG_SAG_CC = build_aparc_aseg_luts(corpus_callosum=True)
 
-    labels_sag = np.array([0, 14, 15, 16, 24, 41, 43, 44, 46, 47, 49,
-                           50, 51, 52, 53, 54, 58, 60, 63, 77, 1002,
-                           1003, 1005, 1006, 1007, 1008, 1009, 1010, 1011, 1012, 1013, 1014,
-                           1015, 1016, 1017, 1018, 1019, 1020, 1021, 1022, 1023, 1024, 1025,
-                           1026, 1027, 1028, 1029, 1030, 1031, 1034, 1035])
 
-    h, w, d = aseg.shape
-    lut_aseg = np.zeros(max(labels_sag) + 1, dtype='int')
-    for idx, value in enumerate(labels_sag):
-        lut_aseg[value] = idx
+def _apply_aparc_aseg_lut(aseg, lut, lut_cc, aseg_nocc=None):
+    """
+    Function to map aparc+aseg values to one label space with a single gather
+    :param np.ndarray aseg: ground truth aparc+aseg
+    :param np.ndarray lut: composite look-up table for aseg
+    :param np.ndarray lut_cc: composite look-up table for the corpus callosum replacement from aseg_nocc
+    :param None/np.ndarray aseg_nocc: ground truth aseg without corpus callosum segmentation
+    :return:
+    """
+    # mode='clip' sends all values above MAX_ASEG_LABEL to the last (background) entry without a temporary
+    mapped_aseg = np.take(lut, aseg, mode='clip')
 
-    # Remap Label Classes - Perform LUT Mapping - Coronal, Axial
+    # If corpus callosum is not removed yet, do it now
+    if aseg_nocc is not None:
+        cc_mask = (aseg >= 251) & (aseg <= 255)
+        mapped_aseg[cc_mask] = np.take(lut_cc, aseg_nocc[cc_mask], mode='clip')
+
+    if mapped_aseg.min() < 0:
+        raise IndexError('aparc+aseg contains labels outside of the label space')
 
-    mapped_aseg_sag = lut_aseg.ravel()[aseg.ravel()]
+    return mapped_aseg
 
-    mapped_aseg_sag = mapped_aseg_sag.reshape((h, w, d))
+
+def map_aparc_aseg2label(aseg, aseg_nocc=None, plane=None):
+    """
+    Function to perform look-up table mapping of aparc.DKTatlas+aseg.mgz data to label space
+    :param np.ndarray aseg: ground truth aparc+aseg
+    :param None/np.ndarray aseg_nocc: ground truth aseg without corpus callosum segmentation
+    :param None/str plane: only compute the label space needed for this plane (sagittal or coronal/axial),
+                           both if None (default)
+    :return: mapped aseg for coronal/axial (None if not computed), mapped aseg for sagittal (None if not computed)
+    """
+    mapped_aseg, mapped_aseg_sag = None, None
+
+    # Remap Label Classes - Perform LUT Mapping - Coronal, Axial
+    if plane != 'sagittal':
+        mapped_aseg = _apply_aparc_aseg_lut(aseg, LUT_ASEG, LUT_ASEG_CC, aseg_nocc)
+
+    # Map Sagittal Labels
+    if plane is None or plane == 'sagittal':
+        mapped_aseg_sag = _apply_aparc_aseg_lut(aseg, LUT_ASEG_SAG, LUT_ASEG_SAG_CC, aseg_nocc)
 
     return mapped_aseg, mapped_aseg_sag
 
@@ -347,6 +522,66 @@ def bbox_3d(img):
     return rmin, rmax, cmin, cmax, zmin, zmax
 
 
+# Sizes the height and width of bounding box crops are enlarged to (so the cropped slices fall into few shapes)
+BBOX_BUCKETS = [128, 160, 192, 224, 256]
+
+
+def get_crop_window(label_vol, margin=8, buckets=BBOX_BUCKETS, image_vol=None):
+    """
+    Function to get the crop window of the slices of one subject: the foreground bounding box (bbox_3d) of the label
+    slices (and of the non-zero voxels of the image slices, if given) plus margin, enlarged to the smallest bucket size
+    (per axis) holding it and centered on the box, inside the frame. A box larger than all buckets (or slices without
+    foreground) keep the full frame size along that axis.
+    All voxels outside of the window are background and no label edge (needs margin >= 1), so the full frames are
+    reconstructed with label 0 and the (constant) background weight outside of the window. With image_vol, the image
+    is 0 outside of the window as well, so it is reconstructed exactly too. Background noise of the image grows the
+    window to about the full frame, pass its head mask (get_head_mask) instead to crop the noise away.
+    :param np.ndarray label_vol: label slices (H, W, N)
+    :param int margin: number of voxels kept around the bounding box (at least 1)
+    :param list buckets: sizes the window is enlarged to
+    :param None/np.ndarray image_vol: image slices or mask (H, W, N) kept in the window as well (e.g. the scalp and
+                                      skull around the labelled brain)
+    :return: top, left, height and width of the window
+    """
+    if margin < 1:
+        raise ValueError("The margin of the bounding box has to be at least 1, got {}".format(margin))
+
+    frame = label_vol.shape[:2]
+    boxes = [bbox_3d(vol) for vol in [label_vol, image_vol] if vol is not None and vol.shape[2] > 0 and np.any(vol)]
+    if not boxes:
+        return 0, 0, frame[0], frame[1]
+
+    rmin, rmax = min(box[0] for box in boxes), max(box[1] for box in boxes)
+    cmin, cmax = min(box[2] for box in boxes), max(box[3] for box in boxes)
+
+    window = []
+    for start, stop, length in [(rmin, rmax, frame[0]), (cmin, cmax, frame[1])]:
+        needed = stop - start + 1 + 2 * margin
+        size = min([bucket for bucket in buckets if bucket >= needed] + [length])
+        first = min(max((start + stop + 1) // 2 - size // 2, 0), length - size)
+        window.append((int(first), int(size)))
+
+    return window[0][0], window[1][0], window[0][1], window[1][1]
+
+
+def get_head_mask(image_vol, threshold):
+    """
+    Function to get the head mask of an image: the largest (26-)connected component of the voxels above threshold,
+    so background noise and isolated artefacts above threshold are not part of it.
+    :param np.ndarray image_vol: image
+    :param float threshold: intensity threshold
+    :return: mask of the head (all False if no voxel is above threshold)
+    """
+    labels = label(image_vol > threshold, connectivity=3, background=0)
+
+    bincount = np.bincount(labels.ravel())
+    if len(bincount) < 2:
+        return np.zeros(image_vol.shape, dtype=bool)
+
+    bincount[0] = 0
+    return labels == np.argmax(bincount)
+
+
 def get_largest_cc(segmentation):
     """
     Function to find largest connected component of segmentation.
@@ -369,13 +604,17 @@ class OrigDataThickSlices(Dataset):
     """
     Class to load a given image and segmentation and prepare it
     for network training.
+    With lazy = True only the edge-padded volume is kept in slice-major order (D + 2 * slice_thickness, H, W) and
+    __getitem__ returns each thick slice as a strided view on 2 * slice_thickness + 1 consecutive (contiguous) slices
+    of it, instead of gathering them from the sliding window view along the last axis.
     """
-    def __init__(self, img_filename, orig, plane='Axial', slice_thickness=3, transforms=None):
+    def __init__(self, img_filename, orig, plane='Axial', slice_thickness=3, transforms=None, lazy=False):
 
         try:
             self.img_filename = img_filename
             self.plane = plane
             self.slice_thickness = slice_thickness
+            self.lazy = lazy
 
             # Transform Data as needed
             if plane == 'Sagittal':
@@ -389,14 +628,22 @@ class OrigDataThickSlices(Dataset):
             else:
                 print('Loading Coronal.')
 
-            # Create Thick Slices
-            orig_thick = get_thick_slices(orig, self.slice_thickness)
+            if self.lazy:
+                # Pad the slice axis only (same dtype as get_thick_slices), thick slices are cut in __getitem__
+                orig = np.asarray(orig, dtype=np.result_type(np.uint8, orig.dtype))
+                self.volume = np.pad(np.moveaxis(orig, 2, 0), ((slice_thickness, slice_thickness), (0, 0), (0, 0)),
+                                     mode='edge')
+                self.count = self.volume.shape[0] - 2 * slice_thickness
+
+            else:
+                # Create Thick Slices
+                orig_thick = get_thick_slices(orig, self.slice_thickness)
 
-            # Make 4D
-            orig_thick = np.transpose(orig_thick, (2, 0, 1, 3))
-            self.images = orig_thick
+                # Make 4D
+                orig_thick = np.transpose(orig_thick, (2, 0, 1, 3))
+                self.images = orig_thick
 
-            self.count = self.images.shape[0]
+                self.count = self.images.shape[0]
 
             self.transforms = transforms
 
@@ -407,7 +654,15 @@ class OrigDataThickSlices(Dataset):
 
     def __getitem__(self, index):
 
-        img = self.images[index]
+        if self.lazy:
+            # Negative and out of range indices as for the eager array (IndexError)
+            index = range(self.count)[index]
+
+            # Slices index - slice_thickness to index + slice_thickness as H, W, 2 * slice_thickness + 1
+            img = np.transpose(self.volume[index:index + 2 * self.slice_thickness + 1], (1, 2, 0))
+
+        else:
+            img = self.images[index]
 
         if self.transforms is not None:
             img = self.transforms(img)
@@ -426,21 +681,56 @@ class OrigDataThickSlices(Dataset):
 class AsegDatasetWithAugmentation(Dataset):
     """
     Class for loading aseg file with augmentations (transforms)
+    With params['lazy'] = True only the subject names are read on construction and __getitem__ reads the requested
+    slice from the file. The file is opened once per (DataLoader worker) process on first access, decoded chunks are
+    kept in the hdf5 chunk cache of params['chunk_cache_size'] bytes (default 64 MiB).
+    Compactly stored weights (float16 or log quantized uint8) are decoded to float32 per slice.
+    Slices stored cropped to their bounding box (generate_hdf5 --crop_bbox) are returned as full frames, reconstructed
+    with the crop offsets of the slice index (identical to the full frames written without cropping).
     """
     def __init__(self, params, transforms=None):
 
         # Load the h5 file and save it to the dataset
         try:
             self.params = params
+            self.lazy = params.get('lazy', False)
+            self.chunk_cache_size = params.get('chunk_cache_size', 64 * 1024 ** 2)
+            self._hf = None
+            self._hf_pid = None
 
             # Open file in reading mode
             with h5py.File(self.params['dataset_name'], "r") as hf:
-                self.images = np.array(hf.get('orig_dataset'))
-                self.labels = np.array(hf.get('aseg_dataset'))
-                self.weights = np.array(hf.get('weight_dataset'))
+                # Groups of the cropped slices of each size (only the root group for full frames)
+                self.buckets = [b.decode() if isinstance(b, bytes) else b for b in hf.attrs.get('buckets', [])]
+
+                if self.buckets:
+                    self.frame_shape = tuple(int(s) for s in hf.attrs['frame_shape'])
+                    self.slice_index = hf['slice_index'][()]
+                    groups = [hf[bucket] for bucket in self.buckets]
+
+                else:
+                    groups = [hf]
+
+                if self.lazy:
+                    self.count = sum(group['orig_dataset'].shape[0] for group in groups)
+
+                elif self.buckets:
+                    # One array per bucket
+                    self.images = [np.array(group.get('orig_dataset')) for group in groups]
+                    self.labels = [np.array(group.get('aseg_dataset')) for group in groups]
+                    self.weights = [np.array(group.get('weight_dataset')) for group in groups]
+                    self.count = len(self.slice_index)
+
+                else:
+                    self.images = np.array(hf.get('orig_dataset'))
+                    self.labels = np.array(hf.get('aseg_dataset'))
+                    self.weights = np.array(hf.get('weight_dataset'))
+                    self.count = self.images.shape[0]
+
+                self.weight_scale, self.weight_offset, self.weight_encoding = \
+                    get_weight_scale(groups[0]['weight_dataset'])
                 self.subjects = np.array(hf.get("subject"))
 
-            self.count = self.images.shape[0]
             self.transforms = transforms
 
             print("Successfully loaded {} with plane: {}".format(params["dataset_name"], params["plane"]))
@@ -451,11 +741,79 @@ class AsegDatasetWithAugmentation(Dataset):
     def get_subject_names(self):
         return self.subjects
 
+    def _get_file(self):
+        """
+        Function to get the hdf5-file for lazy reading. Handles inherited from the parent process (forked
+        DataLoader workers) are not shared, every process opens its own.
+        :return:
+        """
+        if self._hf is None or self._hf_pid != os.getpid():
+            self._hf = h5py.File(self.params['dataset_name'], "r", rdcc_nbytes=self.chunk_cache_size,
+                                 rdcc_nslots=10007)
+            self._hf_pid = os.getpid()
+
+        return self._hf
+
+    def __getstate__(self):
+        # Open hdf5-files can not be pickled (e.g. for spawned DataLoader workers)
+        state = self.__dict__.copy()
+        state['_hf'] = None
+        state['_hf_pid'] = None
+        return state
+
+    def _get_full_frame(self, record, img, label, weight):
+        """
+        Function to reconstruct the full frame of a cropped slice (intensity and label 0, background weight outside,
+        see get_crop_window)
+        :param np.void record: slice index record of the slice
+        :param np.ndarray img: cropped image (h, w, C)
+        :param np.ndarray label: cropped label (h, w)
+        :param np.ndarray weight: cropped (decoded) weight (h, w)
+        :return: img, label and weight of the full frame
+        """
+        window = (slice(record['crop_top'], record['crop_top'] + img.shape[0]),
+                  slice(record['crop_left'], record['crop_left'] + img.shape[1]))
+
+        full_img = np.zeros(self.frame_shape + img.shape[2:], dtype=img.dtype)
+        full_label = np.zeros(self.frame_shape, dtype=label.dtype)
+        full_weight = np.full(self.frame_shape, record['weight_fill'], dtype=weight.dtype)
+        full_img[window], full_label[window], full_weight[window] = img, label, weight
+
+        return full_img, full_label, full_weight
+
     def __getitem__(self, index):
 
-        img = self.images[index]
-        label = self.labels[index]
-        weight = self.weights[index]
+        if self.buckets:
+            # Bucket and position of the slice in the bucket
+            record = self.slice_index[index]
+            bucket, bucket_index = int(record['bucket']), int(record['bucket_slice'])
+
+            if self.lazy:
+                group = self._get_file()[self.buckets[bucket]]
+                img = group['orig_dataset'][bucket_index]
+                label = group['aseg_dataset'][bucket_index]
+                weight = group['weight_dataset'][bucket_index]
+
+            else:
+                img = self.images[bucket][bucket_index]
+                label = self.labels[bucket][bucket_index]
+                weight = self.weights[bucket][bucket_index]
+
+        elif self.lazy:
+            hf = self._get_file()
+            img = hf['orig_dataset'][index]
+            label = hf['aseg_dataset'][index]
+            weight = hf['weight_dataset'][index]
+
+        else:
+            img = self.images[index]
+            label = self.labels[index]
+            weight = self.weights[index]
+
+        weight = decode_weights(weight, self.weight_scale, self.weight_offset, self.weight_encoding)
+
+        if self.buckets:
+            img, label, weight = self._get_full_frame(record, img, label, weight)
 
         if self.transforms is not None:
             tx_sample = self.transforms({'img': img, 'label': label, 'weight': weight})
@@ -467,4 +825,3 @@ class AsegDatasetWithAugmentation(Dataset):
 
     def __len__(self):
         return self.count
-
@@ -0,0 +1,137 @@
+# IMPORTS
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is not reported there
+    resource = None
+
+
+def get_peak_rss(children=False):
+    """
+    Function to get the peak resident set size of this process (or of its terminated child processes)
+    :param bool children: peak of the child processes (e.g. the workers of a finished process pool) instead
+    :return: peak resident set size in bytes (None if not available)
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+##
+# Per-stage timing (for training set generation)
+##
+class StageTimer(object):
+    """
+    Class to accumulate the wall time of named processing stages and counts (e.g. of kept and dropped slices).
+    Stages are reported in the order they were first entered. For stages timed with stage(), the amount by which the
+    stage raised the peak resident set size of the process is recorded as well (0 if the stage stayed below the peak
+    of the stages before), so the stages driving the peak can be found.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.peak_rss_increase = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing one stage (time of repeated stages is summed up)
+        :param str name: name of the stage
+        :return:
+        """
+        peak_start = get_peak_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, peak_start)
+
+    def add(self, name, seconds, peak_start=None):
+        """
+        Function to add the time of one run of a stage
+        :param str name: name of the stage
+        :param float seconds: wall time of the run
+        :param None/int peak_start: peak resident set size of the process before the run (bytes), the increase up to
+                                    now is added to the stage (None = not measured)
+        :return:
+        """
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+        peak = get_peak_rss()
+        if peak is not None and peak_start is not None:
+            self.peak_rss_increase[name] = self.peak_rss_increase.get(name, 0) + peak - peak_start
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def as_dict(self):
+        return {'stages': dict(self.stages), 'counts': dict(self.counts),
+                'peak_rss_increase': dict(self.peak_rss_increase)}
+
+
+class ProfileReport(object):
+    """
+    Class to collect the per-subject stage timings of a run and aggregate them into a machine-readable report
+    """
+    def __init__(self):
+        self.subjects = []
+        self.start = time.perf_counter()
+
+    def add_subject(self, subject, profile, error=None):
+        """
+        Function to add the profile of one subject
+        :param str subject: name of the subject
+        :param None/dict profile: profile as returned by StageTimer.as_dict (None if processing failed)
+        :param None/str error: error message if processing failed
+        :return:
+        """
+        entry = {'subject': subject, 'status': 'failed' if error is not None else 'ok'}
+        entry.update(profile or {'stages': {}, 'counts': {}, 'peak_rss_increase': {}})
+        entry['total'] = sum(entry['stages'].values())
+
+        if error is not None:
+            entry['error'] = error
+
+        self.subjects.append(entry)
+
+    def aggregate(self):
+        """
+        Function to aggregate the stage timings and counts over all subjects
+        :return: dictionary with summed and mean stage times, summed counts, the largest increase of the peak resident
+                 set size by each stage (maximum over all subjects), the peak resident set size of the processes (main
+                 process and terminated workers) and subject numbers
+        """
+        stages = {}
+        counts = {}
+        peak_rss_increase = {}
+        processed = [entry for entry in self.subjects if entry['status'] == 'ok']
+
+        for entry in processed:
+            for name, seconds in entry['stages'].items():
+                stages[name] = stages.get(name, 0.0) + seconds
+            for name, value in entry['counts'].items():
+                counts[name] = counts.get(name, 0) + value
+            for name, increase in entry.get('peak_rss_increase', {}).items():
+                peak_rss_increase[name] = max(peak_rss_increase.get(name, 0), increase)
+
+        total = sum(stages.values())
+        return {'subjects_processed': len(processed),
+                'subjects_failed': len(self.subjects) - len(processed),
+                'wall_time': time.perf_counter() - self.start,
+                'stages': stages,
+                'stages_mean': {name: seconds / len(processed) for name, seconds in stages.items()},
+                'stages_fraction': {name: seconds / total for name, seconds in stages.items()} if total > 0 else {},
+                'counts': counts,
+                'peak_rss_increase': peak_rss_increase,
+                'peak_rss_main': get_peak_rss(),
+                'peak_rss_workers': get_peak_rss(children=True)}
+
+    def as_dict(self):
+        return {'subjects': self.subjects, 'aggregate': self.aggregate()}
@@ -0,0 +1,143 @@
+# IMPORTS
+import os
+import numpy as np
+import h5py
+
+from torch.utils.data import Sampler
+
+
+# Weighting of the slices by their classes
+SAMPLING_MODES = ['balanced', 'inverse_frequency']
+
+
+##
+# Per-slice class counts
+##
+def compute_class_counts(dataset_name, block_size=64):
+    """
+    Function to count the voxels of every class in every slice of the aseg_dataset of a hdf5-file (for files written
+    without class_counts dataset). The labels are read block_size slices at a time.
+    :param str dataset_name: path and name of the hdf5-file
+    :param int block_size: number of slices read at once
+    :return: voxel counts (N, num_classes)
+    """
+    with h5py.File(dataset_name, "r") as hf:
+        labels = hf['aseg_dataset']
+        counts = []
+
+        for start in range(0, labels.shape[0], block_size):
+            counts.extend(np.bincount(label_slice.ravel()) for label_slice in labels[start:start + block_size])
+
+    num_classes = max([len(c) for c in counts] or [0])
+    class_counts = np.zeros((len(counts), num_classes), dtype=np.uint32)
+    for idx, c in enumerate(counts):
+        class_counts[idx, :len(c)] = c
+
+    return class_counts
+
+
+def get_class_counts(dataset_name, cache_dir=None):
+    """
+    Function to get the voxel counts of every class in every slice of a hdf5-file. They are read from the class_counts
+    dataset written by generate_hdf5. For files without it, they are computed on first use and cached in
+    <dataset file name>.class_counts.npz (recomputed when the hdf5-file changes).
+    :param str dataset_name: path and name of the hdf5-file
+    :param None/str cache_dir: directory of the cached counts (default: directory of the hdf5-file)
+    :return: voxel counts (N, num_classes)
+    """
+    with h5py.File(dataset_name, "r") as hf:
+        if 'class_counts' in hf:
+            return hf['class_counts'][()]
+
+    stat = os.stat(dataset_name)
+    cache_file = os.path.join(cache_dir or os.path.dirname(os.path.abspath(dataset_name)),
+                              os.path.basename(dataset_name) + ".class_counts.npz")
+
+    try:
+        with np.load(cache_file) as cached:
+            if cached['mtime'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+                return cached['class_counts']
+
+    except (OSError, KeyError, ValueError):
+        pass
+
+    class_counts = compute_class_counts(dataset_name)
+
+    # Write to a temporary file first, so concurrent readers never see a partial cache
+    try:
+        with open(cache_file + ".tmp", 'wb') as f:
+            np.savez(f, class_counts=class_counts, mtime=stat.st_mtime_ns, size=stat.st_size)
+        os.replace(cache_file + ".tmp", cache_file)
+
+    except OSError as e:
+        print("Could not cache the class counts in {}: {}".format(cache_file, e))
+
+    return class_counts
+
+
+def get_slice_weights(class_counts, mode='balanced', ignore_classes=(0,)):
+    """
+    Function to get the sampling probability of every slice from its class counts
+    balanced: every class is equally likely to be drawn, then a slice containing it uniformly (rare classes are seen
+              as often as frequent ones)
+    inverse_frequency: the slices are weighted with the inverse voxel frequency of their classes (every class
+                       contributes the same number of voxels in expectation)
+    Slices containing only ignored classes are never drawn.
+    :param np.ndarray class_counts: voxel counts of every class in every slice (N, num_classes)
+    :param str mode: weighting of the slices (one of SAMPLING_MODES)
+    :param tuple ignore_classes: classes not balanced (default background)
+    :return: probabilities of the slices (N,)
+    """
+    counts = class_counts.astype(np.float64)
+    counts[:, [c for c in ignore_classes if c < counts.shape[1]]] = 0
+
+    if mode == 'balanced':
+        present = counts > 0
+        slices_per_class = present.sum(axis=0)
+        weights = present @ (1.0 / np.maximum(slices_per_class, 1))
+
+    elif mode == 'inverse_frequency':
+        voxels_per_class = counts.sum(axis=0)
+        weights = counts @ (1.0 / np.maximum(voxels_per_class, 1))
+
+    else:
+        raise ValueError('Unknown sampling mode {}, use one of {}'.format(mode, SAMPLING_MODES))
+
+    if weights.sum() == 0:
+        return np.full(len(weights), 1.0 / max(len(weights), 1))
+
+    return weights / weights.sum()
+
+
+##
+# Sampler (for training)
+##
+class ClassBalancedSliceSampler(Sampler):
+    """
+    Sampler drawing slices of an AsegDatasetWithAugmentation with replacement, weighted by the classes they contain
+    (see get_slice_weights). The weights are computed from the per-slice class counts of the hdf5-file, the label
+    slices are not read.
+    """
+    def __init__(self, dataset, mode='balanced', num_samples=None, ignore_classes=(0,), cache_dir=None, seed=None):
+        """
+        :param AsegDatasetWithAugmentation dataset: dataset to sample from
+        :param str mode: weighting of the slices (one of SAMPLING_MODES)
+        :param None/int num_samples: number of slices drawn per epoch (default: number of slices in the dataset)
+        :param tuple ignore_classes: classes not balanced (default background)
+        :param None/str cache_dir: directory of the cached class counts of files without class_counts dataset
+        :param None/int seed: random seed
+        """
+        class_counts = get_class_counts(dataset.params['dataset_name'], cache_dir)
+
+        if len(class_counts) != len(dataset):
+            raise ValueError("{} class counts for {} slices".format(len(class_counts), len(dataset)))
+
+        self.weights = get_slice_weights(class_counts, mode, ignore_classes)
+        self.num_samples = num_samples if num_samples is not None else len(dataset)
+        self.rng = np.random.RandomState(seed)
+
+    def __iter__(self):
+        return iter(self.rng.choice(len(self.weights), size=self.num_samples, p=self.weights).tolist())
+
+    def __len__(self):
+        return self.num_samples
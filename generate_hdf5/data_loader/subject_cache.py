@@ -0,0 +1,129 @@
+# IMPORTS
+import os
+import shutil
+import hashlib
+import numpy as np
+
+
+# Bump whenever the cached volumes change for the same inputs (e.g. label mapping or weight computation)
+CACHE_VERSION = 2
+
+
+##
+# Content addressed cache of processed subjects
+##
+class SubjectCache(object):
+    """
+    Class to cache processed volumes of a subject on disk. Entries are addressed by a hash of the input files and
+    the processing parameters, so changed inputs never hit stale entries. Each entry is a directory of .npy files,
+    which are memory mapped on a hit. The least recently used entries are evicted once the cache grows beyond
+    max_size bytes.
+    """
+    def __init__(self, cache_dir, max_size=None):
+        """
+        :param str cache_dir: directory of the cache (created if necessary)
+        :param None/int max_size: size limit of the cache in bytes (None = unbounded)
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def hash_file(filename, block_size=2 ** 20):
+        """
+        Function to hash the content of a file
+        :param str filename: path and name of the file
+        :param int block_size: number of bytes read at once
+        :return: hex digest
+        """
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+
+        return sha.hexdigest()
+
+    def key(self, filenames, **params):
+        """
+        Function to get the cache key of processed input files
+        :param list filenames: input files
+        :param params: parameters the processing depends on
+        :return: hex digest
+        """
+        sha = hashlib.sha256('version={}'.format(CACHE_VERSION).encode())
+        for filename in filenames:
+            sha.update(self.hash_file(filename).encode())
+
+        for name in sorted(params):
+            sha.update('{}={}'.format(name, params[name]).encode())
+
+        return sha.hexdigest()
+
+    def get(self, key):
+        """
+        Function to get a cached entry
+        :param str key: cache key
+        :return: dictionary of (memory mapped) arrays, None if the entry is not cached
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+
+        try:
+            arrays = {os.path.splitext(name)[0]: np.load(os.path.join(entry_dir, name), mmap_mode='r')
+                      for name in os.listdir(entry_dir)}
+            # Mark as recently used
+            os.utime(entry_dir)
+
+        except (OSError, ValueError):
+            return None
+
+        return arrays
+
+    def put(self, key, arrays):
+        """
+        Function to store an entry (written to a temporary directory first, so readers never see partial entries)
+        :param str key: cache key
+        :param dict arrays: arrays to store
+        :return:
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = os.path.join(self.cache_dir, '.{}.{}'.format(key, os.getpid()))
+
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), array)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Stored concurrently by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Function to remove the least recently used entries until the cache fits into max_size
+        :return:
+        """
+        if self.max_size is None:
+            return
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+            except OSError:
+                continue
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
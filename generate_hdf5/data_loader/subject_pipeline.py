@@ -0,0 +1,301 @@
+# IMPORTS
+import os
+import numpy as np
+import nibabel as nib
+
+from .load_neuroimaging_data import map_aparc_aseg2label, create_weight_mask, transform_sagittal, \
+                                    transform_axial, get_thick_slices, filter_blank_slices_thick, load_volume, \
+                                    get_slice_index, get_slice_class_counts, get_crop_window, get_head_mask, LABELS, \
+                                    LABELS_SAG
+from .conform import is_conform, conform
+from .subject_cache import SubjectCache
+from .profiling import StageTimer
+
+# Memory estimates (bytes per voxel of the input volume, measured with tracemalloc on conformed volumes):
+# while mapping the labels (orig, int32 aseg, intp copy of the lookup indices and int64 labels per label space)
+MAPPING_BYTES_PER_VOXEL = 13
+MAPPED_BYTES_PER_VOXEL = 8
+# afterwards (orig and the uint8 labels and float32 weights per label space)
+LABEL_SPACE_BYTES_PER_VOXEL = 5
+# Python, numpy and h5py of one process
+PROCESS_BASE_MEMORY = 256 * 1024 ** 2
+
+
+##
+# Per-subject processing (for training set generation)
+##
+def get_label_spaces(planes):
+    """
+    Function to get the label spaces needed for a list of planes (axial and coronal share one)
+    :param list planes: planes to process
+    :return: list of label spaces ('coronal' and/or 'sagittal')
+    """
+    label_spaces = []
+    if any(plane != 'sagittal' for plane in planes):
+        label_spaces.append('coronal')
+
+    if 'sagittal' in planes:
+        label_spaces.append('sagittal')
+
+    return label_spaces
+
+
+def get_num_classes(plane):
+    """
+    Function to get the number of classes of the label space of a plane
+    :param str plane: plane (axial, coronal or sagittal)
+    :return:
+    """
+    return len(LABELS_SAG) if plane == 'sagittal' else len(LABELS)
+
+
+def load_input_volume(filename, dtype, params, cache=None, timer=None, label=False):
+    """
+    Function to load an input volume in dtype. With params['conform'] set, volumes which are not conform (checked on
+    the header only) are conformed, the conformed volumes are taken from / stored in the cache.
+    :param str filename: path and name of the volume
+    :param dtype: dtype of the returned voxels
+    :param dict params: conform and conform_threads (number of threads interpolating)
+    :param None/SubjectCache cache: cache of the conformed volumes
+    :param None/StageTimer timer: timer recording the processing stages
+    :param bool label: the volume is a segmentation (nearest neighbour interpolation, no rescaling)
+    :return: np.ndarray
+    """
+    timer = timer if timer is not None else StageTimer()
+
+    if not params.get('conform') or is_conform(nib.load(filename)):
+        with timer.stage('decode'):
+            return load_volume(filename, dtype)
+
+    if cache is not None:
+        with timer.stage('cache_lookup'):
+            key = cache.key([filename], conform=True, label=label)
+            cached = cache.get(key)
+
+        if cached is not None:
+            return np.asarray(cached['data'], dtype=dtype)
+
+    print("Conforming {} to 256^3, 1mm isotropic voxels and LIA orientation".format(filename))
+    with timer.stage('conform'):
+        conformed = conform(nib.load(filename), label=label, num_threads=params.get('conform_threads', 1))
+        data = np.asarray(np.asanyarray(conformed.dataobj), dtype=dtype)
+
+    if cache is not None:
+        with timer.stage('cache_store'):
+            cache.put(key, {'data': data})
+
+    return data
+
+
+def load_subject_volumes(subject_dir, params, label_spaces, timer=None):
+    """
+    Function to load orig and aseg of one subject, map the aseg to the label spaces and create the weights.
+    With params['cache_dir'] set, the volumes of each label space are taken from / stored in a SubjectCache.
+    :param str subject_dir: name of the subject directory (relative to params['inputdir'])
+    :param dict params: inputdir, image_name, gt_name, cache_dir, cache_size (bytes), conform and conform_threads
+    :param list label_spaces: label spaces to compute ('coronal' and/or 'sagittal')
+    :param None/StageTimer timer: timer recording the processing stages
+    :return: dictionary mapping each label space to a dictionary with orig, mapped_aseg and weights
+    """
+    timer = timer if timer is not None else StageTimer()
+    orig_file = os.path.join(params['inputdir'], subject_dir, params['image_name'])
+    gt_file = os.path.join(params['inputdir'], subject_dir, params['gt_name'])
+
+    volumes = {}
+    cache = None
+
+    if params.get('cache_dir'):
+        cache = SubjectCache(params['cache_dir'], params.get('cache_size'))
+        keys = {}
+
+        for label_space in label_spaces:
+            with timer.stage('cache_lookup'):
+                keys[label_space] = cache.key([orig_file, gt_file], gt_name=params['gt_name'], label_space=label_space,
+                                              conform=params.get('conform', False))
+                cached = cache.get(keys[label_space])
+
+            if cached is not None:
+                print("Using cached {} volumes of {}".format(label_space, subject_dir))
+                volumes[label_space] = cached
+
+    missing = [label_space for label_space in label_spaces if label_space not in volumes]
+    if not missing:
+        return volumes
+
+    print("Processing MRI Data from {}/{}".format(subject_dir, params['image_name']))
+
+    # Load orig and aseg (decoded straight into the storage dtype, conformed if requested)
+    orig = load_input_volume(orig_file, np.uint8, params, cache, timer)
+
+    print('Processing ground truth segmentation {}'.format(params['gt_name']))
+    aseg = load_input_volume(gt_file, np.int32, params, cache, timer, label=True)
+
+    # Map aseg to label space (only the label spaces needed) and create weight masks
+    with timer.stage('label_mapping'):
+        mapped_aseg, mapped_aseg_sag = map_aparc_aseg2label(aseg, plane=missing[0] if len(missing) == 1 else None)
+    del aseg
+
+    for label_space, mapped in zip(['coronal', 'sagittal'], [mapped_aseg, mapped_aseg_sag]):
+        if mapped is None:
+            continue
+
+        # Label spaces have less than 256 classes, store them compactly (as in the hdf5-file)
+        mapped = mapped.astype(np.uint8)
+
+        with timer.stage('weight_mask'):
+            weights = create_weight_mask(mapped)
+
+        volumes[label_space] = {'orig': orig, 'mapped_aseg': mapped, 'weights': weights}
+
+        if cache is not None:
+            with timer.stage('cache_store'):
+                cache.put(keys[label_space], volumes[label_space])
+
+    return volumes
+
+
+def process_subject(subject_dir, params):
+    """
+    Function to load orig and aseg of one subject, map the aseg to label space, create the weights and
+    cut the volumes into (non-blank) thick slices of the requested planes.
+    Orig and aseg are loaded and mapped only once, the planes are views on the same volumes.
+    Defined on module level so it can be handed to a process pool.
+    :param str subject_dir: name of the subject directory (relative to params['inputdir'])
+    :param dict params: inputdir, image_name, gt_name, planes, slice_thickness, cache_dir, cache_size, crop_bbox,
+                        bbox_margin, bbox_buckets and bbox_threshold
+    :return: dictionary mapping each plane to its thick slices (H, W, N, C), labels (H, W, N), weights (H, W, N),
+             slice index records (N,) (see get_slice_index), voxel counts per class (N, num_classes) and the shape of
+             the full frames if the slices are cropped to their bounding box (params['crop_bbox'], None otherwise),
+             profile of the processing stages (StageTimer.as_dict)
+    """
+    planes = params['planes']
+    timer = StageTimer()
+    volumes = load_subject_volumes(subject_dir, params, get_label_spaces(planes), timer)
+
+    # Voxels of the orig kept in the crop window: the head mask (computed once, the orig of both label spaces is the
+    # same coronal volume), all non-zero voxels for bbox_threshold 0
+    head = next(iter(volumes.values()))['orig']
+    if params.get('crop_bbox', False) and params['bbox_threshold'] > 0:
+        with timer.stage('head_mask'):
+            head = get_head_mask(head, params['bbox_threshold'])
+
+    processed = {}
+    for plane in planes:
+        with timer.stage('plane_transform'):
+            if plane == 'sagittal':
+                sagittal = volumes['sagittal']
+                plane_orig = transform_sagittal(sagittal['orig'])
+                plane_aseg = transform_sagittal(sagittal['mapped_aseg'])
+                plane_weights = transform_sagittal(sagittal['weights'])
+                plane_head = transform_sagittal(head)
+
+            else:
+                coronal = volumes['coronal']
+                plane_orig, plane_aseg, plane_weights = coronal['orig'], coronal['mapped_aseg'], coronal['weights']
+                plane_head = head
+
+            # Transform Data as needed (swap axis for axial view)
+            if plane == 'axial':
+                plane_orig = transform_axial(plane_orig)
+                plane_aseg = transform_axial(plane_aseg)
+                plane_weights = transform_axial(plane_weights)
+                plane_head = transform_axial(plane_head)
+
+        # Create Thick Slices, filter out blanks
+        with timer.stage('thick_slices'):
+            orig_thick = get_thick_slices(plane_orig, params['slice_thickness'])
+
+        with timer.stage('blank_filtering'):
+            orig_thick, kept_aseg, kept_weights, slice_idx = filter_blank_slices_thick(orig_thick, plane_aseg,
+                                                                                       plane_weights, return_index=True)
+
+        crop, frame_shape = None, None
+        if params.get('crop_bbox', False):
+            with timer.stage('bbox_crop'):
+                # Bounding box of the labels and the head of all slices (foreground in dropped slices creates edges
+                # in the neighbouring ones, their intensities are in the thick slices), so nothing but background
+                # noise and background weights is cropped away
+                frame_shape = kept_aseg.shape[:2]
+                top, left, height, width = get_crop_window(plane_aseg, params['bbox_margin'], params['bbox_buckets'],
+                                                           plane_head)
+
+                # Weight of the voxels outside of the window (all background without edges)
+                outside = (0, 0) if top > 0 or left > 0 else (frame_shape[0] - 1, frame_shape[1] - 1)
+                weight_fill = float(kept_weights[outside][0]) if kept_weights.shape[2] > 0 else 0.0
+                crop = (top, left, weight_fill)
+
+        # Class counts and slice index describe the full frames
+        with timer.stage('slice_index'):
+            class_counts = get_slice_class_counts(kept_aseg, get_num_classes(plane))
+            slice_index = get_slice_index(kept_aseg, slice_idx, get_num_classes(plane), class_counts, crop)
+
+        if crop is not None:
+            window = (slice(top, top + height), slice(left, left + width))
+            orig_thick, kept_aseg, kept_weights = orig_thick[window], kept_aseg[window], kept_weights[window]
+
+        processed[plane] = orig_thick, kept_aseg, kept_weights, slice_index, class_counts, frame_shape
+
+        num_kept = kept_aseg.shape[2]
+        timer.count('{}_slices_kept'.format(plane), num_kept)
+        timer.count('{}_slices_dropped'.format(plane), plane_aseg.shape[2] - num_kept)
+
+    return processed, timer.as_dict()
+
+
+##
+# Memory budget (for training set generation)
+##
+def estimate_subject_memory(shape, slice_thickness, planes):
+    """
+    Function to estimate the memory needed to process one subject
+    :param tuple shape: shape of the input volumes
+    :param int slice_thickness: number of pre- and succeeding slices
+    :param list planes: planes to process
+    :return: peak memory while processing (including the processed slices, bytes),
+             memory of the processed slices of all planes (bytes)
+    """
+    voxels = int(np.prod(shape, dtype=np.int64))
+    num_label_spaces = len(get_label_spaces(planes))
+
+    # Thick slices (uint8), labels (uint8) and weights (float32) of every plane
+    result = voxels * len(planes) * (2 * slice_thickness + 1 + 1 + 4)
+    processing = max(voxels * (MAPPING_BYTES_PER_VOXEL + MAPPED_BYTES_PER_VOXEL * num_label_spaces),
+                     voxels * (1 + LABEL_SPACE_BYTES_PER_VOXEL * num_label_spaces) + result)
+
+    return processing, result
+
+
+def plan_memory(max_memory, shape, slice_thickness, planes, jobs=1, weight_dtype='float64'):
+    """
+    Function to fit the processing into a memory budget: the number of worker processes and subjects in flight
+    are reduced until the estimated peak fits and the writer converts and writes at most buffer_slices slices at once.
+    :param int max_memory: memory budget in bytes
+    :param tuple shape: shape of the input volumes
+    :param int slice_thickness: number of pre- and succeeding slices
+    :param list planes: planes to process
+    :param int jobs: requested number of worker processes
+    :param str weight_dtype: storage dtype of the weights
+    :return: dictionary with jobs, window (subjects in flight), buffer_slices and required (estimated minimum memory
+             in bytes)
+    """
+    processing, result = estimate_subject_memory(shape, slice_thickness, planes)
+
+    # Slices are buffered in the storage dtypes: thick slices, labels and weights
+    slice_bytes = int(np.prod(shape, dtype=np.int64)) // int(min(shape)) * \
+        (2 * slice_thickness + 2 + np.dtype(weight_dtype).itemsize)
+    buffer_bytes = min(max_memory // 16, 256 * 1024 ** 2)
+    buffer_slices = max(1, buffer_bytes // slice_bytes)
+    buffer_bytes = buffer_slices * slice_bytes
+
+    # Sequential: processing in this process, then the processed slices and the write buffer
+    required = PROCESS_BASE_MEMORY + max(processing, result + buffer_bytes)
+
+    # Pool: every worker processes one subject, this process holds the results in flight and the write buffer
+    available = max_memory - PROCESS_BASE_MEMORY - buffer_bytes
+    jobs = max(1, min(jobs, available // (PROCESS_BASE_MEMORY + processing + result)))
+    window = 1
+    if jobs > 1:
+        window = (available - jobs * (PROCESS_BASE_MEMORY + processing)) // result
+        window = int(min(max(window, jobs), 2 * jobs))
+
+    return {'jobs': int(jobs), 'window': window, 'buffer_slices': int(buffer_slices), 'required': int(required)}
@@ -14,15 +14,20 @@ import os
 import sys
 import time
 import glob
-import h5py
-import numpy as np
-import nibabel as nib
-from data_loader.load_neuroimaging_data import map_aparc_aseg2label, create_weight_mask, transform_sagittal, \
-                                               transform_axial, get_thick_slices, filter_blank_slices_thick
-
+import json
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
 
+# The data_loader package lives next to this script
 sys.path.append(os.path.dirname(__file__))
 
+from data_loader.hdf5_io import HDF5SliceWriter, HDF5ShardedWriter, WEIGHT_DTYPES, COMPRESSIONS, get_compression_options
+import nibabel as nib
+from data_loader.subject_pipeline import process_subject, plan_memory, estimate_subject_memory, get_num_classes, \
+                                         PROCESS_BASE_MEMORY
+from data_loader.profiling import StageTimer, ProfileReport
+
 # import the Chris app superclass
 from chrisapp.base import ChrisApp
 
@@ -124,7 +129,9 @@ class Generate_hdf5(ChrisApp):
     MAX_CPU_LIMIT           = '' # Override with millicore value as string, e.g. '2000m'
     MIN_CPU_LIMIT           = '' # Override with millicore value as string, e.g. '2000m'
     MAX_MEMORY_LIMIT        = '' # Override with string, e.g. '1Gi', '2000Mi'
-    MIN_MEMORY_LIMIT        = '' # Override with string, e.g. '1Gi', '2000Mi'
+    # Estimated peak of one conformed (256^3) subject, one plane and the default thickness
+    MIN_MEMORY_LIMIT        = '{}Mi'.format((PROCESS_BASE_MEMORY + estimate_subject_memory((256, 256, 256), 3, ['axial'])[0])
+                                            // 1024 ** 2 + 1)
     MIN_GPU_LIMIT           = 0  # Override with the minimum number of GPUs, as an integer, for your plugin
     MAX_GPU_LIMIT           = 0  # Override with the maximum number of GPUs, as an integer, for your plugin
 
@@ -150,8 +157,10 @@ class Generate_hdf5(ChrisApp):
 
         self.add_argument('--hdf5_name', dest='dataset_name',type=str,optional = True, default="testsuite_2.hdf5",
                         help='path and name of hdf5-dataset (default: testsuite_2.hdf5)')
-        self.add_argument('--plane',dest='plane', type=str, default="axial",optional = True, choices=["axial", "coronal", "sagittal"],
-                        help="Which plane to put into file (axial (default), coronal or sagittal)")
+        self.add_argument('--plane',dest='plane', type=str, default="axial",optional = True, choices=["axial", "coronal", "sagittal", "all"],
+                        help="Which plane to put into file (axial (default), coronal or sagittal)."
+                             " With all, each subject is loaded once and every plane is written to its own file"
+                             " (plane appended to the hdf5 name, e.g. testsuite_2_axial.hdf5)")
         self.add_argument('--height',dest='height', type=int,optional = True, default=256, help='Height of Image (Default 256)')
         self.add_argument('--width', dest = 'height', type=int,optional = True, default=256, help='Width of Image (Default 256)')
         self.add_argument('--thickness',dest = 'slice_thickness',type=int,optional = True, default=3, help="Number of pre- and succeeding slices (default: 3)")
@@ -163,6 +172,66 @@ class Generate_hdf5(ChrisApp):
                              " If Corpus Callosum segmentation is already removed, do not set gt_nocc."
                              " (e.g. for our internal training set mri/aparc.DKTatlas+aseg.filled.mgz exists already"
                              " and should be used here instead of mri/aparc.DKTatlas+aseg.mgz). ")
+        self.add_argument('--jobs', dest='jobs', type=int, optional=True, default=1,
+                        help="Number of subjects processed in parallel by a process pool (default: 1)."
+                             " Results are still written in subject order by a single writer.")
+        self.add_argument('--weight_dtype', dest='weight_dtype', type=str, optional=True, default="float64",
+                        choices=WEIGHT_DTYPES,
+                        help="Storage dtype of the weight dataset (default: float64). uint8 quantizes the weights"
+                             " to 256 logarithmically spaced levels from 1e-4 to 10 (relative error below 2.3%),"
+                             " the quantization is stored as attributes of the dataset.")
+        self.add_argument('--compression', dest='compression', type=str, optional=True, default="gzip",
+                        choices=COMPRESSIONS,
+                        help="Compression filter of the datasets (default: gzip). blosc and zstd need hdf5plugin.")
+        self.add_argument('--compression_level', dest='compression_level', type=int, optional=True, default=-1,
+                        help="Level of the compression filter (default: -1 = filter default, ignored for lzf)")
+        self.add_argument('--shuffle', dest='shuffle', type=bool, optional=True, default=False,
+                        help="If specified, apply the shuffle filter before compression")
+        self.add_argument('--chunk_slices', dest='chunk_slices', type=int, optional=True, default=1,
+                        help="Number of slices per hdf5 chunk (default: 1, chunks of one slice (1, H, W, C))")
+        self.add_argument('--append', dest='append', type=bool, optional=True, default=False,
+                        help="If specified, append to existing hdf5-files (plane, thickness, weight dtype and slice"
+                             " shape have to match) and only process the subjects not in the files yet")
+        self.add_argument('--cache_dir', dest='cache_dir', type=str, optional=True, default="",
+                        help="Directory of a cache of the processed (label mapped and weighted) volumes of each"
+                             " subject, keyed by the content of the input files (default: no cache)")
+        self.add_argument('--cache_size', dest='cache_size', type=float, optional=True, default=50.0,
+                        help="Size limit of the cache in GiB, least recently used subjects are evicted (default: 50)")
+        self.add_argument('--conform', dest='conform', type=bool, optional=True, default=False,
+                        help="If specified, conform inputs which are not conform yet (256^3, 1 mm isotropic voxels, LIA"
+                             " orientation) to this format (checked on the header only). Images are interpolated"
+                             " linearly and rescaled to UCHAR, segmentations with nearest neighbour. With --cache_dir,"
+                             " the conformed volumes are cached.")
+        self.add_argument('--max_memory', dest='max_memory', type=float, optional=True, default=0.0,
+                        help="Memory budget in GiB (default: 0 = unlimited). Worker processes, subjects in flight"
+                             " and the slices buffered by the writers are reduced to stay below it.")
+        self.add_argument('--profile_report', dest='profile_report', type=str, optional=True, default="",
+                        help="Path and name of a JSON file (resolved like --hdf5_name) to write the per-subject and"
+                             " aggregated time of every processing stage and the kept and dropped slices to"
+                             " (default: no report)")
+        self.add_argument('--shard_size', dest='shard_size', type=int, optional=True, default=0,
+                        help="Maximal number of slices per file (default: 0 = one file). If given, the slices are"
+                             " written to shard files <name>_shard000.hdf5, ... (subjects are not split across"
+                             " shards) and the hdf5-dataset becomes a master file exposing the shards as virtual"
+                             " datasets. Keep the shards next to the master file. Can not be combined with --append.")
+        self.add_argument('--crop_bbox', dest='crop_bbox', type=bool, optional=True, default=False,
+                        help="If specified, crop the slices of each subject to the bounding box of its labels and"
+                             " head (see --bbox_threshold) plus --bbox_margin, enlarged to the next of --bbox_buckets."
+                             " The slices are stored in one group per crop size, the crop offsets in the slice index."
+                             " The full frames are reconstructed with label 0, the background weight and intensity 0"
+                             " outside of the crop, so the background noise there is lost. Can not be combined with"
+                             " --shard_size.")
+        self.add_argument('--bbox_margin', dest='bbox_margin', type=int, optional=True, default=8,
+                        help="Number of voxels kept around the bounding box with --crop_bbox (default: 8, at least 1)")
+        self.add_argument('--bbox_buckets', dest='bbox_buckets', type=str, optional=True,
+                        default="128,160,192,224,256",
+                        help="Comma separated sizes the height and width of the crops are enlarged to with --crop_bbox"
+                             " (default: 128,160,192,224,256)")
+        self.add_argument('--bbox_threshold', dest='bbox_threshold', type=int, optional=True, default=10,
+                        help="Intensity threshold (of the conformed orig) of the head kept inside the crop with"
+                             " --crop_bbox: the largest connected component of the voxels above (default: 10, above"
+                             " the usual background noise). 0 keeps all non-zero voxels, so the orig is reconstructed"
+                             " exactly, but background noise then grows the crop to about the full frame")
 
 
         
@@ -174,7 +243,8 @@ class Generate_hdf5(ChrisApp):
         print('Version: %s' % self.get_version())
         
         self.search_pattern = os.path.join(options.inputdir, options.pattern)
-        self.subject_dirs = os.listdir(self.search_pattern)
+        # Sort the subjects, so that the order of the written slices does not depend on the file system
+        self.subject_dirs = sorted(os.listdir(self.search_pattern))
         print (self.subject_dirs)
         self.data_set_size = len(self.subject_dirs)
         self.create_hdf5_dataset(options,plane=options.plane)
@@ -184,97 +254,211 @@ class Generate_hdf5(ChrisApp):
         Print the app's man page.
         """
         print(Gstr_synopsis)
-    def create_hdf5_dataset( self,options,plane='axial', is_small=False):
+
+    def iter_subjects(self, subject_dirs, params, jobs=1, window=None):
         """
-        Function to store all images in a given directory (or pattern) in a hdf5-file.
-        :param str plane: which plane is processed (coronal, axial or saggital)
-        :param bool is_small: small hdf5-file for pretraining?
-        :return:
+        Generator over the processed subjects in the order of subject_dirs.
+        With jobs > 1 the subjects are processed by a pool of worker processes, keeping at most window
+        subjects in flight. Failures stay isolated: they are only raised when the result of the failing subject is
+        requested.
+        :param list subject_dirs: subjects to process
+        :param dict params: parameters passed on to process_subject
+        :param int jobs: number of worker processes (1 = process in this process)
+        :param None/int window: maximal number of subjects in flight (default None = 2 * jobs)
+        :return: tuples of (index, subject, function returning the processed subject)
         """
-        start_d = time.time()
+        window = window or 2 * jobs
 
-        # Prepare arrays to hold the data
-        orig_dataset = np.ndarray(shape=(256, 256, 0, 2 * options.slice_thickness + 1), dtype=np.uint8)
-        aseg_dataset = np.ndarray(shape=(256, 256, 0), dtype=np.uint8)
-        weight_dataset = np.ndarray(shape=(256, 256, 0), dtype=np.float)
-        subjects = []
+        if jobs <= 1:
+            for idx, current_subject in enumerate(subject_dirs):
+                yield idx, current_subject, lambda subject=current_subject: process_subject(subject, params)
+            return
 
-        # Loop over all subjects and load orig, aseg and create the weights
-        for idx, current_subject in enumerate(self.subject_dirs):
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            pending = deque()
 
             try:
-                start = time.time()
+                for idx, current_subject in enumerate(subject_dirs):
+                    pending.append((idx, current_subject, executor.submit(process_subject, current_subject, params)))
 
-                print("Volume Nr: {} Processing MRI Data from {}/{}".format(idx, current_subject, options.image_name))
+                    if len(pending) >= window:
+                        idx, current_subject, future = pending.popleft()
+                        yield idx, current_subject, future.result
 
-                # Load orig and aseg
-                orig = nib.load(os.path.join(options.inputdir,current_subject, options.image_name))
-                orig = np.asarray(orig.get_fdata(), dtype=np.uint8)
+                while pending:
+                    idx, current_subject, future = pending.popleft()
+                    yield idx, current_subject, future.result
 
-                aseg = nib.load(os.path.join(options.inputdir,current_subject, options.gt_name))
+            finally:
+                # Do not process the remaining subjects if the consumer stopped early
+                for _, _, future in pending:
+                    future.cancel()
 
-                print('Processing ground truth segmentation {}'.format(options.gt_name))
-                aseg = np.asarray(aseg.get_fdata(), dtype=np.int32)
-               
-                
-                # Map aseg to label space and create weight masks
-                if plane == 'sagittal':
-                    _, mapped_aseg = map_aparc_aseg2label(aseg, aseg_nocc)
-                    weights = create_weight_mask(mapped_aseg)
-                    orig = transform_sagittal(orig)
-                    mapped_aseg = transform_sagittal(mapped_aseg)
-                    weights = transform_sagittal(weights)
+    def get_volume_shape(self, options):
+        """
+        Function to get the shape of the input volumes (read from the header of the first subject)
+        :return:
+        """
+        image = nib.load(os.path.join(options.inputdir, self.subject_dirs[0], options.image_name))
+        return tuple(int(s) for s in image.shape[:3])
 
+    @staticmethod
+    def format_memory(num_bytes):
+        """
+        Function to format a memory size for printing
+        :param None/int num_bytes: memory size in bytes (None if not available)
+        :return:
+        """
+        return "n/a" if num_bytes is None else "{:.1f} MiB".format(num_bytes / 1024 ** 2)
+
+    @staticmethod
+    def get_plane_dataset_name(dataset_name, plane, planes):
+        """
+        Function to get the name of the hdf5-file of a plane (plane is appended to the name if several planes are
+        written)
+        :param str dataset_name: path and name of the hdf5-dataset
+        :param str plane: plane to get the file name for
+        :param list planes: all planes written
+        :return:
+        """
+        if len(planes) == 1:
+            return dataset_name
+
+        root, ext = os.path.splitext(dataset_name)
+        return "{}_{}{}".format(root, plane, ext)
+
+    def create_hdf5_dataset( self,options,plane='axial', is_small=False):
+        """
+        Function to store all images in a given directory (or pattern) in a hdf5-file.
+        :param str plane: which plane is processed (coronal, axial, saggital or all)
+        :param bool is_small: small hdf5-file for pretraining?
+        :return:
+        """
+        start_d = time.time()
+
+        if options.shard_size > 0 and options.append:
+            raise ValueError("--append can not be combined with --shard_size")
+
+        if options.shard_size > 0 and options.crop_bbox:
+            raise ValueError("--crop_bbox can not be combined with --shard_size")
+
+        planes = ["axial", "coronal", "sagittal"] if plane == "all" else [plane]
+        dataset_names = {p: self.get_plane_dataset_name(options.dataset_name, p, planes) for p in planes}
+
+        # Create the directories of the hdf5-files and the report before any subject is processed
+        for filename in list(dataset_names.values()) + ([options.profile_report] if options.profile_report else []):
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+
+        params = {'inputdir': options.inputdir, 'image_name': options.image_name, 'gt_name': options.gt_name,
+                  'planes': planes, 'slice_thickness': options.slice_thickness,
+                  'cache_dir': options.cache_dir, 'cache_size': int(options.cache_size * 1024 ** 3),
+                  'conform': options.conform, 'crop_bbox': options.crop_bbox, 'bbox_margin': options.bbox_margin,
+                  'bbox_buckets': [int(size) for size in options.bbox_buckets.split(",")],
+                  'bbox_threshold': options.bbox_threshold}
+
+        compression_options = get_compression_options(options.compression,
+                                                      None if options.compression_level < 0 else options.compression_level,
+                                                      options.shuffle)
+
+        jobs, window, buffer_slices = options.jobs, None, None
+        if options.max_memory > 0 and self.subject_dirs:
+            shape = (256, 256, 256) if options.conform else self.get_volume_shape(options)
+            memory = plan_memory(int(options.max_memory * 1024 ** 3), shape, options.slice_thickness, planes,
+                                 options.jobs, options.weight_dtype)
+            jobs, window, buffer_slices = memory['jobs'], memory['window'], memory['buffer_slices']
+
+            if memory['required'] > options.max_memory * 1024 ** 3:
+                print("Warning: --max_memory {} GiB is below the estimated minimum of {:.2f} GiB".format(
+                    options.max_memory, memory['required'] / 1024 ** 3))
+
+            print("Memory budget {} GiB: {} jobs, {} subjects in flight, {} slices buffered".format(
+                options.max_memory, jobs, window if jobs > 1 else 1, buffer_slices))
+
+        # Share the cores between the worker processes for the interpolation of conform
+        params['conform_threads'] = max(1, (os.cpu_count() or 1) // jobs)
+
+        report = ProfileReport()
+
+        # Stream every subject straight into the hdf5-files (peak memory is bounded by the subjects in flight)
+        with ExitStack() as stack:
+            writers = {}
+            for p in planes:
+                attrs = {'plane': p, 'slice_thickness': options.slice_thickness}
+                if options.crop_bbox:
+                    attrs['bbox_margin'] = options.bbox_margin
+                    attrs['bbox_threshold'] = options.bbox_threshold
+                if options.shard_size > 0:
+                    writer = HDF5ShardedWriter(dataset_names[p], options.shard_size, compression_options,
+                                               options.chunk_slices, options.weight_dtype, attrs=attrs,
+                                               buffer_slices=buffer_slices, num_classes=get_num_classes(p))
                 else:
-                    mapped_aseg, _ = map_aparc_aseg2label(aseg)
-                    weights = create_weight_mask(mapped_aseg)
-                
-                # Transform Data as needed (swap axis for axial view)
-                if plane == 'axial':
-                    orig = transform_axial(orig)
-                    mapped_aseg = transform_axial(mapped_aseg)
-                    weights = transform_axial(weights)
+                    writer = HDF5SliceWriter(dataset_names[p], "a" if options.append else "w", compression_options,
+                                             options.chunk_slices, options.weight_dtype, attrs=attrs,
+                                             buffer_slices=buffer_slices, num_classes=get_num_classes(p))
+                writers[p] = stack.enter_context(writer)
+
+            # Skip the subjects already written to all files
+            existing = {p: set(writers[p].get_subjects()) for p in planes}
+            subject_dirs = [s for s in self.subject_dirs
+                            if any(s.split("/")[-1] not in existing[p] for p in planes)]
 
-                # Create Thick Slices, filter out blanks
-                orig_thick = get_thick_slices(orig, options.slice_thickness)
-                orig, mapped_aseg, weights = filter_blank_slices_thick(orig_thick, mapped_aseg, weights)
+            if options.append:
+                print("Appending {} of {} subjects".format(len(subject_dirs), len(self.subject_dirs)))
 
-                # Append finally processed images to arrays
-                orig_dataset = np.append(orig_dataset, orig, axis=2)
-                aseg_dataset = np.append(aseg_dataset, mapped_aseg, axis=2)
-                weight_dataset = np.append(weight_dataset, weights, axis=2)
+            # Loop over all subjects and load orig, aseg and create the weights
+            for idx, current_subject, get_result in self.iter_subjects(subject_dirs, params, jobs, window):
 
-                sub_name = current_subject.split("/")[-1]
-                subjects.append(sub_name.encode("ascii", "ignore"))
+                try:
+                    start = time.time()
 
-                end = time.time() - start
+                    print("Volume Nr: {} Processing MRI Data from {}/{}".format(idx, current_subject, options.image_name))
 
-                print("Volume: {} Finished Data Reading and Appending in {:.3f} seconds.".format(idx, end))
+                    processed, profile = get_result()
 
-                if is_small and idx == 2:
-                    break
+                    # Append finally processed images to the hdf5-files (compression is applied while writing)
+                    timer = StageTimer()
+                    sub_name = current_subject.split("/")[-1]
+                    for p in planes:
+                        if sub_name not in existing[p]:
+                            orig, mapped_aseg, weights, slice_index, class_counts, frame_shape = processed[p]
+                            with timer.stage('write'):
+                                writers[p].append(orig, mapped_aseg, weights, sub_name, slice_index, class_counts,
+                                                  frame_shape)
 
-            except Exception as e:
-                print("Volume: {} Failed Reading Data. Error: {}".format(idx, e))
-                continue
+                    profile['stages'].update(timer.stages)
+                    profile['peak_rss_increase'].update(timer.peak_rss_increase)
+                    report.add_subject(current_subject, profile)
 
-        # Transpose to N, H, W, C and expand_dims for image
+                    end = time.time() - start
 
-        orig_dataset = np.transpose(orig_dataset, (2, 0, 1, 3))
-        aseg_dataset = np.transpose(aseg_dataset, (2, 0, 1))
-        weight_dataset = np.transpose(weight_dataset, (2, 0, 1))
+                    print("Volume: {} Finished Data Reading and Appending in {:.3f} seconds.".format(idx, end))
 
-        # Write the hdf5 file
-        with h5py.File(options.dataset_name, "w") as hf:
-            hf.create_dataset('orig_dataset', data=orig_dataset, compression='gzip')
-            hf.create_dataset('aseg_dataset', data=aseg_dataset, compression='gzip')
-            hf.create_dataset('weight_dataset', data=weight_dataset, compression='gzip')
+                    if is_small and idx == 2:
+                        break
 
-            dt = h5py.special_dtype(vlen=str)
-            hf.create_dataset("subject", data=subjects, dtype=dt, compression="gzip")
+                except Exception as e:
+                    print("Volume: {} Failed Reading Data. Error: {}".format(idx, e))
+                    report.add_subject(current_subject, None, error=str(e))
+                    continue
 
         end_d = time.time() - start_d
-        print("Successfully written {} in {:.3f} seconds.".format(options.outputdir + "/"+options.dataset_name, end_d))
+        for p in planes:
+            print("Successfully written {} in {:.3f} seconds.".format(dataset_names[p], end_d))
+
+        summary = report.aggregate()
+        for name, seconds in summary['stages'].items():
+            print("Stage {}: {:.3f} seconds ({:.1%}), raised the peak memory by up to {}".format(
+                name, seconds, summary['stages_fraction'][name],
+                self.format_memory(summary['peak_rss_increase'].get(name))))
+
+        print("Peak memory: {} (main process), {} (worker processes)".format(
+            self.format_memory(summary['peak_rss_main']), self.format_memory(summary['peak_rss_workers'])))
+
+        self.OUTPUT_META_DICT = {'hdf5_files': [dataset_names[p] for p in planes], 'profile': summary}
+
+        if options.profile_report:
+            with open(options.profile_report, 'w') as f:
+                json.dump(report.as_dict(), f, indent=2)
 
 # ENTRYPOINT
 if __name__ == "__main__":
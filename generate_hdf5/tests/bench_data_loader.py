@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+#
+# Benchmarks for the data_loader hot functions on synthetic volumes, optionally compared against the original
+# implementations (legacy_*) and against the results of an earlier run.
+#
+# Run with
+#
+#   python -m generate_hdf5.tests.bench_data_loader [--output_dir <DIR>] [--compare <RESULTS.json>]
+#
+# The results (best run time and peak traced memory of every benchmark) are written to
+# <DIR>/<git commit>.json, so regressions can be tracked across commits.
+#
+
+# IMPORTS
+import os
+import sys
+import json
+import atexit
+import shutil
+import tempfile
+import time
+import optparse
+import subprocess
+import tracemalloc
+import numpy as np
+import nibabel as nib
+
+from generate_hdf5.data_loader.load_neuroimaging_data import map_aparc_aseg2label, create_weight_mask, \
+                                                          get_thick_slices, filter_blank_slices_thick, \
+                                                          transform_axial, transform_sagittal, load_volume, \
+                                                          OrigDataThickSlices
+from generate_hdf5.data_loader.conform import conform, getscale, scalecrop
+from generate_hdf5.data_loader.augmentation import ToTensor, ToTensorTest, AugmentationPadImage, \
+                                                  AugmentationRandomCrop, AugmentationPadCrop, BatchToTensor, \
+                                                  BatchAugmentationPadCrop, BatchCollate
+from generate_hdf5.tests import legacy_data_loader
+
+HELPTEXT = """
+Benchmark suite for the data_loader hot functions.
+
+USAGE:
+bench_data_loader.py [--output_dir <DIR>] [--compare <RESULTS.json>] [--size <N>] [--repeat <N>] [--legacy]
+"""
+
+# Relative frequency of aparc.DKTatlas+aseg labels inside the brain (roughly as in FreeSurfer segmentations:
+# cerebral white matter and cortex dominate, subcortical structures and single parcels are small)
+LABEL_FREQUENCIES = {2: 200, 41: 200, 3: 10, 42: 10, 4: 8, 43: 8, 7: 15, 46: 15, 8: 50, 47: 50, 10: 4, 49: 4,
+                     11: 3, 50: 3, 12: 4, 51: 4, 13: 2, 52: 2, 16: 10, 17: 3, 53: 3, 18: 1, 54: 1, 24: 15,
+                     26: 1, 58: 1, 28: 3, 60: 3, 14: 1, 15: 1, 5: 1, 44: 1, 31: 1, 63: 1, 77: 2, 251: 1, 252: 1}
+LABEL_FREQUENCIES.update({label: 6 for label in list(range(1002, 1036)) + list(range(2002, 2036))
+                          if label not in [1004, 1032, 1033, 2004, 2032, 2033]})
+
+
+def options_parse():
+    """
+    Command line option parser
+    """
+    parser = optparse.OptionParser(usage=HELPTEXT)
+    parser.add_option('--output_dir', dest='output_dir', default='benchmark_results',
+                      help='directory to write the results to (default: benchmark_results)')
+    parser.add_option('--compare', dest='compare', help='results of an earlier run to compare with')
+    parser.add_option('--size', dest='size', type="int", default=256, help='edge length of the volumes (default 256)')
+    parser.add_option('--repeat', dest='repeat', type="int", default=3, help='runs per benchmark (default 3)')
+    parser.add_option('--legacy', dest='legacy', action='store_true', default=False,
+                      help='also benchmark the original implementations')
+    (fin_options, args) = parser.parse_args()
+    return fin_options
+
+
+def synthetic_aseg(shape=(256, 256, 256), seed=0):
+    """
+    Function to create a synthetic aparc+aseg volume (background outside of a centered ellipsoid,
+    blocks of labels drawn with LABEL_FREQUENCIES inside). Every label is placed in at least one block, so all classes
+    of the label space are present (as create_weight_mask requires).
+    :param tuple shape: shape of the volume
+    :param int seed: random seed
+    :return:
+    """
+    rng = np.random.RandomState(seed)
+    labels = np.array(list(LABEL_FREQUENCIES.keys()))
+    probabilities = np.array(list(LABEL_FREQUENCIES.values()), dtype=float)
+
+    block = 4
+    blocks = rng.choice(labels, size=tuple(s // block for s in shape), p=probabilities / probabilities.sum())
+
+    # Blocks with their center voxel inside the ellipsoid (kept by the mask below)
+    centers = np.ogrid[tuple(slice(0, b) for b in blocks.shape)]
+    center_dist = sum(((g * block + block // 2 - s / 2.0) / (0.4 * s)) ** 2 for g, s in zip(centers, shape))
+    inside = np.flatnonzero(center_dist <= 1)
+
+    if len(inside) < len(labels):
+        raise ValueError("Volumes of shape {} are too small to hold all {} labels".format(shape, len(labels)))
+
+    blocks.flat[rng.choice(inside, size=len(labels), replace=False)] = labels
+    aseg = np.kron(blocks, np.ones((block, block, block), dtype=np.int32)).astype(np.int32)
+
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    dist = sum(((g - s / 2.0) / (0.4 * s)) ** 2 for g, s in zip(grid, shape))
+    aseg[dist > 1] = 0
+
+    return aseg
+
+
+def synthetic_orig(aseg, seed=0):
+    """
+    Function to create a synthetic uint8 intensity volume matching a synthetic aseg
+    :param np.ndarray aseg: synthetic aparc+aseg volume
+    :param int seed: random seed
+    :return:
+    """
+    rng = np.random.RandomState(seed)
+    orig = (aseg % 97 + 60) * (aseg > 0) + rng.randint(0, 20, size=aseg.shape)
+    return orig.astype(np.uint8)
+
+
+def synthetic_unconformed_image(size, seed=0):
+    """
+    Function to create a synthetic float image with 1.2 mm voxels (needs conforming)
+    :param int size: edge length of the conformed volume
+    :param int seed: random seed
+    :return: nibabel.MGHImage
+    """
+    shape = (int(size / 1.2),) * 3
+    data = np.random.RandomState(seed).gamma(2.0, 150.0, size=shape).astype(np.float32)
+    affine = np.diag([-1.2, 1.2, 1.2, 1.0])
+    affine[:3, 3] = [s * 0.6 for s in shape]
+
+    return nib.MGHImage(data, affine)
+
+
+def measure(func, repeat=3):
+    """
+    Function to measure the best run time and the peak memory (traced by tracemalloc, which includes
+    numpy allocations) of func()
+    :param func: function to benchmark
+    :param int repeat: number of timed runs
+    :return: dictionary with time (seconds) and peak_memory (bytes)
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'time': min(times), 'peak_memory': peak}
+
+
+def get_benchmarks(size, legacy=False):
+    """
+    Function to set up the benchmarks
+    :param int size: edge length of the volumes
+    :param bool legacy: also benchmark the original implementations
+    :return: list of (name, function)
+    """
+    aseg = synthetic_aseg((size, size, size))
+    orig = synthetic_orig(aseg)
+    mapped_aseg, _ = map_aparc_aseg2label(aseg, plane='coronal')
+    mapped_aseg = mapped_aseg.astype(np.uint8)
+    weights = create_weight_mask(mapped_aseg)
+    orig_thick = get_thick_slices(orig, 3)
+    unconformed = synthetic_unconformed_image(size)
+    unconformed_data = np.asanyarray(unconformed.dataobj)
+
+    # Segmentation as stored by FreeSurfer (compressed, big-endian int32)
+    tmp_dir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, tmp_dir, ignore_errors=True)
+    aseg_file = os.path.join(tmp_dir, 'aparc.DKTatlas+aseg.mgz')
+    nib.MGHImage(aseg, np.eye(4)).to_filename(aseg_file)
+
+    # One training sample (as stored in the hdf5-file)
+    sample = {'img': np.ascontiguousarray(orig_thick[:, :, size // 2, :]),
+              'label': np.ascontiguousarray(mapped_aseg[:, :, size // 2]),
+              'weight': np.ascontiguousarray(weights[:, :, size // 2])}
+    pad = AugmentationPadImage(pad_size=16)
+    crop = AugmentationRandomCrop(output_size=size)
+    pad_crop = AugmentationPadCrop(pad_size=16, output_size=size)
+    to_tensor = ToTensor()
+    padded = pad(sample)
+
+    # One batch of 16 samples, per sample and batched
+    samples = [{'image': sample['img'], 'label': sample['label'], 'weight': sample['weight']}] * 16
+    collate = BatchCollate(lambda batch: BatchToTensor()(BatchAugmentationPadCrop(16, size)(batch)))
+
+    # Inference on one volume (building the dataset and normalizing all thick slices)
+    def inference_slices(lazy):
+        dataset = OrigDataThickSlices('orig.mgz', orig, 'Axial', 3, ToTensorTest(), lazy=lazy)
+        return [dataset[index] for index in range(len(dataset))]
+
+    benchmarks = [
+        ('load_volume', lambda: load_volume(aseg_file, np.int32)),
+        ('map_aparc_aseg2label', lambda: map_aparc_aseg2label(aseg)),
+        ('map_aparc_aseg2label_single_plane', lambda: map_aparc_aseg2label(aseg, plane='axial')),
+        ('create_weight_mask', lambda: create_weight_mask(mapped_aseg)),
+        ('get_thick_slices', lambda: np.ascontiguousarray(get_thick_slices(orig, 3))),
+        ('filter_blank_slices_thick', lambda: filter_blank_slices_thick(orig_thick, mapped_aseg, weights)),
+        ('transform_axial', lambda: np.ascontiguousarray(transform_axial(orig))),
+        ('transform_sagittal', lambda: np.ascontiguousarray(transform_sagittal(orig))),
+        ('getscale', lambda: getscale(unconformed_data, 0, 255)),
+        ('scalecrop', lambda: scalecrop(unconformed_data, 0, 255, 0.0, 0.5, out=np.empty(unconformed.shape, np.uint8))),
+        ('conform', lambda: conform(unconformed)),
+        ('augmentation_pad', lambda: pad(sample)),
+        ('augmentation_random_crop', lambda: crop(padded)),
+        ('augmentation_pad_crop', lambda: pad_crop(sample)),
+        ('augmentation_to_tensor', lambda: to_tensor(sample)),
+        ('augmentation_batch_per_sample', lambda: [to_tensor(crop(pad(sample))) for _ in range(16)]),
+        ('augmentation_batch_collate', lambda: collate(samples)),
+        ('orig_thick_slices', lambda: inference_slices(False)),
+        ('orig_thick_slices_lazy', lambda: inference_slices(True)),
+    ]
+
+    if legacy:
+        benchmarks += [
+            ('legacy_load_volume', lambda: np.asarray(nib.load(aseg_file).get_fdata(), dtype=np.int32)),
+            ('legacy_map_aparc_aseg2label', lambda: legacy_data_loader.map_aparc_aseg2label(aseg.copy())),
+            ('legacy_get_thick_slices', lambda: legacy_data_loader.get_thick_slices(orig, 3)),
+            ('legacy_getscale', lambda: legacy_data_loader.getscale(unconformed_data, 0, 255)),
+            ('legacy_scalecrop', lambda: legacy_data_loader.scalecrop(unconformed_data, 0, 255, 0.0, 0.5)),
+            ('legacy_create_weight_mask', lambda: legacy_data_loader.create_weight_mask(mapped_aseg)),
+        ]
+
+    return benchmarks
+
+
+def get_commit():
+    """
+    Function to get the current git commit (short hash, "unknown" outside of a git repository)
+    :return:
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, reference):
+    """
+    Function to print the change of every benchmark relative to an earlier run
+    :param dict results: current results
+    :param dict reference: earlier results
+    :return:
+    """
+    print("\nCompared with {}:".format(reference['commit']))
+    for name, result in results['benchmarks'].items():
+        if name not in reference['benchmarks']:
+            continue
+
+        ref = reference['benchmarks'][name]
+        print("{:40s} time {:6.2f}x  memory {:6.2f}x".format(name, result['time'] / ref['time'],
+                                                             result['peak_memory'] / max(ref['peak_memory'], 1)))
+
+
+if __name__ == "__main__":
+    options = options_parse()
+
+    results = {'commit': get_commit(), 'size': options.size, 'benchmarks': {}}
+
+    for name, func in get_benchmarks(options.size, options.legacy):
+        try:
+            result = measure(func, options.repeat)
+        except Exception as e:
+            print("{:40s} failed: {}".format(name, e))
+            continue
+
+        results['benchmarks'][name] = result
+        print("{:40s} {:8.4f} s  {:8.1f} MiB".format(name, result['time'], result['peak_memory'] / 1024 ** 2))
+
+    os.makedirs(options.output_dir, exist_ok=True)
+    output_file = os.path.join(options.output_dir, "{}.json".format(results['commit']))
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print("Results written to {}".format(output_file))
+
+    if options.compare is not None:
+        with open(options.compare) as f:
+            compare(results, json.load(f))
+
+    sys.exit(0)
@@ -0,0 +1,274 @@
+# Reference copies of the original data_loader implementations. The optimized versions in
+# generate_hdf5.data_loader are tested and benchmarked against these.
+
+
+# IMPORTS
+import sys
+import numpy as np
+
+
+def get_thick_slices(img_data, slice_thickness=3):
+    """
+    Function to extract thick slices from the image 
+    (feed slice_thickness preceeding and suceeding slices to network, 
+    label only middle one)
+    :param np.ndarray img_data: 3D MRI image read in with nibabel 
+    :param int slice_thickness: number of slices to stack on top and below slice of interest (default=3) 
+    :return: 
+    """
+    h, w, d = img_data.shape
+    img_data_pad = np.expand_dims(np.pad(img_data, ((0, 0), (0, 0), (slice_thickness, slice_thickness)), mode='edge'),
+                                  axis=3)
+    img_data_thick = np.ndarray((h, w, d, 0), dtype=np.uint8)
+    
+    for slice_idx in range(2 * slice_thickness + 1):
+        img_data_thick = np.append(img_data_thick, img_data_pad[:, :, slice_idx:d + slice_idx, :], axis=3)
+
+    return img_data_thick
+
+
+def map_aparc_aseg2label(aseg, aseg_nocc=None):
+    """
+    Function to perform look-up table mapping of aparc.DKTatlas+aseg.mgz data to label space
+    :param np.ndarray aseg: ground truth aparc+aseg
+    :param None/np.ndarray aseg_nocc: ground truth aseg without corpus callosum segmentation
+    :return:
+    """
+    aseg[aseg > 11000] = 0
+    aseg_temp = aseg.copy()
+    aseg[aseg == 80] = 77  # Hypointensities Class
+    aseg[aseg == 85] = 0  # Optic Chiasma to BKG
+    aseg[aseg == 62] = 41  # Right Vessel to Right GM
+    aseg[aseg == 30] = 2  # Left Vessel to Left GM
+    aseg[aseg == 72] = 24  # 5th Ventricle to CSF
+
+    # If corpus callosum is not removed yet, do it now
+    if aseg_nocc is not None:
+        cc_mask = (aseg >= 251) & (aseg <= 255)
+        aseg[cc_mask] = aseg_nocc[cc_mask]
+
+    aseg[aseg == 3] = 0  # Map Remaining Cortical labels to background
+    aseg[aseg == 42] = 0
+
+    cortical_label_mask = (aseg >= 2000) & (aseg <= 2999)
+    aseg[cortical_label_mask] = aseg[cortical_label_mask] - 1000
+
+    # Preserve Cortical Labels
+    aseg[aseg_temp == 2014] = 2014
+    aseg[aseg_temp == 2028] = 2028
+    aseg[aseg_temp == 2012] = 2012
+    aseg[aseg_temp == 2016] = 2016
+    aseg[aseg_temp == 2002] = 2002
+    aseg[aseg_temp == 2023] = 2023
+    aseg[aseg_temp == 2017] = 2017
+    aseg[aseg_temp == 2024] = 2024
+    aseg[aseg_temp == 2010] = 2010
+    aseg[aseg_temp == 2013] = 2013
+    aseg[aseg_temp == 2025] = 2025
+    aseg[aseg_temp == 2022] = 2022
+    aseg[aseg_temp == 2021] = 2021
+    aseg[aseg_temp == 2005] = 2005
+
+    labels = np.array([0, 2, 4, 5, 7, 8, 10, 11, 12, 13, 14,
+                       15, 16, 17, 18, 24, 26, 28, 31, 41, 43, 44,
+                       46, 47, 49, 50, 51, 52, 53, 54, 58, 60, 63,
+                       77, 1002, 1003, 1005, 1006, 1007, 1008, 1009, 1010, 1011,
+                       1012, 1013, 1014, 1015, 1016, 1017, 1018, 1019, 1020, 1021, 1022,
+                       1023, 1024, 1025, 1026, 1027, 1028, 1029, 1030, 1031, 1034, 1035,
+                       2002, 2005, 2010, 2012, 2013, 2014, 2016, 2017, 2021, 2022, 2023,
+                       2024, 2025, 2028])
+
+    h, w, d = aseg.shape
+    lut_aseg = np.zeros(max(labels) + 1, dtype='int')
+    for idx, value in enumerate(labels):
+        lut_aseg[value] = idx
+
+    # Remap Label Classes - Perform LUT Mapping - Coronal, Axial
+
+    mapped_aseg = lut_aseg.ravel()[aseg.ravel()]
+
+    mapped_aseg = mapped_aseg.reshape((h, w, d))
+
+    # Map Sagittal Labels
+    aseg[aseg == 2] = 41
+    aseg[aseg == 3] = 42
+    aseg[aseg == 4] = 43
+    aseg[aseg == 5] = 44
+    aseg[aseg == 7] = 46
+    aseg[aseg == 8] = 47
+    aseg[aseg == 10] = 49
+    aseg[aseg == 11] = 50
+    aseg[aseg == 12] = 51
+    aseg[aseg == 13] = 52
+    aseg[aseg == 17] = 53
+    aseg[aseg == 18] = 54
+    aseg[aseg == 26] = 58
+    aseg[aseg == 28] = 60
+    aseg[aseg == 31] = 63
+
+    cortical_label_mask = (aseg >= 2000) & (aseg <= 2999)
+    aseg[cortical_label_mask] = aseg[cortical_label_mask] - 1000
+
+    labels_sag = np.array([0, 14, 15, 16, 24, 41, 43, 44, 46, 47, 49,
+                           50, 51, 52, 53, 54, 58, 60, 63, 77, 1002,
+                           1003, 1005, 1006, 1007, 1008, 1009, 1010, 1011, 1012, 1013, 1014,
+                           1015, 1016, 1017, 1018, 1019, 1020, 1021, 1022, 1023, 1024, 1025,
+                           1026, 1027, 1028, 1029, 1030, 1031, 1034, 1035])
+
+    h, w, d = aseg.shape
+    lut_aseg = np.zeros(max(labels_sag) + 1, dtype='int')
+    for idx, value in enumerate(labels_sag):
+        lut_aseg[value] = idx
+
+    # Remap Label Classes - Perform LUT Mapping - Coronal, Axial
+
+    mapped_aseg_sag = lut_aseg.ravel()[aseg.ravel()]
+
+    mapped_aseg_sag = mapped_aseg_sag.reshape((h, w, d))
+
+    return mapped_aseg, mapped_aseg_sag
+
+
+def create_weight_mask(mapped_aseg, max_weight=5, max_edge_weight=5):
+    """
+    Function to create weighted mask - with median frequency balancing and edge-weighting
+    :param mapped_aseg:
+    :param max_weight:
+    :param max_edge_weight:
+    :return:
+    """
+    unique, counts = np.unique(mapped_aseg, return_counts=True)
+
+    # Median Frequency Balancing
+    class_wise_weights = np.median(counts) / counts
+    class_wise_weights[class_wise_weights > max_weight] = max_weight
+    (h, w, d) = mapped_aseg.shape
+
+    weights_mask = np.reshape(class_wise_weights[mapped_aseg.ravel()], (h, w, d))
+
+    # Gradient Weighting
+    (gx, gy, gz) = np.gradient(mapped_aseg)
+    grad_weight = max_edge_weight * np.asarray(np.power(np.power(gx, 2) + np.power(gy, 2) + np.power(gz, 2), 0.5) > 0,
+                                               dtype='float')
+
+    weights_mask += grad_weight
+
+    return weights_mask
+
+
+def map_image(img, out_affine, out_shape, ras2ras=np.array([[1.0, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]]),
+              order=1):
+    """
+    Function to map image to new voxel space (RAS orientation)
+    (img.get_data() replaced by np.asanyarray(img.dataobj), get_data is removed in nibabel 5)
+
+    :param nibabel.MGHImage img: the src 3D image with data and affine set
+    :param np.ndarray out_affine: trg image affine
+    :param np.ndarray out_shape: the trg shape information
+    :param np.ndarray ras2ras: ras2ras an additional maping that should be applied (default=id to just reslice)
+    :param int order: order of interpolation (0=nearest,1=linear(default),2=quadratic,3=cubic)
+    :return: mapped Image data array
+    """
+    from scipy.ndimage import affine_transform
+    from numpy.linalg import inv
+
+    # compute vox2vox from src to trg
+    vox2vox = inv(out_affine) @ ras2ras @ img.affine
+
+    # here we apply the inverse vox2vox (to pull back the src info to the target image)
+    new_data = affine_transform(np.asanyarray(img.dataobj), inv(vox2vox), output_shape=out_shape, order=order)
+    return new_data
+
+
+def getscale(data, dst_min, dst_max, f_low=0.0, f_high=0.999):
+    """
+    Function to get offset and scale of image intensities to robustly rescale to range dst_min..dst_max.
+    Equivalent to how mri_convert conforms images.
+
+    :param np.ndarray data: Image data (intensity values)
+    :param float dst_min: future minimal intensity value
+    :param float dst_max: future maximal intensity value
+    :param f_low: robust cropping at low end (0.0 no cropping)
+    :param f_high: robust cropping at higher end (0.999 crop one thousandths of high intensity voxels)
+    :return: returns (adjusted) src_min and scale factor
+    """
+    # get min and max from source
+    src_min = np.min(data)
+    src_max = np.max(data)
+
+    if src_min < 0.0:
+        sys.exit('ERROR: Min value in input is below 0.0!')
+
+    print("Input:    min: " + format(src_min) + "  max: " + format(src_max))
+
+    if f_low == 0.0 and f_high == 1.0:
+        return src_min, 1.0
+
+    # compute non-zeros and total vox num
+    nz = (np.abs(data) >= 1e-15).sum()
+    voxnum = data.shape[0] * data.shape[1] * data.shape[2]
+
+    # compute histogram
+    histosize = 1000
+    bin_size = (src_max - src_min) / histosize
+    hist, bin_edges = np.histogram(data, histosize)
+
+    # compute cummulative sum
+    cs = np.concatenate(([0], np.cumsum(hist)))
+
+    # get lower limit
+    nth = int(f_low * voxnum)
+    idx = np.where(cs < nth)
+
+    if len(idx[0]) > 0:
+        idx = idx[0][-1] + 1
+
+    else:
+        idx = 0
+
+    src_min = idx * bin_size + src_min
+
+    # print("bin min: "+format(idx)+"  nth: "+format(nth)+"  passed: "+format(cs[idx])+"\n")
+    # get upper limit
+    nth = voxnum - int((1.0 - f_high) * nz)
+    idx = np.where(cs >= nth)
+
+    if len(idx[0]) > 0:
+        idx = idx[0][0] - 2
+
+    else:
+        print('ERROR: rescale upper bound not found')
+
+    src_max = idx * bin_size + src_min
+    # print("bin max: "+format(idx)+"  nth: "+format(nth)+"  passed: "+format(voxnum-cs[idx])+"\n")
+
+    # scale
+    if src_min == src_max:
+        scale = 1.0
+
+    else:
+        scale = (dst_max - dst_min) / (src_max - src_min)
+
+    print("rescale:  min: " + format(src_min) + "  max: " + format(src_max) + "  scale: " + format(scale))
+
+    return src_min, scale
+
+
+def scalecrop(data, dst_min, dst_max, src_min, scale):
+    """
+    Function to crop the intensity ranges to specific min and max values
+
+    :param np.ndarray data: Image data (intensity values)
+    :param float dst_min: future minimal intensity value
+    :param float dst_max: future maximal intensity value
+    :param float src_min: minimal value to consider from source (crops below)
+    :param float scale: scale value by which source will be shifted
+    :return: scaled Image data array
+    """
+    data_new = dst_min + scale * (data - src_min)
+
+    # clip
+    data_new = np.clip(data_new, dst_min, dst_max)
+    print("Output:   min: " + format(data_new.min()) + "  max: " + format(data_new.max()))
+
+    return data_new
@@ -0,0 +1,122 @@
+from unittest import TestCase
+
+import numpy as np
+
+from generate_hdf5.data_loader.augmentation import ToTensor, ToTensorTest, image_to_tensor, AugmentationPadImage, AugmentationRandomCrop, \
+                                                  AugmentationPadCrop, BatchToTensor, BatchAugmentationPadImage, \
+                                                  BatchAugmentationRandomCrop, BatchAugmentationPadCrop, \
+                                                  BatchCollate, crop_edge_padded
+
+
+def compose(transforms):
+    def apply(sample):
+        for transform in transforms:
+            sample = transform(sample)
+        return sample
+
+    return apply
+
+
+class BatchTransformTests(TestCase):
+    """
+    Test the batched transforms against the per-sample transforms.
+    """
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.samples = [{'image': rng.randint(0, 255, size=(20, 24, 7)).astype(np.uint8),
+                         'label': rng.randint(0, 79, size=(20, 24)).astype(np.uint8),
+                         'weight': rng.rand(20, 24).astype(np.float32)} for _ in range(5)]
+
+    def check_batch(self, transforms, batch_transforms):
+        np.random.seed(0)
+        expected = [transforms({'img': s['image'], 'label': s['label'], 'weight': s['weight']}) for s in self.samples]
+
+        np.random.seed(0)
+        batch = BatchCollate(batch_transforms)(self.samples)
+
+        for key, batch_key in [('img', 'image'), ('label', 'label'), ('weight', 'weight')]:
+            np.testing.assert_array_equal(np.stack([np.asarray(e[key]) for e in expected]),
+                                          np.asarray(batch[batch_key]))
+
+    def test_random_crop(self):
+        self.check_batch(compose([AugmentationPadImage(pad_size=8), AugmentationRandomCrop(output_size=(20, 16)),
+                                  ToTensor()]),
+                         compose([BatchAugmentationPadImage(pad_size=8),
+                                  BatchAugmentationRandomCrop(output_size=(20, 16)), BatchToTensor()]))
+
+    def test_center_crop(self):
+        self.check_batch(compose([AugmentationPadImage(pad_size=4), AugmentationRandomCrop(16, 'Center')]),
+                         compose([BatchAugmentationPadImage(pad_size=4), BatchAugmentationRandomCrop(16, 'Center')]))
+
+    def test_to_tensor(self):
+        batch = BatchCollate(BatchToTensor())(self.samples)
+        image = np.asarray(batch['image'])
+
+        self.assertEqual(image.shape, (5, 7, 20, 24))
+        self.assertEqual(image.dtype, np.float32)
+        np.testing.assert_allclose(image[2, 3], self.samples[2]['image'][:, :, 3] / 255.0, rtol=1e-6)
+        np.testing.assert_array_equal(np.asarray(batch['label']), np.stack([s['label'] for s in self.samples]))
+
+    def test_pad_crop(self):
+        self.check_batch(AugmentationPadCrop(pad_size=8, output_size=(20, 16)),
+                         BatchAugmentationPadCrop(pad_size=8, output_size=(20, 16)))
+
+
+class AugmentationPadCropTests(TestCase):
+    """
+    Test the fused pad and crop against AugmentationPadImage followed by AugmentationRandomCrop.
+    """
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.sample = {'img': rng.randint(0, 255, size=(20, 24, 7)).astype(np.uint8),
+                       'label': rng.randint(0, 79, size=(20, 24)).astype(np.uint8),
+                       'weight': rng.rand(20, 24)}
+
+    def test_identical(self):
+        for pad_size, output_size, crop_type in [(16, 24, 'Random'), (((16, 16), (16, 16)), (20, 24), 'Random'),
+                                                 (((3, 9), (12, 0)), (8, 30), 'Random'), (16, 24, 'Center')]:
+            np.random.seed(0)
+            pad_crop = AugmentationPadCrop(pad_size, output_size, crop_type)
+            fused = [pad_crop(self.sample) for _ in range(20)]
+
+            np.random.seed(0)
+            pad, crop = AugmentationPadImage(pad_size), AugmentationRandomCrop(output_size, crop_type)
+            expected = [crop(pad(self.sample)) for _ in range(20)]
+
+            for e, f in zip(expected, fused):
+                for key in ['img', 'label', 'weight']:
+                    np.testing.assert_array_equal(e[key], f[key])
+
+    def test_window_in_padding(self):
+        pad_size = ((10, 10), (10, 10))
+        padded = np.pad(self.sample['img'], pad_size + ((0, 0),), 'edge')
+
+        for top in range(0, 36, 5):
+            for left in range(0, 40, 6):
+                np.testing.assert_array_equal(crop_edge_padded(self.sample['img'], top, left, (4, 5), pad_size),
+                                              padded[top:top + 4, left:left + 5])
+
+
+class ToTensorTests(TestCase):
+    """
+    Test the one-pass normalization against the original cast, divide, clip and transpose.
+    """
+    def test_to_tensor(self):
+        rng = np.random.RandomState(0)
+        img = rng.randint(0, 255, size=(20, 24, 7)).astype(np.uint8)
+
+        for image in [img, rng.rand(20, 24, 7) * 300 - 20]:
+            expected = np.clip(image.astype(np.float32) / 255.0, a_min=0.0, a_max=1.0).transpose((2, 0, 1))
+            tensor = np.asarray(ToTensorTest()(image))
+
+            self.assertEqual(tensor.dtype, np.float32)
+            self.assertTrue(tensor.flags['C_CONTIGUOUS'])
+            np.testing.assert_array_equal(tensor, expected)
+
+        sample = ToTensor()({'img': img, 'label': img[:, :, 0], 'weight': img[:, :, 1] * 0.5})
+        np.testing.assert_array_equal(np.asarray(sample['label']), img[:, :, 0])
+
+        # Reused output buffer
+        out = image_to_tensor(img)
+        self.assertIs(image_to_tensor(img[::-1], out=out), out)
+        np.testing.assert_array_equal(np.asarray(out), np.transpose(img[::-1] / np.float32(255.0), (2, 0, 1)))
@@ -0,0 +1,83 @@
+from unittest import TestCase
+
+import nibabel as nib
+import numpy as np
+
+from generate_hdf5.data_loader.conform import map_image, conform, is_conform, getscale, scalecrop
+from generate_hdf5.tests import legacy_data_loader
+
+
+class ConformTests(TestCase):
+    """
+    Test map_image, getscale and scalecrop against the original implementations and conform of label volumes.
+    """
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        # 2 mm voxels, slightly rotated
+        self.affine = np.array([[-2.0, 0.05, 0.0, 60.0], [0.0, 0.1, 2.0, -50.0], [0.02, -2.0, 0.1, 70.0],
+                                [0.0, 0.0, 0.0, 1.0]])
+        self.out_affine = np.array([[-1.0, 0.0, 0.0, 40.0], [0.0, 0.0, 1.0, -40.0], [0.0, -1.0, 0.0, 40.0],
+                                    [0.0, 0.0, 0.0, 1.0]])
+
+    def test_map_image(self):
+        for dtype in [np.uint8, np.int16, np.float32]:
+            img = nib.MGHImage((self.rng.rand(30, 32, 28) * 250).astype(dtype), self.affine)
+
+            for order in [0, 1, 3]:
+                expected = legacy_data_loader.map_image(img, self.out_affine, (80, 80, 80), order=order)
+
+                for num_threads in [1, 3]:
+                    mapped = map_image(img, self.out_affine, (80, 80, 80), order=order, num_threads=num_threads)
+
+                    self.assertEqual(mapped.dtype, expected.dtype)
+                    np.testing.assert_array_equal(expected, mapped)
+
+    def test_map_image_threads(self):
+        """
+        Test that the threaded slabs are identical to the single-threaded mapping, also on the border of the input.
+        """
+        affine = np.array([[-1.2, 0.05, 0.0, 60.0], [0.0, 0.1, 1.2, -50.0], [0.02, -1.2, 0.1, 70.0],
+                           [0.0, 0.0, 0.0, 1.0]])
+        for dtype in [np.uint8, np.float32]:
+            img = nib.MGHImage((self.rng.rand(60, 64, 56) * 250).astype(dtype), affine)
+
+            for order in [0, 1]:
+                expected = map_image(img, self.out_affine, (80, 80, 80), order=order, num_threads=1)
+
+                for num_threads in [2, 3, 4]:
+                    np.testing.assert_array_equal(
+                        expected, map_image(img, self.out_affine, (80, 80, 80), order=order, num_threads=num_threads))
+
+    def test_conform_label(self):
+        labels = np.array([0, 2, 41, 1002, 2035], dtype=np.int32)
+        img = nib.MGHImage(labels[self.rng.randint(0, 5, size=(30, 32, 28))], self.affine)
+
+        conformed = conform(img, label=True, num_threads=2)
+        data = np.asanyarray(conformed.dataobj)
+
+        self.assertTrue(is_conform(conformed))
+        self.assertEqual(data.dtype, np.int32)
+        self.assertEqual(set(np.unique(data)), set(labels))
+
+    def test_getscale_scalecrop(self):
+        volumes = [self.rng.randint(0, 255, size=(20, 16, 12)).astype(np.uint8),
+                   self.rng.randint(0, 4000, size=(20, 16, 12)).astype('>i2'),
+                   self.rng.randint(0, 60000, size=(20, 16, 12)).astype(np.uint16),
+                   self.rng.randint(0, 100000, size=(20, 16, 12)).astype(np.int32),
+                   self.rng.gamma(2.0, 150.0, size=(20, 16, 12)).astype(np.float32),
+                   self.rng.gamma(2.0, 150.0, size=(20, 16, 12)),
+                   np.full((20, 16, 12), 7, dtype=np.int16)]
+
+        for data in volumes:
+            for f_low, f_high in [(0.0, 0.999), (0.0, 1.0), (0.01, 0.99)]:
+                expected = legacy_data_loader.getscale(data, 0, 255, f_low, f_high)
+                self.assertEqual(expected, getscale(data, 0, 255, f_low, f_high))
+
+            src_min, scale = expected
+            expected = legacy_data_loader.scalecrop(data, 0, 255, src_min, scale)
+            scaled = scalecrop(data, 0, 255, src_min, scale)
+
+            self.assertEqual(expected.dtype, scaled.dtype)
+            np.testing.assert_array_equal(expected, scaled)
+            np.testing.assert_array_equal(np.uint8(np.rint(expected)),
+                                          scalecrop(data, 0, 255, src_min, scale, out=np.empty(data.shape, np.uint8)))
@@ -1,7 +1,15 @@
-
+import os
+import json
+import shutil
+import tempfile
 from unittest import TestCase
-from unittest import mock
+
+import h5py
+import nibabel as nib
+import numpy as np
+
 from generate_hdf5.generate_hdf5 import Generate_hdf5
+from generate_hdf5.tests.bench_data_loader import synthetic_aseg, synthetic_orig
 
 
 class Generate_hdf5Tests(TestCase):
@@ -10,24 +18,138 @@ class Generate_hdf5Tests(TestCase):
     """
     def setUp(self):
         self.app = Generate_hdf5()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.inputdir = os.path.join(self.tmp_dir, 'inputdir')
+        self.outputdir = os.path.join(self.tmp_dir, 'outputdir')
+        self.dataset_name = os.path.join(self.outputdir, 'test.hdf5')
+        os.makedirs(self.outputdir)
+
+        self.subjects = ['sub0', 'sub1', 'sub2']
+        for seed, subject in enumerate(self.subjects):
+            self.make_subject(subject, seed)
+
+        self.params = {'inputdir': self.inputdir, 'image_name': 'mri/orig.mgz',
+                       'gt_name': 'mri/aparc.DKTatlas+aseg.mgz', 'planes': ['axial'], 'slice_thickness': 3}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_subject(self, subject, seed):
+        os.makedirs(os.path.join(self.inputdir, subject, 'mri'))
+        aseg = synthetic_aseg((32, 32, 32), seed)
+        nib.MGHImage(synthetic_orig(aseg, seed), np.eye(4)).to_filename(
+            os.path.join(self.inputdir, subject, 'mri', 'orig.mgz'))
+        nib.MGHImage(aseg, np.eye(4)).to_filename(
+            os.path.join(self.inputdir, subject, 'mri', 'aparc.DKTatlas+aseg.mgz'))
+
+    def break_subject(self, subject):
+        os.remove(os.path.join(self.inputdir, subject, 'mri', 'aparc.DKTatlas+aseg.mgz'))
+
+    def run_app(self, *args):
+        options = self.app.parse_args([self.inputdir, self.outputdir, '--hdf5_name', self.dataset_name] +
+                                      [str(arg) for arg in args])
+        self.app.run(options)
+        return options
+
+    def get_written(self, dataset_name=None):
+        with h5py.File(dataset_name or self.dataset_name, "r") as hf:
+            return [s.decode() for s in hf['subject'][()]], hf['orig_dataset'].shape[0], len(hf['slice_index'])
 
     def test_run(self):
         """
         Test the run code.
         """
-        args = []
-        if self.app.TYPE == 'ds':
-            args.append('inputdir') # you may want to change this inputdir mock
-        args.append('outputdir')  # you may want to change this outputdir mock
+        options = self.run_app()
+        self.assertEqual(options.outputdir, self.outputdir)
 
-        # you may want to add more of your custom defined optional arguments to test
-        # your app with
-        # eg.
-        # args.append('--custom-int')
-        # args.append(10)
+        subjects, num_slices, num_records = self.get_written()
+        self.assertEqual(subjects, self.subjects)
+        self.assertGreater(num_slices, 0)
+        self.assertEqual(num_slices, num_records)
 
-        options = self.app.parse_args(args)
-        self.app.run(options)
+    def test_profile_report(self):
+        """
+        Test that the report and the hdf5-file are written to the given paths, missing directories are created.
+        """
+        self.dataset_name = os.path.join(self.tmp_dir, 'new', 'test.hdf5')
+        report = os.path.join(self.tmp_dir, 'reports', 'profile.json')
+        self.run_app('--profile_report', report)
+
+        self.assertEqual(self.get_written()[0], self.subjects)
+        with open(report) as f:
+            self.assertEqual(json.load(f)['aggregate']['subjects_processed'], 3)
+
+    def test_shards(self):
+        """
+        Test that all subjects are written to the shards and exposed by the master file.
+        """
+        self.run_app('--shard_size', 20)
+
+        subjects, num_slices, num_records = self.get_written()
+        self.assertEqual(subjects, self.subjects)
+        self.assertEqual(num_slices, num_records)
+
+        with h5py.File(self.dataset_name, "r") as hf:
+            self.assertGreater(len(hf.attrs['shards']), 1)
+
+    def test_crop_bbox(self):
+        """
+        Test that cropped slices are written and shards are refused with cropping.
+        """
+        self.run_app('--crop_bbox', '--bbox_buckets', '16,24')
+
+        with h5py.File(self.dataset_name, "r") as hf:
+            self.assertEqual([s.decode() for s in hf['subject'][()]], self.subjects)
+            self.assertEqual(tuple(hf.attrs['frame_shape']), (32, 32))
+            self.assertEqual(sum(hf[bucket]['orig_dataset'].shape[0] for bucket in hf.attrs['buckets']),
+                             len(hf['slice_index']))
+
+        with self.assertRaises(ValueError):
+            self.run_app('--crop_bbox', '--shard_size', 20)
+
+    def test_failing_subject(self):
+        """
+        Test that a failing subject is skipped and the others are written in order (also with a process pool).
+        """
+        self.break_subject('sub1')
+
+        for jobs in [1, 2]:
+            self.run_app('--jobs', jobs)
+            self.assertEqual(self.get_written()[0], ['sub0', 'sub2'])
+
+    def test_invalid_compression_level(self):
+        """
+        Test that an invalid compression level fails before any subject is processed.
+        """
+        with self.assertRaises(ValueError):
+            self.run_app('--compression_level', 15)
+
+        self.assertFalse(os.path.exists(self.dataset_name))
+
+    def test_iter_subjects(self):
+        """
+        Test that the process pool yields the subjects in order, with failures raised for the failing subject only.
+        """
+        self.break_subject('sub1')
+
+        expected = {subject: processed for _, subject, processed in self.app.iter_subjects(['sub0', 'sub2'],
+                                                                                             self.params)}
+        for jobs in [1, 2]:
+            results = []
+            for idx, subject, get_result in self.app.iter_subjects(self.subjects, self.params, jobs, window=2):
+                try:
+                    results.append((idx, subject, get_result()[0]['axial']))
+                except Exception:
+                    results.append((idx, subject, None))
+
+            self.assertEqual([(idx, subject) for idx, subject, _ in results], list(enumerate(self.subjects)))
+            self.assertIsNone(results[1][2])
+
+            for _, subject, processed in [results[0], results[2]]:
+                for stored, computed in zip(expected[subject]()[0]['axial'], processed):
+                    np.testing.assert_array_equal(stored, computed)
 
-        # write your own assertions
-        self.assertEqual(options.outputdir, 'outputdir')
+        # Stopping early does not wait for the remaining subjects to be processed
+        subjects = self.app.iter_subjects(self.subjects * 4, self.params, jobs=2, window=2)
+        next(subjects)[2]()
+        subjects.close()
@@ -0,0 +1,303 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from generate_hdf5.data_loader.hdf5_io import HDF5SliceWriter, HDF5ShardedWriter, encode_weights, decode_weights, \
+                                             get_weight_scale, get_compression_options, get_slice_index_dtype
+from generate_hdf5.data_loader.load_neuroimaging_data import map_aparc_aseg2label, create_weight_mask
+from generate_hdf5.tests.bench_data_loader import synthetic_aseg
+
+
+class HDF5SliceWriterTests(TestCase):
+    """
+    Test HDF5SliceWriter.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'test.hdf5')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_subject(self, num_slices, seed):
+        rng = np.random.RandomState(seed)
+        orig = rng.randint(0, 255, size=(16, 12, num_slices, 7)).astype(np.uint8)
+        aseg = rng.randint(0, 79, size=(16, 12, num_slices))
+        weights = rng.rand(16, 12, num_slices)
+        return orig, aseg, weights
+
+    def test_append(self):
+        """
+        Test that subjects are appended in order as N, H, W, (C) datasets.
+        """
+        subjects = [self.make_subject(3, 0), self.make_subject(5, 1)]
+
+        with HDF5SliceWriter(self.filename) as writer:
+            for idx, (orig, aseg, weights) in enumerate(subjects):
+                writer.append(orig, aseg, weights, 'sub{}'.format(idx))
+
+        with h5py.File(self.filename, "r") as hf:
+            self.assertEqual(hf['orig_dataset'].shape, (8, 16, 12, 7))
+            self.assertEqual(hf['aseg_dataset'].dtype, np.uint8)
+            np.testing.assert_array_equal(hf['orig_dataset'][3:], np.transpose(subjects[1][0], (2, 0, 1, 3)))
+            np.testing.assert_array_equal(hf['aseg_dataset'][:3], np.transpose(subjects[0][1], (2, 0, 1)))
+            np.testing.assert_array_equal(hf['weight_dataset'][3:], np.transpose(subjects[1][2], (2, 0, 1)))
+            self.assertEqual(list(hf['subject'][()]), [b'sub0', b'sub1'])
+
+    def test_weight_dtype(self):
+        """
+        Test that compactly stored weights decode to (close to) the original weights, including the small median
+        frequency weights of create_weight_mask.
+        """
+        orig, _, _ = self.make_subject(32, 0)
+        aseg = np.transpose(synthetic_aseg((32, 32, 32)), (1, 2, 0))
+        aseg = map_aparc_aseg2label(aseg, plane='coronal')[0].astype(np.uint8)
+        weights = create_weight_mask(aseg, dtype=np.float64)[:16, :12]
+        aseg = aseg[:16, :12]
+        self.assertLess(weights.min(), 10 / 255.0 / 2)
+
+        for weight_dtype, tolerance in [('float32', 1e-6), ('float16', 1e-3), ('uint8', 0.023)]:
+            with HDF5SliceWriter(self.filename, weight_dtype=weight_dtype, weight_max=10.0) as writer:
+                writer.append(orig, aseg, weights, 'sub0')
+
+            with h5py.File(self.filename, "r") as hf:
+                self.assertEqual(hf['weight_dataset'].dtype, np.dtype(weight_dtype))
+                decoded = decode_weights(hf['weight_dataset'][()], *get_weight_scale(hf['weight_dataset']))
+
+            np.testing.assert_allclose(decoded, np.transpose(weights, (2, 0, 1)), rtol=tolerance)
+
+        with h5py.File(self.filename, "r") as hf:
+            self.assertEqual(get_weight_scale(hf['weight_dataset'])[2], 'log')
+            self.assertGreater(hf['weight_dataset'][()].min(), 0)
+
+        # Linearly quantized weights (files written before the log quantization) still decode
+        linear = encode_weights(weights, 'uint8', 10 / 255.0, 0.0)
+        np.testing.assert_allclose(decode_weights(linear, 10 / 255.0, 0.0), weights, atol=10 / 255.0 / 2)
+
+    def test_chunks_and_compression(self):
+        """
+        Test the per-slice chunk layout and the compression options.
+        """
+        orig, aseg, weights = self.make_subject(4, 0)
+
+        with HDF5SliceWriter(self.filename) as writer:
+            writer.append(orig, aseg, weights, 'sub0')
+
+        with h5py.File(self.filename, "r") as hf:
+            self.assertEqual(hf['orig_dataset'].chunks, (1, 16, 12, 7))
+            self.assertEqual(hf['aseg_dataset'].chunks, (1, 16, 12))
+            self.assertEqual(hf['orig_dataset'].compression, 'gzip')
+
+        with HDF5SliceWriter(self.filename, compression_options=get_compression_options('lzf', shuffle=True),
+                             chunk_slices=2) as writer:
+            writer.append(orig, aseg, weights, 'sub0')
+
+        with h5py.File(self.filename, "r") as hf:
+            self.assertEqual(hf['weight_dataset'].chunks, (2, 16, 12))
+            self.assertEqual(hf['weight_dataset'].compression, 'lzf')
+            self.assertTrue(hf['weight_dataset'].shuffle)
+            np.testing.assert_array_equal(hf['orig_dataset'][()], np.transpose(orig, (2, 0, 1, 3)))
+
+        # Invalid levels are rejected before any dataset is written
+        with self.assertRaises(ValueError):
+            get_compression_options('gzip', 15)
+
+    def test_append_mode(self):
+        """
+        Test appending to an existing file and the attribute check.
+        """
+        subjects = [self.make_subject(3, 0), self.make_subject(5, 1)]
+        attrs = {'plane': 'axial', 'slice_thickness': 3}
+
+        with HDF5SliceWriter(self.filename, attrs=attrs) as writer:
+            writer.append(*subjects[0], 'sub0')
+
+        with HDF5SliceWriter(self.filename, "a", attrs=attrs) as writer:
+            self.assertEqual(writer.get_subjects(), ['sub0'])
+            self.assertEqual(writer.num_slices, 3)
+            writer.append(*subjects[1], 'sub1')
+
+        with h5py.File(self.filename, "r") as hf:
+            self.assertEqual(hf['orig_dataset'].shape[0], 8)
+            self.assertEqual(list(hf['subject'][()]), [b'sub0', b'sub1'])
+
+        with self.assertRaises(ValueError):
+            HDF5SliceWriter(self.filename, "a", attrs=dict(attrs, plane='coronal'))
+
+        with self.assertRaises(ValueError):
+            with HDF5SliceWriter(self.filename, "a", attrs=attrs) as writer:
+                orig, aseg, weights = subjects[0]
+                writer.append(orig[:8], aseg[:8], weights[:8], 'sub2')
+
+        with h5py.File(self.filename, "r") as hf:
+            self.assertEqual(hf['orig_dataset'].shape[0], 8)
+
+    def test_buffer_slices(self):
+        """
+        Test that writing in blocks of buffer_slices gives the same datasets.
+        """
+        orig, aseg, weights = self.make_subject(5, 0)
+
+        with HDF5SliceWriter(self.filename, weight_dtype='uint8', buffer_slices=2) as writer:
+            writer.append(orig, aseg, weights, 'sub0')
+            writer.append(orig, aseg, weights, 'sub1')
+
+        with h5py.File(self.filename, "r") as hf:
+            self.assertEqual(hf['orig_dataset'].shape[0], 10)
+            np.testing.assert_array_equal(hf['orig_dataset'][5:], np.transpose(orig, (2, 0, 1, 3)))
+            np.testing.assert_array_equal(hf['aseg_dataset'][:5], np.transpose(aseg, (2, 0, 1)))
+            decoded = decode_weights(hf['weight_dataset'][5:], *get_weight_scale(hf['weight_dataset']))
+
+        np.testing.assert_allclose(decoded, np.transpose(weights, (2, 0, 1)), rtol=0.023, atol=1e-4)
+
+    def test_slice_index(self):
+        """
+        Test that the slice index records get the subject id and files without index are appended to without one.
+        """
+        orig, aseg, weights = self.make_subject(3, 0)
+        slice_index = np.zeros(3, dtype=get_slice_index_dtype(79))
+        slice_index['slice_idx'] = [4, 5, 9]
+
+        with HDF5SliceWriter(self.filename, num_classes=79) as writer:
+            writer.append(orig, aseg, weights, 'sub0', slice_index)
+            writer.append(orig, aseg, weights, 'sub1', slice_index)
+
+            with self.assertRaises(ValueError):
+                writer.append(orig, aseg, weights, 'sub2', slice_index[:2])
+
+            with self.assertRaises(ValueError):
+                writer.append(orig, aseg, weights, 'sub2')
+
+        with h5py.File(self.filename, "r") as hf:
+            self.assertEqual(hf['slice_index'].attrs['num_classes'], 79)
+            self.assertEqual(hf['slice_index'].dtype['class_mask'].shape, (10,))
+            np.testing.assert_array_equal(hf['slice_index']['subject_id'], [0, 0, 0, 1, 1, 1])
+            np.testing.assert_array_equal(hf['slice_index']['slice_idx'], [4, 5, 9, 4, 5, 9])
+
+        with HDF5SliceWriter(self.filename) as writer:
+            writer.append(orig, aseg, weights, 'sub0')
+
+        with HDF5SliceWriter(self.filename, "a") as writer:
+            writer.append(orig, aseg, weights, 'sub1', slice_index)
+
+        with h5py.File(self.filename, "r") as hf:
+            self.assertEqual(hf['orig_dataset'].shape[0], 6)
+            self.assertNotIn('slice_index', hf)
+
+    def test_buckets(self):
+        """
+        Test that cropped slices are appended to the group of their size and the slice index records where.
+        """
+        slice_index = np.zeros(3, dtype=get_slice_index_dtype(79, cropped=True))
+        slice_index['crop_top'] = 2
+
+        with HDF5SliceWriter(self.filename, num_classes=79) as writer:
+            for idx, crop in enumerate([(8, 8), (10, 6), (8, 8)]):
+                orig, aseg, weights = [data[:crop[0], :crop[1]] for data in self.make_subject(3, idx)]
+                writer.append(orig, aseg, weights, 'sub{}'.format(idx), slice_index, frame_shape=(16, 12))
+
+            with self.assertRaises(ValueError):
+                writer.append(orig, aseg, weights, 'sub3')
+
+            with self.assertRaises(ValueError):
+                writer.append(orig, aseg, weights, 'sub3', slice_index, frame_shape=(20, 12))
+
+        with HDF5SliceWriter(self.filename, "a") as writer:
+            self.assertEqual(writer.num_slices, 9)
+
+        with h5py.File(self.filename, "r") as hf:
+            self.assertEqual(list(hf.attrs['buckets']), ['bucket_8x8', 'bucket_10x6'])
+            self.assertEqual(tuple(hf.attrs['frame_shape']), (16, 12))
+            self.assertEqual(hf['bucket_8x8/orig_dataset'].shape, (6, 8, 8, 7))
+            self.assertEqual(hf['bucket_10x6/aseg_dataset'].shape, (3, 10, 6))
+            np.testing.assert_array_equal(hf['slice_index']['bucket'], [0, 0, 0, 1, 1, 1, 0, 0, 0])
+            np.testing.assert_array_equal(hf['slice_index']['bucket_slice'], [0, 1, 2, 0, 1, 2, 3, 4, 5])
+            np.testing.assert_array_equal(hf['slice_index']['subject_id'], [0, 0, 0, 1, 1, 1, 2, 2, 2])
+
+
+class HDF5ShardedWriterTests(TestCase):
+    """
+    Test HDF5ShardedWriter.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'test.hdf5')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_subject(self, num_slices, seed):
+        rng = np.random.RandomState(seed)
+        orig = rng.randint(0, 255, size=(16, 12, num_slices, 7)).astype(np.uint8)
+        aseg = rng.randint(0, 79, size=(16, 12, num_slices))
+        weights = rng.rand(16, 12, num_slices) * 10
+        return orig, aseg, weights
+
+    def test_shards(self):
+        """
+        Test that subjects are not split across shards and the master file reads like a single file.
+        """
+        subjects = [self.make_subject(3, 0), self.make_subject(5, 1), self.make_subject(8, 2), self.make_subject(2, 3)]
+
+        with HDF5ShardedWriter(self.filename, shard_size=6, weight_dtype='uint8', attrs={'plane': 'axial'},
+                               num_classes=79) as writer:
+            for idx, subject in enumerate(subjects):
+                slice_index = np.zeros(subject[0].shape[2], dtype=get_slice_index_dtype(79))
+                class_counts = np.full((subject[0].shape[2], 79), idx, dtype=np.uint32)
+                writer.append(*subject, 'sub{}'.format(idx), slice_index, class_counts, None)
+
+            # Cropped slices are not sharded
+            with self.assertRaises(ValueError):
+                writer.append(*subjects[0], 'sub4', slice_index, class_counts, (20, 16))
+
+        with h5py.File(self.filename, "r") as hf:
+            self.assertEqual(list(hf.attrs['shards']), ['test_shard000.hdf5', 'test_shard001.hdf5',
+                                                        'test_shard002.hdf5', 'test_shard003.hdf5'])
+            self.assertEqual(hf.attrs['plane'], 'axial')
+            self.assertTrue(hf['orig_dataset'].is_virtual)
+            self.assertEqual(hf['orig_dataset'].shape, (18, 16, 12, 7))
+            self.assertEqual(list(hf['subject'][()]), [b'sub0', b'sub1', b'sub2', b'sub3'])
+            # Subject ids count over all shards
+            np.testing.assert_array_equal(hf['slice_index']['subject_id'], np.repeat([0, 1, 2, 3], [3, 5, 8, 2]))
+            self.assertEqual(hf['slice_index'].attrs['num_classes'], 79)
+            np.testing.assert_array_equal(hf['class_counts'][:, 0], np.repeat([0, 1, 2, 3], [3, 5, 8, 2]))
+
+            np.testing.assert_array_equal(hf['orig_dataset'][()],
+                                          np.concatenate([np.transpose(s[0], (2, 0, 1, 3)) for s in subjects]))
+            np.testing.assert_array_equal(hf['aseg_dataset'][()],
+                                          np.concatenate([np.transpose(s[1], (2, 0, 1)) for s in subjects]))
+            decoded = decode_weights(hf['weight_dataset'][()], *get_weight_scale(hf['weight_dataset']))
+
+        np.testing.assert_allclose(decoded, np.concatenate([np.transpose(s[2], (2, 0, 1)) for s in subjects]),
+                                   rtol=0.023, atol=1e-4)
+
+        # The subject with 8 slices is written to a shard of its own
+        with h5py.File(os.path.join(self.tmp_dir, 'test_shard002.hdf5'), "r") as hf:
+            self.assertEqual(hf['orig_dataset'].shape[0], 8)
+
+    def test_relative_paths(self):
+        """
+        Test that the master file still reads after moving it together with the shards.
+        """
+        orig, aseg, weights = self.make_subject(4, 0)
+
+        with HDF5ShardedWriter(self.filename, shard_size=4) as writer:
+            writer.append(orig, aseg, weights, 'sub0')
+            writer.append(orig, aseg, weights, 'sub1')
+
+            with self.assertRaises(ValueError):
+                writer.append(orig[:8], aseg[:8], weights[:8], 'sub2')
+
+        moved_dir = os.path.join(self.tmp_dir, 'moved')
+        os.makedirs(moved_dir)
+        for name in os.listdir(self.tmp_dir):
+            if name.endswith('.hdf5'):
+                shutil.move(os.path.join(self.tmp_dir, name), moved_dir)
+
+        with h5py.File(os.path.join(moved_dir, 'test.hdf5'), "r") as hf:
+            self.assertEqual(hf['orig_dataset'].shape[0], 8)
+            np.testing.assert_array_equal(hf['orig_dataset'][4:], np.transpose(orig, (2, 0, 1, 3)))
@@ -0,0 +1,355 @@
+import os
+import pickle
+import shutil
+import tempfile
+from unittest import TestCase
+
+import nibabel as nib
+import numpy as np
+
+from generate_hdf5.data_loader.hdf5_io import HDF5SliceWriter, HDF5ShardedWriter, get_class_presence
+from generate_hdf5.data_loader.load_neuroimaging_data import map_aparc_aseg2label, get_thick_slices, \
+                                                          create_weight_mask, load_volume, filter_blank_slices_thick, \
+                                                          get_slice_index, get_slice_class_counts, get_crop_window, \
+                                                          get_head_mask, AsegDatasetWithAugmentation, OrigDataThickSlices
+from generate_hdf5.tests import legacy_data_loader
+
+# aparc.DKTatlas+aseg labels, including the ones remapped or removed by map_aparc_aseg2label
+ASEG_LABELS = [0, 2, 3, 4, 5, 7, 8, 10, 11, 12, 13, 14, 15, 16, 17, 18, 24, 26, 28, 30, 31, 41, 42, 43, 44, 46, 47,
+               49, 50, 51, 52, 53, 54, 58, 60, 62, 63, 72, 77, 80, 85, 251, 252, 253, 254, 255, 12000] + \
+              list(range(1002, 1036)) + list(range(2002, 2036))
+
+
+class LoadVolumeTests(TestCase):
+    """
+    Test load_volume against get_fdata cast to the target dtype.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.aseg = rng.choice(ASEG_LABELS, size=(12, 10, 8)).astype(np.int32)
+        self.orig = rng.randint(0, 255, size=(12, 10, 8)).astype(np.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_formats(self):
+        for ext in ['.mgz', '.mgh', '.nii', '.nii.gz']:
+            image_class = nib.MGHImage if ext.startswith('.mg') else nib.Nifti1Image
+
+            for name, data, dtype in [('aseg', self.aseg, np.int32), ('orig', self.orig, np.uint8)]:
+                filename = os.path.join(self.tmp_dir, name + ext)
+                image_class(data, np.eye(4)).to_filename(filename)
+
+                for target in [dtype, np.uint8, np.int32]:
+                    expected = np.asarray(nib.load(filename).get_fdata(), dtype=target)
+                    loaded = load_volume(filename, target)
+
+                    self.assertEqual(loaded.dtype, np.dtype(target))
+                    self.assertTrue(loaded.dtype.isnative)
+                    np.testing.assert_array_equal(expected, loaded)
+
+    def test_scaled(self):
+        image = nib.Nifti1Image(np.arange(960, dtype=np.int16).reshape(12, 10, 8), np.eye(4))
+        image.header.set_slope_inter(0.5, 2.0)
+        filename = os.path.join(self.tmp_dir, 'scaled.nii.gz')
+        image.to_filename(filename)
+
+        np.testing.assert_array_equal(np.asarray(nib.load(filename).get_fdata(), dtype=np.int32),
+                                      load_volume(filename, np.int32))
+
+
+class MapAparcAseg2LabelTests(TestCase):
+    """
+    Test map_aparc_aseg2label against the original implementation.
+    """
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.aseg = rng.choice(ASEG_LABELS, size=(32, 32, 32)).astype(np.int32)
+        self.aseg_nocc = rng.choice(ASEG_LABELS[:40], size=(32, 32, 32)).astype(np.int32)
+
+    def assert_identical(self, expected, mapped):
+        self.assertEqual(expected.dtype, mapped.dtype)
+        np.testing.assert_array_equal(expected, mapped)
+
+    def test_both_planes(self):
+        expected, expected_sag = legacy_data_loader.map_aparc_aseg2label(self.aseg.copy())
+        mapped, mapped_sag = map_aparc_aseg2label(self.aseg)
+
+        self.assert_identical(expected, mapped)
+        self.assert_identical(expected_sag, mapped_sag)
+
+    def test_single_plane(self):
+        expected, expected_sag = legacy_data_loader.map_aparc_aseg2label(self.aseg.copy())
+
+        mapped, mapped_sag = map_aparc_aseg2label(self.aseg, plane='axial')
+        self.assert_identical(expected, mapped)
+        self.assertIsNone(mapped_sag)
+
+        mapped, mapped_sag = map_aparc_aseg2label(self.aseg, plane='sagittal')
+        self.assertIsNone(mapped)
+        self.assert_identical(expected_sag, mapped_sag)
+
+    def test_corpus_callosum(self):
+        expected, expected_sag = legacy_data_loader.map_aparc_aseg2label(self.aseg.copy(), self.aseg_nocc)
+        mapped, mapped_sag = map_aparc_aseg2label(self.aseg, self.aseg_nocc)
+
+        self.assert_identical(expected, mapped)
+        self.assert_identical(expected_sag, mapped_sag)
+
+
+class GetThickSlicesTests(TestCase):
+    """
+    Test get_thick_slices against the original implementation.
+    """
+    def test_thick_slices(self):
+        img = np.random.RandomState(0).randint(0, 255, size=(20, 16, 12)).astype(np.uint8)
+
+        for slice_thickness in [0, 1, 3]:
+            expected = legacy_data_loader.get_thick_slices(img, slice_thickness)
+            thick = get_thick_slices(img, slice_thickness)
+
+            self.assertEqual(expected.dtype, thick.dtype)
+            np.testing.assert_array_equal(expected, thick)
+
+    def test_transposed_input(self):
+        img = np.random.RandomState(0).rand(20, 16, 12) * 255
+        img = np.moveaxis(img, [0, 1, 2], [1, 2, 0])
+
+        expected = legacy_data_loader.get_thick_slices(img, 3)
+        thick = get_thick_slices(img, 3)
+
+        self.assertEqual(expected.dtype, thick.dtype)
+        np.testing.assert_array_equal(expected, thick)
+
+
+class OrigDataThickSlicesTests(TestCase):
+    """
+    Test the lazy thick slices of OrigDataThickSlices against the eager ones.
+    """
+    def test_lazy(self):
+        orig = np.random.RandomState(0).randint(0, 255, size=(10, 12, 8)).astype(np.uint8)
+
+        for plane in ['Axial', 'Coronal', 'Sagittal']:
+            eager = OrigDataThickSlices('orig.mgz', orig, plane, 3)
+            lazy = OrigDataThickSlices('orig.mgz', orig, plane, 3, lazy=True)
+
+            self.assertEqual(len(eager), len(lazy))
+            for index in list(range(len(eager))) + [-1, -len(eager)]:
+                np.testing.assert_array_equal(eager[index]['image'], lazy[index]['image'])
+
+            for index in [len(eager), -len(eager) - 1]:
+                for dataset in [eager, lazy]:
+                    with self.assertRaises(IndexError):
+                        dataset[index]
+
+
+class CreateWeightMaskTests(TestCase):
+    """
+    Test create_weight_mask against the original implementation.
+    """
+    def setUp(self):
+        # Blocks of labels (all labels present), so there are edges and homogeneous regions
+        rng = np.random.RandomState(0)
+        blocks = np.resize(rng.permutation(79), (8, 6, 5))
+        self.mapped_aseg = np.kron(blocks, np.ones((3, 3, 3), dtype=np.int64))
+
+    def test_float64(self):
+        for mapped_aseg in [self.mapped_aseg, self.mapped_aseg.astype(np.uint8),
+                            np.moveaxis(self.mapped_aseg.astype(np.uint8), [0, 1, 2], [1, 2, 0])]:
+            expected = legacy_data_loader.create_weight_mask(mapped_aseg)
+            weights = create_weight_mask(mapped_aseg, dtype=np.float64)
+
+            self.assertEqual(weights.dtype, np.float64)
+            np.testing.assert_array_equal(expected, weights)
+
+    def test_float32(self):
+        expected = legacy_data_loader.create_weight_mask(self.mapped_aseg)
+        weights = create_weight_mask(self.mapped_aseg.astype(np.uint8))
+
+        self.assertEqual(weights.dtype, np.float32)
+        np.testing.assert_allclose(weights, expected, rtol=1e-6)
+
+    def test_small_axes(self):
+        mapped_aseg = np.random.RandomState(0).randint(0, 3, size=(2, 5, 4))
+        np.testing.assert_array_equal(legacy_data_loader.create_weight_mask(mapped_aseg),
+                                      create_weight_mask(mapped_aseg, dtype=np.float64))
+
+        with self.assertRaises(ValueError):
+            create_weight_mask(mapped_aseg[:, :, :1])
+
+
+class SliceIndexTests(TestCase):
+    """
+    Test the slice indices of filter_blank_slices_thick and get_slice_index.
+    """
+    def test_slice_index(self):
+        label_vol = np.zeros((16, 12, 6), dtype=np.uint8)
+        label_vol[2:10, 3:9, 1] = 3
+        label_vol[:, :, 4] = 12
+        label_vol[0, 0, 4] = 0
+        img_vol = get_thick_slices(np.zeros((16, 12, 6), dtype=np.uint8), 3)
+
+        _, kept, _, slice_idx = filter_blank_slices_thick(img_vol, label_vol, label_vol, return_index=True)
+        np.testing.assert_array_equal(slice_idx, [1, 4])
+
+        slice_index = get_slice_index(kept, slice_idx, 13)
+        np.testing.assert_array_equal(slice_index['slice_idx'], [1, 4])
+        np.testing.assert_array_equal(slice_index['foreground'], [48, 191])
+        np.testing.assert_array_equal(np.flatnonzero(get_class_presence(slice_index, 13)[0]), [0, 3])
+        np.testing.assert_array_equal(np.flatnonzero(get_class_presence(slice_index, 13)[1]), [0, 12])
+
+        with self.assertRaises(ValueError):
+            get_slice_index(kept, slice_idx, 12)
+
+
+class GetCropWindowTests(TestCase):
+    """
+    Test the bounding box crop windows of get_crop_window.
+    """
+    def test_crop_window(self):
+        label_vol = np.zeros((64, 48, 5), dtype=np.uint8)
+        label_vol[20:30, 2:12, 1] = 4
+
+        # Centered on the box, moved inside the frame, full frame when larger than all buckets
+        self.assertEqual(get_crop_window(label_vol, 2, [8, 16, 32]), (17, 0, 16, 16))
+        label_vol[20:30, 2:40, 3] = 4
+        self.assertEqual(get_crop_window(label_vol, 2, [8, 16]), (17, 0, 16, 48))
+        self.assertEqual(get_crop_window(np.zeros_like(label_vol), 2, [8, 16]), (0, 0, 64, 48))
+
+        # The window holds the box plus margin (clipped to the frame)
+        rng = np.random.RandomState(0)
+        for _ in range(50):
+            label_vol[:] = 0
+            rows, cols = np.sort(rng.randint(0, 64, 2)), np.sort(rng.randint(0, 48, 2))
+            label_vol[rows[0]:rows[1] + 1, cols[0]:cols[1] + 1, rng.randint(0, 5)] = 1
+            top, left, height, width = get_crop_window(label_vol, 3, [16, 24, 32])
+
+            self.assertLessEqual(top, max(rows[0] - 3, 0))
+            self.assertGreaterEqual(top + height, min(rows[1] + 4, 64))
+            self.assertLessEqual(left, max(cols[0] - 3, 0))
+            self.assertGreaterEqual(left + width, min(cols[1] + 4, 48))
+
+        # The window holds the non-zero image voxels as well
+        label_vol[:] = 0
+        label_vol[20:30, 2:12, 1] = 4
+        image_vol = np.zeros_like(label_vol)
+        image_vol[10:12, 8:10, 0] = 50
+        self.assertEqual(get_crop_window(label_vol, 2, [8, 16, 32], image_vol), (4, 0, 32, 16))
+
+        with self.assertRaises(ValueError):
+            get_crop_window(label_vol, 0)
+
+    def test_head_mask(self):
+        # Head in background noise up to 8 with two isolated artefacts above the threshold
+        rng = np.random.RandomState(0)
+        image_vol = rng.randint(0, 9, size=(64, 48, 5)).astype(np.uint8)
+        image_vol[14:34, 2:20, 1:4] = 60
+        image_vol[[0, 60], [40, 5], [0, 4]] = 200
+        label_vol = np.zeros_like(image_vol)
+        label_vol[20:30, 4:12, 2] = 4
+
+        head = get_head_mask(image_vol, 10)
+        self.assertEqual(head.dtype, bool)
+        np.testing.assert_array_equal(head, image_vol == 60)
+        self.assertFalse(np.any(get_head_mask(image_vol, 200)))
+
+        # The noise grows the window to the full frame, the head mask does not
+        self.assertEqual(get_crop_window(label_vol, 2, [8, 16, 32], image_vol), (0, 0, 64, 48))
+        self.assertEqual(get_crop_window(label_vol, 2, [8, 16, 32], head), (8, 0, 32, 32))
+
+
+class AsegDatasetWithAugmentationTests(TestCase):
+    """
+    Test lazy reading of AsegDatasetWithAugmentation.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.params = {'dataset_name': os.path.join(self.tmp_dir, 'test.hdf5'), 'plane': 'axial'}
+
+        rng = np.random.RandomState(0)
+        self.subjects = [(rng.randint(0, 255, size=(16, 12, 4, 7)).astype(np.uint8),
+                          rng.randint(0, 79, size=(16, 12, 4)), rng.rand(16, 12, 4), subject)
+                         for subject in ['sub0', 'sub1']]
+
+        with HDF5SliceWriter(self.params['dataset_name']) as writer:
+            for subject in self.subjects:
+                writer.append(*subject)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lazy(self):
+        eager = AsegDatasetWithAugmentation(self.params)
+        lazy = AsegDatasetWithAugmentation(dict(self.params, lazy=True))
+
+        self.assertEqual(len(eager), len(lazy))
+        np.testing.assert_array_equal(eager.get_subject_names(), lazy.get_subject_names())
+
+        for index in [0, 5, 7]:
+            for key in ['image', 'label', 'weight']:
+                np.testing.assert_array_equal(eager[index][key], lazy[index][key])
+
+        # The open file is not pickled (spawned DataLoader workers), the copy opens its own
+        lazy_copy = pickle.loads(pickle.dumps(lazy))
+        np.testing.assert_array_equal(eager[3]['image'], lazy_copy[3]['image'])
+
+    def test_sharded(self):
+        sharded_params = dict(self.params, dataset_name=os.path.join(self.tmp_dir, 'sharded.hdf5'))
+        with HDF5ShardedWriter(sharded_params['dataset_name'], shard_size=4, weight_dtype='float32') as writer:
+            for subject in self.subjects:
+                writer.append(*subject)
+
+        single = AsegDatasetWithAugmentation(self.params)
+        for params in [sharded_params, dict(sharded_params, lazy=True)]:
+            sharded = AsegDatasetWithAugmentation(params)
+
+            self.assertEqual(len(single), len(sharded))
+            np.testing.assert_array_equal(single.get_subject_names(), sharded.get_subject_names())
+
+            for index in [0, 5, 7]:
+                np.testing.assert_array_equal(single[index]['image'], sharded[index]['image'])
+                np.testing.assert_array_equal(single[index]['label'], sharded[index]['label'])
+                np.testing.assert_allclose(single[index]['weight'], sharded[index]['weight'], rtol=1e-6)
+
+    def test_cropped(self):
+        # Background weights not exact in float16 and uint8, the weight outside of the crop has to be stored alike
+        for weight_dtype, weight_fill in [('float64', 1.0), ('float16', 3.175e-4), ('uint8', 3.175e-4)]:
+            self.check_cropped(weight_dtype, weight_fill)
+
+    def check_cropped(self, weight_dtype, weight_fill):
+        cropped_params = dict(self.params, dataset_name=os.path.join(self.tmp_dir, 'cropped.hdf5'))
+        full_params = dict(self.params, dataset_name=os.path.join(self.tmp_dir, 'full.hdf5'))
+
+        # Labels in a different box per subject, intensities in a box one voxel larger (skull)
+        subjects = []
+        for idx, (top, left) in enumerate([(2, 3), (7, 1)]):
+            orig, aseg, weights, subject = self.subjects[idx]
+            aseg = np.zeros_like(aseg)
+            aseg[top:top + 5, left:left + 6] = self.subjects[idx][1][top:top + 5, left:left + 6] % 3 + 1
+            weights = np.where(aseg > 0, weights + 1, weight_fill)
+            head = np.zeros(orig.shape, dtype=np.uint8)
+            head[top - 1:top + 6, left - 1:left + 7] = 1
+            subjects.append((orig * head, aseg, weights, subject))
+
+        with HDF5SliceWriter(full_params['dataset_name'], weight_dtype=weight_dtype) as full_writer, \
+                HDF5SliceWriter(cropped_params['dataset_name'], weight_dtype=weight_dtype, num_classes=4) as writer:
+            for orig, aseg, weights, subject in subjects:
+                full_writer.append(orig, aseg, weights, subject)
+
+                top, left, height, width = get_crop_window(aseg, 1, [8, 10], orig.max(axis=3))
+                self.assertEqual((height, width), (10, 10))
+                window = (slice(top, top + height), slice(left, left + width))
+                slice_index = get_slice_index(aseg, np.arange(4), 4, get_slice_class_counts(aseg, 4),
+                                              (top, left, weight_fill))
+                writer.append(orig[window], aseg[window], weights[window], subject, slice_index,
+                              frame_shape=aseg.shape[:2])
+
+        full = AsegDatasetWithAugmentation(full_params)
+        for params in [cropped_params, dict(cropped_params, lazy=True)]:
+            cropped = AsegDatasetWithAugmentation(params)
+            self.assertEqual(len(full), len(cropped))
+
+            for index in range(len(full)):
+                for key in ['image', 'label', 'weight']:
+                    np.testing.assert_array_equal(full[index][key], cropped[index][key])
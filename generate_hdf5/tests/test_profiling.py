@@ -0,0 +1,62 @@
+from unittest import TestCase, skipIf
+
+import numpy as np
+
+from generate_hdf5.data_loader.profiling import StageTimer, ProfileReport, get_peak_rss
+
+
+class ProfileReportTests(TestCase):
+    """
+    Test StageTimer and ProfileReport.
+    """
+    def test_stage_timer(self):
+        timer = StageTimer()
+
+        for _ in range(2):
+            with timer.stage('decode'):
+                pass
+        timer.add('write', 1.5)
+        timer.count('axial_slices_kept', 3)
+        timer.count('axial_slices_kept', 2)
+
+        profile = timer.as_dict()
+        self.assertEqual(list(profile['stages']), ['decode', 'write'])
+        self.assertEqual(profile['stages']['write'], 1.5)
+        self.assertEqual(profile['counts'], {'axial_slices_kept': 5})
+
+    @skipIf(get_peak_rss() is None, "peak memory not available")
+    def test_peak_rss_increase(self):
+        timer = StageTimer()
+        size = get_peak_rss() + 64 * 1024 ** 2
+
+        # The stage raising the peak gets the increase, a later smaller stage does not
+        with timer.stage('large'):
+            np.ones(size, dtype=np.uint8)
+        with timer.stage('small'):
+            np.ones(1024, dtype=np.uint8)
+
+        increase = timer.as_dict()['peak_rss_increase']
+        self.assertGreater(increase['large'], 32 * 1024 ** 2)
+        self.assertEqual(increase['small'], 0)
+
+    def test_aggregate(self):
+        report = ProfileReport()
+        report.add_subject('sub0', {'stages': {'decode': 1.0, 'write': 3.0}, 'counts': {'axial_slices_kept': 4},
+                                    'peak_rss_increase': {'decode': 10, 'write': 0}})
+        report.add_subject('sub1', {'stages': {'decode': 3.0, 'write': 1.0}, 'counts': {'axial_slices_kept': 6},
+                                    'peak_rss_increase': {'decode': 20, 'write': 5}})
+        report.add_subject('sub2', None, error='missing orig.mgz')
+
+        summary = report.aggregate()
+        self.assertEqual(summary['subjects_processed'], 2)
+        self.assertEqual(summary['subjects_failed'], 1)
+        self.assertEqual(summary['stages'], {'decode': 4.0, 'write': 4.0})
+        self.assertEqual(summary['stages_mean'], {'decode': 2.0, 'write': 2.0})
+        self.assertEqual(summary['stages_fraction'], {'decode': 0.5, 'write': 0.5})
+        self.assertEqual(summary['counts'], {'axial_slices_kept': 10})
+        self.assertEqual(summary['peak_rss_increase'], {'decode': 20, 'write': 5})
+
+        subjects = report.as_dict()['subjects']
+        self.assertEqual(subjects[0]['total'], 4.0)
+        self.assertEqual(subjects[2]['status'], 'failed')
+        self.assertEqual(subjects[2]['error'], 'missing orig.mgz')
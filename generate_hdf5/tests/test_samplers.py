@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from generate_hdf5.data_loader.hdf5_io import HDF5SliceWriter
+from generate_hdf5.data_loader.load_neuroimaging_data import AsegDatasetWithAugmentation, get_slice_class_counts
+from generate_hdf5.data_loader.samplers import ClassBalancedSliceSampler, get_class_counts, get_slice_weights
+
+
+class ClassBalancedSliceSamplerTests(TestCase):
+    """
+    Test the slice weights and ClassBalancedSliceSampler.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.params = {'dataset_name': os.path.join(self.tmp_dir, 'test.hdf5'), 'plane': 'axial'}
+
+        # Class 1 in all slices, class 2 in the first slice only
+        rng = np.random.RandomState(0)
+        self.aseg = np.ones((16, 12, 4), dtype=np.uint8)
+        self.aseg[:8, :, :] = 0
+        self.aseg[:2, :2, 0] = 2
+        self.class_counts = get_slice_class_counts(self.aseg, 3)
+
+        with HDF5SliceWriter(self.params['dataset_name']) as writer:
+            writer.append(rng.randint(0, 255, size=(16, 12, 4, 7)).astype(np.uint8), self.aseg,
+                          rng.rand(16, 12, 4), 'sub0', class_counts=self.class_counts)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_slice_weights(self):
+        # Class 1 and 2 are drawn with probability 1/2 each, class 2 only from the first slice
+        np.testing.assert_allclose(get_slice_weights(self.class_counts, 'balanced'), [5 / 8., 1 / 8., 1 / 8., 1 / 8.])
+
+        weights = get_slice_weights(self.class_counts, 'inverse_frequency')
+        self.assertAlmostEqual(weights.sum(), 1.0)
+        self.assertGreater(weights[0], weights[1])
+
+        with self.assertRaises(ValueError):
+            get_slice_weights(self.class_counts, 'uniform')
+
+    def test_class_counts_cache(self):
+        np.testing.assert_array_equal(get_class_counts(self.params['dataset_name']), self.class_counts)
+
+        # Without class_counts dataset the counts are computed from the labels once and cached
+        with h5py.File(self.params['dataset_name'], "a") as hf:
+            del hf['class_counts']
+
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.makedirs(cache_dir)
+        np.testing.assert_array_equal(get_class_counts(self.params['dataset_name'], cache_dir), self.class_counts)
+        self.assertEqual(os.listdir(cache_dir), ['test.hdf5.class_counts.npz'])
+        np.testing.assert_array_equal(get_class_counts(self.params['dataset_name'], cache_dir), self.class_counts)
+
+    def test_sampler(self):
+        dataset = AsegDatasetWithAugmentation(dict(self.params, lazy=True))
+        sampler = ClassBalancedSliceSampler(dataset, num_samples=4000, seed=0)
+
+        indices = list(sampler)
+        self.assertEqual(len(indices), len(sampler))
+        self.assertAlmostEqual(indices.count(0) / 4000.0, 5 / 8., delta=0.03)
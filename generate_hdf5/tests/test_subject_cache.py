@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from generate_hdf5.data_loader.subject_cache import SubjectCache
+
+
+class SubjectCacheTests(TestCase):
+    """
+    Test SubjectCache.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.input_file = os.path.join(self.tmp_dir, 'orig.mgz')
+
+        with open(self.input_file, 'wb') as f:
+            f.write(b'volume')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_put_get(self):
+        cache = SubjectCache(self.cache_dir)
+        key = cache.key([self.input_file], gt_name='aseg.mgz')
+        arrays = {'orig': np.arange(24, dtype=np.uint8).reshape(2, 3, 4), 'weights': np.ones((2, 3, 4))}
+
+        self.assertIsNone(cache.get(key))
+        cache.put(key, arrays)
+
+        cached = cache.get(key)
+        self.assertEqual(sorted(cached), ['orig', 'weights'])
+        np.testing.assert_array_equal(cached['orig'], arrays['orig'])
+        np.testing.assert_array_equal(cached['weights'], arrays['weights'])
+
+    def test_key(self):
+        cache = SubjectCache(self.cache_dir)
+        key = cache.key([self.input_file], gt_name='aseg.mgz')
+
+        self.assertEqual(key, cache.key([self.input_file], gt_name='aseg.mgz'))
+        self.assertNotEqual(key, cache.key([self.input_file], gt_name='aparc+aseg.mgz'))
+
+        with open(self.input_file, 'wb') as f:
+            f.write(b'changed volume')
+
+        self.assertNotEqual(key, cache.key([self.input_file], gt_name='aseg.mgz'))
+
+    def test_evict(self):
+        array = np.zeros(1000, dtype=np.uint8)
+        cache = SubjectCache(self.cache_dir, max_size=2500)
+
+        for idx, key in enumerate(['a', 'b', 'c']):
+            cache.put(key, {'array': array})
+            os.utime(os.path.join(self.cache_dir, key), (idx, idx))
+
+            # Using 'a' makes 'b' the least recently used entry
+            if key == 'b':
+                self.assertIsNotNone(cache.get('a'))
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
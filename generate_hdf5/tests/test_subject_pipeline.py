@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import nibabel as nib
+import numpy as np
+
+from generate_hdf5.data_loader.profiling import StageTimer
+from generate_hdf5.data_loader.subject_cache import SubjectCache
+from generate_hdf5.data_loader.subject_pipeline import plan_memory, estimate_subject_memory, load_input_volume, \
+                                                     process_subject, PROCESS_BASE_MEMORY
+from generate_hdf5.tests.bench_data_loader import synthetic_aseg, synthetic_orig
+
+
+class LoadInputVolumeTests(TestCase):
+    """
+    Test load_input_volume with conform.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'orig.mgz')
+        data = (np.random.RandomState(0).rand(32, 32, 32) * 500).astype(np.float32)
+        nib.MGHImage(data, np.diag([-4.0, 4.0, 4.0, 1.0])).to_filename(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_conform_cache(self):
+        params = {'conform': True}
+        cache = SubjectCache(os.path.join(self.tmp_dir, 'cache'))
+
+        timer = StageTimer()
+        conformed = load_input_volume(self.filename, np.uint8, params, cache, timer)
+        self.assertEqual(conformed.shape, (256, 256, 256))
+        self.assertIn('conform', timer.stages)
+
+        timer = StageTimer()
+        cached = load_input_volume(self.filename, np.uint8, params, cache, timer)
+        self.assertNotIn('conform', timer.stages)
+        np.testing.assert_array_equal(conformed, cached)
+
+        # Without conform, the volume is loaded as is
+        self.assertEqual(load_input_volume(self.filename, np.uint8, {'conform': False}).shape, (32, 32, 32))
+
+
+class ProcessSubjectTests(TestCase):
+    """
+    Test process_subject with several planes against single plane runs.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp_dir, 'sub0', 'mri'))
+
+        aseg = synthetic_aseg((32, 36, 40))
+        nib.MGHImage(synthetic_orig(aseg), np.eye(4)).to_filename(os.path.join(self.tmp_dir, 'sub0', 'mri', 'orig.mgz'))
+        nib.MGHImage(aseg, np.eye(4)).to_filename(os.path.join(self.tmp_dir, 'sub0', 'mri', 'aparc.DKTatlas+aseg.mgz'))
+
+        self.params = {'inputdir': self.tmp_dir, 'image_name': 'mri/orig.mgz', 'gt_name': 'mri/aparc.DKTatlas+aseg.mgz',
+                       'slice_thickness': 3}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_all_planes(self):
+        planes = ['axial', 'coronal', 'sagittal']
+        processed, _ = process_subject('sub0', dict(self.params, planes=planes))
+        self.assertEqual(sorted(processed.keys()), sorted(planes))
+
+        for plane in planes:
+            single, _ = process_subject('sub0', dict(self.params, planes=[plane]))
+
+            for expected, computed in zip(single[plane], processed[plane]):
+                np.testing.assert_array_equal(expected, computed)
+
+
+class PlanMemoryTests(TestCase):
+    """
+    Test plan_memory.
+    """
+    def setUp(self):
+        self.shape = (256, 256, 256)
+        self.planes = ['axial', 'coronal', 'sagittal']
+
+    def test_fits_budget(self):
+        processing, result = estimate_subject_memory(self.shape, 3, self.planes)
+
+        for max_memory in [4, 8, 16, 64]:
+            budget = max_memory * 1024 ** 3
+            memory = plan_memory(budget, self.shape, 3, self.planes, jobs=8)
+
+            self.assertLessEqual(memory['jobs'], 8)
+            if memory['jobs'] > 1:
+                self.assertGreaterEqual(memory['window'], memory['jobs'])
+                self.assertLessEqual(memory['window'], 2 * memory['jobs'])
+                estimate = (memory['jobs'] + 1) * PROCESS_BASE_MEMORY + memory['jobs'] * processing + \
+                    memory['window'] * result
+                self.assertLessEqual(estimate, budget)
+
+        self.assertEqual(plan_memory(64 * 1024 ** 3, self.shape, 3, self.planes, jobs=8)['jobs'], 8)
+
+    def test_below_minimum(self):
+        memory = plan_memory(1024 ** 2, self.shape, 3, self.planes, jobs=4)
+
+        self.assertEqual(memory['jobs'], 1)
+        self.assertEqual(memory['buffer_slices'], 1)
+        self.assertGreater(memory['required'], 1024 ** 2)